@@ -0,0 +1,105 @@
+# accesos.py
+# Último acceso de las impresiones con escrituras agrupadas: cada acceso se anota en
+# memoria y un hilo por proceso los baja a la base cada ACCESOS['INTERVALO'] segundos
+# con un UPDATE ... CASE por lote. last_accessed puede atrasar hasta ese intervalo
+# (la limpieza de limpieza.py lo tiene en cuenta).
+import atexit
+import logging
+import os
+import threading
+
+from django.conf import settings
+from django.db import close_old_connections
+from django.db.models import Case, DateTimeField, F, Q, Value, When
+from django.utils import timezone
+
+from .models import Impresion
+
+logger = logging.getLogger('almacenamiento')
+
+
+class BufferAccesos:
+    """
+    {impresion_id: último acceso} pendientes de guardar. registrar() no toca la base;
+    volcar() escribe todo lo acumulado. Thread-safe.
+    """
+
+    def __init__(self):
+        self._pendientes = {}
+        self._lock = threading.Lock()
+        self._hilo = None
+
+    def registrar(self, impresion_id, cuando=None):
+        cuando = cuando or timezone.now()
+        with self._lock:
+            if self._pendientes.get(impresion_id) is None or self._pendientes[impresion_id] < cuando:
+                self._pendientes[impresion_id] = cuando
+            lleno = len(self._pendientes) >= settings.ACCESOS['MAX_PENDIENTES']
+            # INTERVALO 0: sin hilo, solo se vuelca al llenarse o a mano (volcar_accesos)
+            if self._hilo is None and settings.ACCESOS['INTERVALO']:
+                self._hilo = threading.Thread(target=self._bucle, name='accesos', daemon=True)
+                self._hilo.start()
+        if lleno:
+            self.volcar()
+        return cuando
+
+    def volcar(self):
+        """Guarda los accesos acumulados. Devuelve cuántas filas se actualizaron."""
+        with self._lock:
+            pendientes, self._pendientes = self._pendientes, {}
+        if not pendientes:
+            return 0
+        lote = settings.ACCESOS['LOTE']
+        items = sorted(pendientes.items())
+        actualizadas = 0
+        try:
+            for inicio in range(0, len(items), lote):
+                tanda = items[inicio:inicio + lote]
+                # Una fila por WHEN; nunca se atrasa un acceso ya guardado
+                actualizadas += Impresion.objects.filter(id__in=[i for i, _ in tanda]).update(
+                    last_accessed=Case(
+                        *[When(Q(id=impresion_id) & (Q(last_accessed__lt=cuando) | Q(last_accessed__isnull=True)),
+                               then=Value(cuando)) for impresion_id, cuando in tanda],
+                        default=F('last_accessed'),
+                        output_field=DateTimeField(),
+                    )
+                )
+        except Exception as e:
+            # Se vuelven a encolar (sin pisar accesos más nuevos) para el próximo volcado
+            logger.error(f"No se pudieron guardar {len(pendientes)} accesos: {e}")
+            with self._lock:
+                for impresion_id, cuando in pendientes.items():
+                    if self._pendientes.get(impresion_id) is None or self._pendientes[impresion_id] < cuando:
+                        self._pendientes[impresion_id] = cuando
+        return actualizadas
+
+    def _bucle(self):
+        evento = threading.Event()
+        while not evento.wait(settings.ACCESOS['INTERVALO']):
+            try:
+                self.volcar()
+            finally:
+                # Hilo propio: no hay request que cierre su conexión
+                close_old_connections()
+
+
+buffer_accesos = BufferAccesos()
+
+
+def registrar_acceso(impresion_id, cuando=None):
+    return buffer_accesos.registrar(impresion_id, cuando)
+
+
+def volcar_accesos():
+    return buffer_accesos.volcar()
+
+
+def _reiniciar_en_hijo():
+    # El hilo de volcado no sobrevive al fork: el hijo arranca con su propio buffer
+    global buffer_accesos
+    buffer_accesos = BufferAccesos()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reiniciar_en_hijo)
+atexit.register(lambda: buffer_accesos.volcar())
@@ -8,7 +8,7 @@ class UsuarioAdmin(admin.ModelAdmin):
     list_display = ('id', 'email', 'nombre', 'apellido', 'usuarioTipo', 'activo', 'created_at')
     list_filter = ('usuarioTipo', 'activo', 'created_at')
     search_fields = ('email', 'nombre', 'apellido', 'telefono')
-    readonly_fields = ('created_at', 'updated_at')
+    readonly_fields = ('created_at', 'updated_at', 'token_version')
     list_per_page = 20
     
     def save_model(self, request, obj, form, change):
@@ -18,6 +18,9 @@ class UsuarioAdmin(admin.ModelAdmin):
             if obj.contraseña and not obj.contraseña.startswith('pbkdf2_'):
                 from django.contrib.auth.hashers import make_password
                 obj.contraseña = make_password(obj.contraseña)
+        # Cambios de tipo o de estado invalidan los tokens con claims ya emitidos
+        if change and ('usuarioTipo' in form.changed_data or 'activo' in form.changed_data):
+            obj.token_version += 1
         super().save_model(request, obj, form, change)
 
 @admin.register(UsuarioTipo)
@@ -0,0 +1,262 @@
+# almacenamiento.py
+# Subida, borrado y acceso a los archivos de impresión (Cloudinary y Cloudflare R2)
+import base64
+import hashlib
+import logging
+import os
+import tempfile
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor, wait
+
+import boto3
+import requests
+from botocore.config import Config
+from django.conf import settings
+
+from .pdf import contar_paginas
+
+logger = logging.getLogger('almacenamiento')
+
+_storage = None
+_storage_lock = threading.Lock()
+
+
+def storage_cloudinary():
+    """Instancia única por proceso del storage de Cloudinary (reutiliza su pool HTTP)"""
+    global _storage
+    if _storage is None:
+        with _storage_lock:
+            if _storage is None:
+                from cloudinary_storage.storage import RawMediaCloudinaryStorage
+                _storage = RawMediaCloudinaryStorage()
+    return _storage
+
+
+class ArchivoSubido:
+    """
+    Resultado de una subida: path dentro del storage y URL pública.
+    nuevo=False indica que se reutilizó un objeto ya almacenado (ver blobs.py).
+    """
+
+    def __init__(self, nombre, url, nombre_original, sha256=None, tamanio=0, nuevo=True):
+        self.nombre = nombre
+        self.url = url
+        self.nombre_original = nombre_original
+        self.sha256 = sha256
+        self.tamanio = tamanio
+        self.nuevo = nuevo
+        self.blob = None
+
+
+def _subir(archivo, carpeta):
+    storage = storage_cloudinary()
+    extension = os.path.splitext(archivo.name)[1]
+    path_almacenado = storage.save(f"{carpeta}/{uuid.uuid4()}{extension}", archivo)
+    return ArchivoSubido(path_almacenado, storage.url(path_almacenado), archivo.name)
+
+
+def subir_archivos(archivos, carpeta='impresiones'):
+    """
+    Sube en paralelo (pool acotado por SUBIDAS_PARALELAS) un dict {clave: UploadedFile}.
+    Devuelve {clave: ArchivoSubido}. Si alguna subida falla, borra las que sí
+    terminaron y relanza el error, para no dejar objetos huérfanos en el bucket.
+    No toca la base: debe llamarse antes de abrir la transacción del pedido.
+    """
+    archivos = {clave: archivo for clave, archivo in archivos.items() if archivo}
+    if not archivos:
+        return {}
+
+    max_workers = min(getattr(settings, 'SUBIDAS_PARALELAS', 4), len(archivos))
+    with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='subida') as pool:
+        futuros = {clave: pool.submit(_subir, archivo, carpeta) for clave, archivo in archivos.items()}
+        wait(futuros.values())
+
+    subidos = {}
+    error = None
+    for clave, futuro in futuros.items():
+        if futuro.exception() is None:
+            subidos[clave] = futuro.result()
+        elif error is None:
+            error = futuro.exception()
+
+    if error is not None:
+        eliminar_subidos(subidos.values())
+        raise error
+    return subidos
+
+
+def eliminar_subidos(subidos):
+    """Borra del storage archivos subidos en este request (limpieza cuando falla la transacción)"""
+    storage = storage_cloudinary()
+    nombres = {subido.nombre for subido in subidos if subido.nuevo}
+    for nombre in nombres:
+        try:
+            storage.delete(nombre)
+        except Exception as e:
+            logger.error(f"No se pudo borrar el archivo huérfano {nombre}: {e}")
+
+
+# --- Cloudflare R2 (API compatible con S3) ---
+
+def config_r2():
+    """
+    Credenciales y endpoint de R2 desde variables de entorno.
+    CLOUDFLARE_ENDPOINT_URL permite apuntar a un S3 local (MinIO, moto) en desarrollo.
+    """
+    account_id = os.getenv('CLOUDFLARE_ACCOUNT_ID', 'tu-account-id')
+    return {
+        'endpoint_url': os.getenv('CLOUDFLARE_ENDPOINT_URL') or f'https://{account_id}.r2.cloudflarestorage.com',
+        'aws_access_key_id': os.getenv('CLOUDFLARE_ACCESS_KEY', 'tu-access-key'),
+        'aws_secret_access_key': os.getenv('CLOUDFLARE_SECRET_KEY', 'tu-secret-key'),
+        'region_name': os.getenv('CLOUDFLARE_REGION', 'auto'),
+    }
+
+
+_r2 = None
+_r2_lock = threading.Lock()
+
+
+def cliente_r2():
+    """
+    Devuelve (cliente S3 para R2, nombre del bucket). El cliente es único por proceso
+    (los clientes de boto3 son thread-safe): armarlo cuesta decenas de ms y cada uno
+    abre su propio pool de conexiones TLS.
+    """
+    global _r2
+    if _r2 is None:
+        with _r2_lock:
+            if _r2 is None:
+                config = settings.R2_CLIENTE
+                _r2 = boto3.session.Session().client('s3', config=Config(
+                    max_pool_connections=config['MAX_CONEXIONES'],
+                    connect_timeout=config['TIMEOUT_CONEXION'],
+                    read_timeout=config['TIMEOUT_LECTURA'],
+                    retries={'max_attempts': config['REINTENTOS'], 'mode': 'standard'},
+                    tcp_keepalive=True,
+                ), **config_r2())
+    return _r2, os.getenv('CLOUDFLARE_BUCKET_NAME', 'suchus-impresiones')
+
+
+def _olvidar_clientes():
+    """
+    En el proceso hijo de un fork (workers del qcluster, servidores con varios
+    procesos) no se reutilizan los sockets ni los locks del padre: los clientes
+    se vuelven a crear en el primer uso.
+    """
+    global _r2, _r2_lock, _storage, _storage_lock
+    _r2, _r2_lock = None, threading.Lock()
+    _storage, _storage_lock = None, threading.Lock()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_olvidar_clientes)
+
+
+def url_publica_r2(cloudflare_key):
+    base = os.getenv('CLOUDFLARE_PUBLIC_URL') or f"https://pub-{os.getenv('CLOUDFLARE_PUB_ID', 'your-pub-id')}.r2.dev"
+    return f"{base.rstrip('/')}/{cloudflare_key}"
+
+
+def nueva_clave_r2(nombre_archivo, carpeta='impresiones'):
+    extension = nombre_archivo.split('.')[-1] if '.' in nombre_archivo else 'pdf'
+    return f"{carpeta}/{uuid.uuid4()}.{extension}"
+
+
+class ObjetoRemoto:
+    """
+    File-like de solo lectura sobre un objeto de R2: cada read() pide únicamente
+    el rango necesario (con una lectura anticipada chica), así se puede inspeccionar
+    un plano de cientos de MB sin descargarlo (ver pdf.contar_paginas).
+    """
+
+    def __init__(self, s3, bucket, key, tamanio=None, bloque=256 * 1024):
+        self.s3 = s3
+        self.bucket = bucket
+        self.key = key
+        if tamanio is None:
+            tamanio = s3.head_object(Bucket=bucket, Key=key)['ContentLength']
+        self.tamanio = tamanio
+        self.bloque = bloque
+        self.posicion = 0
+        self._inicio_buffer = 0
+        self._buffer = b''
+
+    def seek(self, offset, whence=0):
+        if whence == 1:
+            offset += self.posicion
+        elif whence == 2:
+            offset += self.tamanio
+        self.posicion = max(0, offset)
+        return self.posicion
+
+    def tell(self):
+        return self.posicion
+
+    def read(self, cantidad=-1):
+        fin = self.tamanio if cantidad is None or cantidad < 0 else min(self.posicion + cantidad, self.tamanio)
+        if fin <= self.posicion:
+            return b''
+        fin_buffer = self._inicio_buffer + len(self._buffer)
+        if not (self._inicio_buffer <= self.posicion and fin <= fin_buffer):
+            hasta = min(max(fin, self.posicion + self.bloque), self.tamanio)
+            respuesta = self.s3.get_object(Bucket=self.bucket, Key=self.key,
+                                           Range=f'bytes={self.posicion}-{hasta - 1}')
+            self._inicio_buffer, self._buffer = self.posicion, respuesta['Body'].read()
+        desde = self.posicion - self._inicio_buffer
+        datos = self._buffer[desde:desde + fin - self.posicion]
+        self.posicion += len(datos)
+        return datos
+
+
+def bloques_archivo(impresion, bloque=1024 * 1024):
+    """Contenido del archivo de una impresión por bloques: de R2 si tiene key, si no de su URL"""
+    if impresion.cloudflare_key:
+        s3, bucket = cliente_r2()
+        cuerpo = s3.get_object(Bucket=bucket, Key=impresion.cloudflare_key)['Body']
+        yield from cuerpo.iter_chunks(bloque)
+    else:
+        with requests.get(impresion.url, stream=True, timeout=30) as respuesta:
+            respuesta.raise_for_status()
+            yield from respuesta.iter_content(bloque)
+
+
+def contar_paginas_r2(s3, bucket, key, tamanio=None):
+    """Páginas de un PDF ya almacenado en R2, leyendo solo los rangos necesarios (None si no se pudo)"""
+    try:
+        return contar_paginas(ObjetoRemoto(s3, bucket, key, tamanio))
+    except Exception as e:
+        logger.warning(f"No se pudieron contar las páginas de {key}: {e}")
+        return None
+
+
+class ParteLeida:
+    """Parte de una subida volcada a un archivo temporal, con sus digests"""
+
+    def __init__(self, archivo, bytes_leidos, sha256, md5_b64):
+        self.archivo = archivo
+        self.bytes_leidos = bytes_leidos
+        self.sha256 = sha256
+        self.md5_b64 = md5_b64
+
+
+def leer_parte(stream, limite, bloque=1024 * 1024):
+    """
+    Lee hasta `limite` bytes del stream a un archivo temporal (en memoria hasta
+    1 MiB, después a disco) calculando SHA-256 y MD5 en una sola pasada.
+    No usa request.body, así que no aplica DATA_UPLOAD_MAX_MEMORY_SIZE.
+    """
+    archivo = tempfile.SpooledTemporaryFile(max_size=bloque)
+    sha256 = hashlib.sha256()
+    md5 = hashlib.md5()
+    leidos = 0
+    while leidos < limite:
+        datos = stream.read(min(bloque, limite - leidos))
+        if not datos:
+            break
+        sha256.update(datos)
+        md5.update(datos)
+        archivo.write(datos)
+        leidos += len(datos)
+    archivo.seek(0)
+    return ParteLeida(archivo, leidos, sha256.hexdigest(), base64.b64encode(md5.digest()).decode())
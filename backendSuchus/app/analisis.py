@@ -0,0 +1,88 @@
+# analisis.py
+# Análisis de un archivo de impresión dentro de un proceso del pool de preflight.
+# No importa Django ni modelos: el proceso hijo solo necesita pdf.py, así funciona
+# con cualquier método de arranque (fork, spawn, forkserver).
+import signal
+import zlib
+from collections import Counter
+
+from .pdf import PDFInvalido, analizar_paginas, contar_paginas
+
+# Medidas ISO 216 en mm (lado corto, lado largo)
+MEDIDAS_MM = {
+    'A0': (841, 1189),
+    'A1': (594, 841),
+    'A2': (420, 594),
+    'A3': (297, 420),
+    'A4': (210, 297),
+    'A5': (148, 210),
+    'A6': (105, 148),
+}
+MM_POR_PUNTO = 25.4 / 72
+TOLERANCIA_MM = 5
+
+
+def formato_de(ancho_pt, alto_pt):
+    """Formato A0-A6 de una página (sin importar la orientación) u 'otro'"""
+    corto, largo = sorted((ancho_pt * MM_POR_PUNTO, alto_pt * MM_POR_PUNTO))
+    for formato, (medida_corto, medida_largo) in MEDIDAS_MM.items():
+        if abs(corto - medida_corto) <= TOLERANCIA_MM and abs(largo - medida_largo) <= TOLERANCIA_MM:
+            return formato
+    return 'otro'
+
+
+def inicializar_proceso(memoria_mb):
+    """Initializer del pool: limita la memoria del proceso (solo donde existe RLIMIT_AS)"""
+    try:
+        import resource
+    except ImportError:  # Windows
+        return
+    limite = memoria_mb * 1024 * 1024
+    try:
+        resource.setrlimit(resource.RLIMIT_AS, (limite, limite))
+    except (ValueError, OSError):
+        pass
+
+
+def _vencido(signum, frame):
+    raise TimeoutError('Se superó el tiempo de análisis')
+
+
+def analizar(ruta, max_paginas, timeout):
+    """
+    Páginas, formatos y color de un PDF. Corre en el proceso hijo; el timeout se
+    aplica acá con SIGALRM (el padre tiene además su propio límite por si el
+    proceso queda colgado en código C).
+    """
+    alarma = hasattr(signal, 'setitimer')
+    if alarma:
+        signal.signal(signal.SIGALRM, _vencido)
+        signal.setitimer(signal.ITIMER_REAL, timeout)
+    try:
+        with open(ruta, 'rb') as archivo:
+            paginas = contar_paginas(archivo)
+            if paginas is None:
+                return {'error': 'No es un PDF legible'}
+            if paginas > max_paginas:
+                return {'paginas': paginas, 'error': f'Más de {max_paginas} páginas, no se analizó'}
+            try:
+                detalle = analizar_paginas(archivo, max_paginas)
+            except (PDFInvalido, zlib.error, ValueError) as e:
+                return {'paginas': paginas, 'error': f'No se pudo recorrer el PDF: {e}'}
+    except (TimeoutError, MemoryError) as e:
+        # No depende solo del archivo (carga del servidor): no se guarda y se reintenta
+        return {'error': str(e) or 'Memoria insuficiente para analizar el archivo', 'transitorio': True}
+    finally:
+        if alarma:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+
+    formatos = Counter(formato_de(ancho, alto) for ancho, alto, _ in detalle)
+    paginas_color = sum(1 for _, _, color in detalle if color)
+    return {
+        'paginas': paginas,
+        'formatos': dict(formatos),
+        'formato': formatos.most_common(1)[0][0] if formatos else None,
+        'color': paginas_color > 0,
+        'paginas_color': paginas_color,
+        'error': None,
+    }
@@ -4,3 +4,11 @@ from django.apps import AppConfig
 class AppConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'app'
+
+    def ready(self):
+        # Registra las señales que invalidan la cache de usuarios autenticados
+        from . import authentication  # noqa: F401
+        # y la que libera los archivos deduplicados al borrar impresiones
+        from . import blobs  # noqa: F401
+        # y la que invalida la tabla de tarifas de impresión
+        from . import precios  # noqa: F401
@@ -1,6 +1,102 @@
+import copy
+
+from django.conf import settings
+from django.db.models import F
+from django.db.models.signals import post_save, post_delete
+from django.utils.functional import cached_property
+from django.dispatch import receiver
 from rest_framework_simplejwt.authentication import JWTAuthentication
 from rest_framework_simplejwt.exceptions import InvalidToken
-from .models import Usuario
+from .cache_local import CacheTTL
+from .models import Usuario, UsuarioTipo
+
+
+_config_cache = getattr(settings, 'USUARIO_CACHE', {})
+
+# Usuarios ya resueltos (con usuarioTipo incluido) por id, por proceso
+usuarios_cache = CacheTTL(
+    ttl=_config_cache.get('TTL', 30),
+    max_entradas=_config_cache.get('MAX_ENTRADAS', 2048),
+)
+
+
+def obtener_usuario_activo(user_id):
+    """
+    Devuelve el Usuario activo con su usuarioTipo ya cargado, pasando por la
+    cache del proceso. Lanza Usuario.DoesNotExist si no existe o está inactivo.
+    """
+    user = usuarios_cache.get(user_id)
+    if user is None:
+        user = Usuario.objects.select_related('usuarioTipo').get(id=user_id, activo=True)
+        usuarios_cache.set(user_id, user)
+    # Cada request recibe su propia copia para que nadie modifique la instancia cacheada
+    return copy.copy(user)
+
+
+# Versión vigente de los tokens de cada usuario (None = inactivo/inexistente)
+versiones_cache = CacheTTL(
+    ttl=_config_cache.get('TTL_VERSION', 15),
+    max_entradas=_config_cache.get('MAX_ENTRADAS', 2048),
+)
+_SIN_VERSION = object()
+
+
+def obtener_token_version(user_id):
+    """Devuelve la token_version de un usuario activo, o None si no está activo"""
+    version = versiones_cache.get(user_id, _SIN_VERSION)
+    if version is _SIN_VERSION:
+        version = (Usuario.objects
+                   .filter(id=user_id, activo=True)
+                   .values_list('token_version', flat=True)
+                   .first())
+        versiones_cache.set(user_id, version)
+    return version
+
+
+def agregar_claims_de_rol(token, user):
+    """Firma en el token el tipo de usuario, si es admin y su descuento"""
+    token['tipo_id'] = user.usuarioTipo_id
+    token['tipo'] = user.usuarioTipo.descripcion
+    token['es_admin'] = user.es_admin()
+    token['descuento'] = user.descuento
+    token['tv'] = user.token_version
+    return token
+
+
+class UsuarioPrincipal:
+    """
+    Usuario autenticado construido solo con los claims del access token.
+    Expone lo que usan los endpoints calientes (id, rol y descuento) sin ir a
+    la base; cualquier otro atributo se resuelve contra el Usuario real.
+    """
+    is_authenticated = True
+    is_active = True
+    is_anonymous = False
+
+    def __init__(self, validated_token):
+        self.id = self.pk = validated_token['user_id']
+        self.email = validated_token.get('email')
+        self.nombre = validated_token.get('nombre')
+        self.usuarioTipo_id = validated_token.get('tipo_id')
+        self.tipo = validated_token.get('tipo')
+        self.descuento = validated_token.get('descuento', 0)
+        self._es_admin = bool(validated_token.get('es_admin'))
+
+    def es_admin(self):
+        return self._es_admin
+
+    @cached_property
+    def usuario(self):
+        return obtener_usuario_activo(self.id)
+
+    def __getattr__(self, nombre):
+        # Solo se llama para atributos que el principal no tiene (ej: usuarioTipo)
+        if nombre.startswith('_'):
+            raise AttributeError(nombre)
+        return getattr(self.usuario, nombre)
+
+    def __str__(self):
+        return f"{self.nombre} (token)"
 
 
 class CustomJWTAuthentication(JWTAuthentication):
@@ -8,7 +104,7 @@ class CustomJWTAuthentication(JWTAuthentication):
     Custom JWT Authentication that works with the Usuario model
     instead of Django's default User model
     """
-    
+
     def get_user(self, validated_token):
         """
         Attempts to find and return a user using the given validated token.
@@ -17,14 +113,38 @@ class CustomJWTAuthentication(JWTAuthentication):
             user_id = validated_token.get('user_id')
         except KeyError:
             raise InvalidToken('Token contained no recognizable user identification')
-        
+
+        if settings.JWT_CLAIMS_AUTH and 'tv' in validated_token:
+            if obtener_token_version(user_id) != validated_token['tv']:
+                raise InvalidToken('Token desactualizado: inicie sesión nuevamente')
+            return UsuarioPrincipal(validated_token)
+
         try:
-            user = Usuario.objects.get(id=user_id, activo=True)
+            user = obtener_usuario_activo(user_id)
         except Usuario.DoesNotExist:
             raise InvalidToken('User not found or inactive')
-        
+
         # Add required attributes for DRF permissions
         user.is_authenticated = True
         user.is_active = user.activo
-        
+
         return user
+
+
+# --- Invalidación de la cache ---
+# Las señales solo limpian la cache del proceso que hizo el cambio; en los demás
+# workers la entrada vieja vive como máximo USUARIO_CACHE['TTL'] segundos.
+
+@receiver([post_save, post_delete], sender=Usuario)
+def invalidar_usuario_cache(sender, instance, **kwargs):
+    usuarios_cache.delete(instance.pk)
+    versiones_cache.delete(instance.pk)
+
+
+@receiver([post_save, post_delete], sender=UsuarioTipo)
+def invalidar_usuarios_de_tipo(sender, instance, created=False, **kwargs):
+    usuarios_cache.delete_where(lambda usuario: usuario.usuarioTipo_id == instance.pk)
+    if kwargs.get('signal') is post_save and not created:
+        # El descuento o la descripción del tipo viajan en los tokens de sus usuarios
+        Usuario.objects.filter(usuarioTipo=instance).update(token_version=F('token_version') + 1)
+        versiones_cache.clear()
@@ -0,0 +1,147 @@
+# blobs.py
+# Deduplicación de archivos de impresión por contenido (SHA-256) con conteo de referencias
+import hashlib
+import logging
+from collections import defaultdict
+
+from django.db import IntegrityError, transaction
+from django.db.models import F
+from django.db.models.signals import post_delete
+from django.dispatch import receiver
+
+from . import almacenamiento
+from .almacenamiento import ArchivoSubido, subir_archivos
+from .models import ArchivoBlob, Impresion
+
+logger = logging.getLogger('almacenamiento')
+
+CLOUDINARY = 'cloudinary'
+R2 = 'r2'
+
+
+def sha256_archivo(archivo):
+    """SHA-256 de un UploadedFile leyendo por chunks (sin cargarlo entero en memoria)"""
+    digest = hashlib.sha256()
+    for chunk in archivo.chunks():
+        digest.update(chunk)
+    archivo.seek(0)
+    return digest.hexdigest()
+
+
+def buscar_blobs(digests, backend):
+    """{sha256: ArchivoBlob} de los contenidos que ya están almacenados"""
+    if not digests:
+        return {}
+    return {blob.sha256: blob
+            for blob in ArchivoBlob.objects.filter(backend=backend, sha256__in=set(digests))}
+
+
+def preparar_subidas(archivos, carpeta='impresiones'):
+    """
+    Versión con deduplicación de subir_archivos (Cloudinary). Fuera de la transacción:
+    calcula el SHA-256 de cada archivo y sube en paralelo solo los contenidos que
+    todavía no están almacenados, una vez por contenido aunque se repitan en el pedido.
+    Devuelve {clave: ArchivoSubido}; las referencias se suman después con vincular_blobs.
+    """
+    archivos = {clave: archivo for clave, archivo in archivos.items() if archivo}
+    if not archivos:
+        return {}
+
+    digests = {clave: sha256_archivo(archivo) for clave, archivo in archivos.items()}
+    existentes = buscar_blobs(digests.values(), CLOUDINARY)
+    a_subir = {}
+    for clave, archivo in archivos.items():
+        if digests[clave] not in existentes:
+            a_subir.setdefault(digests[clave], archivo)
+    nuevos = subir_archivos(a_subir, carpeta)
+
+    subidos = {}
+    for clave, archivo in archivos.items():
+        digest = digests[clave]
+        if digest in nuevos:
+            nombre, url, nuevo = nuevos[digest].nombre, nuevos[digest].url, True
+        else:
+            nombre, url, nuevo = existentes[digest].ruta, existentes[digest].url, False
+        subidos[clave] = ArchivoSubido(nombre, url, archivo.name, sha256=digest,
+                                       tamanio=archivo.size, nuevo=nuevo)
+    return subidos
+
+
+def vincular_blobs(subidos, backend):
+    """
+    Dentro de la transacción del alta: suma una referencia por archivo a su blob
+    (creándolo para los contenidos recién subidos) y asigna subido.blob; el
+    objeto a usar es siempre subido.blob.ruta. Si otro request registró el mismo
+    contenido en paralelo, se usa el suyo y la copia subida en este request se
+    borra al confirmar.
+    """
+    por_digest = defaultdict(list)
+    for subido in subidos:
+        por_digest[subido.sha256].append(subido)
+    if not por_digest:
+        return
+
+    # Bloquear los blobs evita que una baja simultánea los borre mientras se referencian
+    bloqueados = {blob.sha256: blob for blob in ArchivoBlob.objects.select_for_update()
+                  .filter(backend=backend, sha256__in=list(por_digest))}
+    incrementos = defaultdict(list)
+    for digest, lista in por_digest.items():
+        blob = bloqueados.get(digest)
+        base = next((subido for subido in lista if subido.nuevo), None)
+        creado = False
+        if blob is None:
+            if base is None:
+                raise ValueError(f"El archivo {lista[0].nombre_original} se eliminó durante la subida, reintentar")
+            try:
+                with transaction.atomic():
+                    blob = ArchivoBlob.objects.create(
+                        sha256=digest, backend=backend, ruta=base.nombre, url=base.url,
+                        tamanio=base.tamanio, referencias=len(lista),
+                    )
+                    creado = True
+            except IntegrityError:
+                blob = ArchivoBlob.objects.select_for_update().get(backend=backend, sha256=digest)
+        if not creado:
+            incrementos[len(lista)].append(blob.pk)
+        if base is not None and base.nombre != blob.ruta:
+            transaction.on_commit(lambda ruta=base.nombre: borrar_objeto(backend, ruta))
+        for subido in lista:
+            subido.blob = blob
+
+    for cantidad, ids in incrementos.items():
+        ArchivoBlob.objects.filter(pk__in=ids).update(referencias=F('referencias') + cantidad)
+
+
+def liberar_blob(blob_id):
+    """
+    Resta una referencia. Con la última, borra el blob y (al confirmar la
+    transacción) el objeto remoto. Devuelve True si el objeto se eliminó.
+    """
+    with transaction.atomic():
+        blob = ArchivoBlob.objects.select_for_update().filter(pk=blob_id).first()
+        if blob is None:
+            return False
+        if blob.referencias > 1:
+            ArchivoBlob.objects.filter(pk=blob_id).update(referencias=F('referencias') - 1)
+            return False
+        blob.delete()
+        transaction.on_commit(lambda: borrar_objeto(blob.backend, blob.ruta))
+    return True
+
+
+def borrar_objeto(backend, ruta):
+    try:
+        if backend == R2:
+            s3, bucket_name = almacenamiento.cliente_r2()
+            s3.delete_object(Bucket=bucket_name, Key=ruta)
+        else:
+            almacenamiento.storage_cloudinary().delete(ruta)
+    except Exception as e:
+        logger.error(f"No se pudo borrar el objeto {ruta} ({backend}): {e}")
+
+
+@receiver(post_delete, sender=Impresion)
+def liberar_blob_de_impresion(sender, instance, **kwargs):
+    # Cubre destroy, limpiar_antiguos y los borrados en cascada (ej: al borrar un usuario)
+    if instance.fk_blob_id:
+        liberar_blob(instance.fk_blob_id)
@@ -0,0 +1,279 @@
+# cache_archivos.py
+# Caché en disco local de los archivos de impresión para las PCs del local: la
+# primera descarga baja el archivo de Cloudinary/R2 y las siguientes (reimpresiones,
+# revisiones) salen del disco. Tamaño acotado con desalojo LRU por fecha de uso.
+import hashlib
+import logging
+import mimetypes
+import os
+import re
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import close_old_connections, transaction
+from django.http import FileResponse, HttpResponse, StreamingHttpResponse
+from django.utils.http import content_disposition_header
+
+from .almacenamiento import bloques_archivo
+from .models import Impresion
+
+logger = logging.getLogger('almacenamiento')
+
+RE_RANGO = re.compile(r'^bytes=(\d*)-(\d*)$')
+BLOQUE_LECTURA = 256 * 1024
+
+
+def clave_de(impresion):
+    """Nombre en disco: el SHA-256 del contenido si está deduplicado, si no un hash de la URL"""
+    if impresion.fk_blob_id:
+        return impresion.fk_blob.sha256
+    return 'url-' + hashlib.sha256(impresion.url.encode()).hexdigest()
+
+
+class CacheDisco:
+    """
+    Archivos en un directorio, uno por clave. El orden LRU es el mtime: cada hit lo
+    renueva con os.utime, así varios procesos sobre el mismo directorio comparten
+    el orden. Las escrituras van a un temporal y se publican con os.replace (nadie
+    lee un archivo a medio bajar).
+    """
+
+    def __init__(self, directorio, max_bytes):
+        self.directorio = directorio
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._descargas = {}   # clave -> Lock: una sola descarga por clave en el proceso
+        os.makedirs(directorio, exist_ok=True)
+
+    def ruta(self, clave):
+        return os.path.join(self.directorio, clave)
+
+    def obtener(self, impresion):
+        """Ruta local del archivo de la impresión, bajándolo si no está"""
+        clave = clave_de(impresion)
+        ruta = self.ruta(clave)
+        if self._tocar(ruta):
+            return ruta
+        with self._lock:
+            lock = self._descargas.setdefault(clave, threading.Lock())
+        with lock:
+            # Otro hilo pudo haberlo bajado mientras se esperaba
+            if not self._tocar(ruta):
+                self._descargar(impresion, ruta)
+                self.desalojar()
+        with self._lock:
+            self._descargas.pop(clave, None)
+        return ruta
+
+    def contiene(self, impresion):
+        return os.path.exists(self.ruta(clave_de(impresion)))
+
+    def _tocar(self, ruta):
+        try:
+            os.utime(ruta)
+            return True
+        except FileNotFoundError:
+            return False
+
+    def _descargar(self, impresion, ruta):
+        descriptor, temporal = tempfile.mkstemp(dir=self.directorio, prefix='.descarga-')
+        try:
+            with os.fdopen(descriptor, 'wb') as destino:
+                for bloque in bloques_archivo(impresion):
+                    destino.write(bloque)
+            os.replace(temporal, ruta)
+        except BaseException:
+            os.unlink(temporal)
+            raise
+
+    def desalojar(self):
+        """Borra los menos usados hasta quedar por debajo de max_bytes"""
+        archivos = []
+        abandonadas = time.time() - 3600
+        for entrada in os.scandir(self.directorio):
+            if not entrada.is_file():
+                continue
+            estado = entrada.stat()
+            if entrada.name.startswith('.'):
+                # Descargas que quedaron a medias (proceso terminado en el medio)
+                if estado.st_mtime < abandonadas:
+                    os.unlink(entrada.path)
+                continue
+            archivos.append((estado.st_mtime, estado.st_size, entrada.path))
+        total = sum(tamanio for _, tamanio, _ in archivos)
+        for _, tamanio, ruta in sorted(archivos):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.unlink(ruta)
+                total -= tamanio
+            except FileNotFoundError:
+                pass
+
+
+_cache = None
+_cache_lock = threading.Lock()
+_precarga = None
+
+
+def cache_archivos():
+    """Instancia única por proceso de la caché configurada en CACHE_ARCHIVOS"""
+    global _cache
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                config = settings.CACHE_ARCHIVOS
+                _cache = CacheDisco(config['DIRECTORIO'], config['MAX_BYTES'])
+    return _cache
+
+
+def precargar(impresion_ids):
+    """Baja a la caché los archivos que todavía no están (ej: pedidos que pasan a En proceso)"""
+    cache = cache_archivos()
+    try:
+        for impresion in Impresion.objects.filter(id__in=impresion_ids).select_related('fk_blob'):
+            if cache.contiene(impresion):
+                continue
+            try:
+                cache.obtener(impresion)
+            except Exception as e:
+                logger.warning(f"No se pudo precargar la impresión #{impresion.id}: {e}")
+    finally:
+        # Corre en un hilo propio: no hay request que cierre su conexión
+        close_old_connections()
+
+
+def precargar_pedidos(pedido_ids):
+    """
+    Al confirmar la transacción, precarga en segundo plano los archivos de esos
+    pedidos. Corre en un hilo del proceso web: es el que tiene el disco de la caché.
+    """
+    pedido_ids = list(pedido_ids)
+    if not pedido_ids:
+        return
+
+    def lanzar():
+        global _precarga
+        with _cache_lock:
+            if _precarga is None:
+                _precarga = ThreadPoolExecutor(max_workers=settings.CACHE_ARCHIVOS['PRECARGA_HILOS'],
+                                               thread_name_prefix='precarga')
+        ids = list(Impresion.objects.filter(pedidoimpresiondetalle__fk_pedido__in=pedido_ids)
+                   .values_list('id', flat=True))
+        if ids:
+            _precarga.submit(precargar, ids)
+
+    transaction.on_commit(lanzar)
+
+
+def _reiniciar_en_hijo():
+    # Los hilos de precarga no sobreviven al fork
+    global _precarga
+    _precarga = None
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reiniciar_en_hijo)
+
+
+def rango_pedido(cabecera, tamanio):
+    """
+    (inicio, fin inclusive) del header Range, None si no aplica (se manda el archivo
+    entero) o False si no se puede satisfacer. Solo un rango; varios se ignoran.
+    """
+    m = RE_RANGO.match(cabecera.strip()) if cabecera else None
+    if m is None or m.group(1) == m.group(2) == '':
+        return None
+    if m.group(1) == '':
+        # bytes=-N: los últimos N bytes
+        largo = int(m.group(2))
+        return (max(tamanio - largo, 0), tamanio - 1) if largo else False
+    inicio = int(m.group(1))
+    fin = min(int(m.group(2)), tamanio - 1) if m.group(2) else tamanio - 1
+    if inicio >= tamanio or fin < inicio:
+        return False
+    return inicio, fin
+
+
+def leer_rango(archivo, inicio, largo):
+    """Bloques de largo bytes desde inicio; el archivo ya abierto sobrevive a un desalojo"""
+    with archivo:
+        archivo.seek(inicio)
+        while largo > 0:
+            datos = archivo.read(min(BLOQUE_LECTURA, largo))
+            if not datos:
+                break
+            largo -= len(datos)
+            yield datos
+
+
+async def leer_rango_async(archivo, inicio, largo):
+    """
+    Igual que leer_rango para ASGI (uvicorn): Django consume los iteradores
+    sincrónicos con sync_to_async(list), o sea el archivo entero en memoria.
+    Cada lectura va a un hilo y se entrega bloque a bloque.
+    """
+    leer = sync_to_async(archivo.read, thread_sensitive=False)
+    try:
+        await sync_to_async(archivo.seek, thread_sensitive=False)(inicio)
+        while largo > 0:
+            datos = await leer(min(BLOQUE_LECTURA, largo))
+            if not datos:
+                break
+            largo -= len(datos)
+            yield datos
+    finally:
+        archivo.close()
+
+
+def es_asgi(request):
+    return 'wsgi.version' not in request.META
+
+
+def servir(request, ruta, nombre, etag):
+    """
+    Respuesta con el archivo de la caché. Con CACHE_ARCHIVOS['SENDFILE'] el envío lo
+    hace el proxy (X-Accel-Redirect / X-Sendfile, sin pasar por Python). Si no, en
+    WSGI el archivo entero va como FileResponse (wsgi.file_wrapper -> sendfile) y en
+    ASGI con un iterador asíncrono por bloques. Range de un solo tramo -> 206;
+    If-Range con otro ETag -> archivo entero.
+    Lanza FileNotFoundError si el desalojo lo borró desde obtener().
+    """
+    config = settings.CACHE_ARCHIVOS
+    tipo = mimetypes.guess_type(nombre)[0] or 'application/octet-stream'
+
+    if config.get('SENDFILE'):
+        os.stat(ruta)
+        # El proxy resuelve Range y el envío
+        response = HttpResponse(content_type=tipo)
+        response[config['SENDFILE']] = config['PREFIJO_SENDFILE'].rstrip('/') + '/' + os.path.basename(ruta)
+    else:
+        archivo = open(ruta, 'rb')
+        tamanio = os.fstat(archivo.fileno()).st_size
+        if_range = request.headers.get('If-Range')
+        rango = rango_pedido(request.headers.get('Range'), tamanio) if if_range in (None, etag) else None
+        if rango is False:
+            archivo.close()
+            response = HttpResponse(status=416)
+            response['Content-Range'] = f'bytes */{tamanio}'
+            return response
+        if rango is None and not es_asgi(request):
+            response = FileResponse(archivo, content_type=tipo)
+        else:
+            inicio, fin = rango or (0, tamanio - 1)
+            largo = fin - inicio + 1
+            bloques = leer_rango_async if es_asgi(request) else leer_rango
+            response = StreamingHttpResponse(bloques(archivo, inicio, largo), content_type=tipo,
+                                             status=200 if rango is None else 206)
+            response['Content-Length'] = str(largo)
+            if rango is not None:
+                response['Content-Range'] = f'bytes {inicio}-{fin}/{tamanio}'
+    response['Accept-Ranges'] = 'bytes'
+    response['ETag'] = etag
+    response['Content-Disposition'] = content_disposition_header(False, nombre)
+    response['Cache-Control'] = 'private, max-age=3600'
+    return response
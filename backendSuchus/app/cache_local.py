@@ -0,0 +1,54 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class CacheTTL:
+    """
+    Cache en memoria por proceso (cada worker de gunicorn tiene la suya).
+    Combina expiración por tiempo (TTL) con desalojo LRU cuando se llena.
+    Es thread-safe para poder usarse desde los threads del servidor.
+    """
+
+    def __init__(self, ttl=30, max_entradas=1024):
+        self.ttl = ttl
+        self.max_entradas = max_entradas
+        self._datos = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, clave, default=None):
+        with self._lock:
+            entrada = self._datos.get(clave)
+            if entrada is None:
+                return default
+            valor, vence = entrada
+            if vence < time.monotonic():
+                del self._datos[clave]
+                return default
+            self._datos.move_to_end(clave)
+            return valor
+
+    def set(self, clave, valor):
+        with self._lock:
+            self._datos[clave] = (valor, time.monotonic() + self.ttl)
+            self._datos.move_to_end(clave)
+            while len(self._datos) > self.max_entradas:
+                self._datos.popitem(last=False)
+
+    def delete(self, clave):
+        with self._lock:
+            self._datos.pop(clave, None)
+
+    def delete_where(self, condicion):
+        """Elimina todas las entradas cuyo valor cumple la condición"""
+        with self._lock:
+            claves = [c for c, (valor, _) in self._datos.items() if condicion(valor)]
+            for clave in claves:
+                del self._datos[clave]
+
+    def clear(self):
+        with self._lock:
+            self._datos.clear()
+
+    def __len__(self):
+        return len(self._datos)
@@ -0,0 +1,47 @@
+# condicional.py
+# GET condicionales (ETag / Last-Modified) para listados. Los validadores salen de
+# MAX(updated_at) y COUNT(*) del queryset ya filtrado: una query, sin serializar nada.
+import hashlib
+
+from django.db.models import Count, Max
+from django.utils.cache import get_conditional_response, patch_vary_headers
+from django.utils.http import http_date
+
+
+def validadores(request, queryset, campos_fecha=('updated_at',), extra=''):
+    """
+    Devuelve (etag, ultima_modificacion) del listado.
+    campos_fecha son las columnas updated_at que afectan a la representación
+    (ej: la del usuario, cuyo nombre viaja en cada pedido). La URL completa y el
+    usuario entran en el ETag: cada página, filtro o rol tiene su propio validador.
+    El COUNT detecta bajas, que no mueven el MAX(updated_at); es DISTINCT porque
+    un campo de una relación múltiple (ej: las impresiones del pedido) repite filas.
+    """
+    maximos = {f'max_{i}': Max(campo) for i, campo in enumerate(campos_fecha)}
+    datos = queryset.order_by().aggregate(cantidad=Count('pk', distinct=True), **maximos)
+    fechas = [datos[clave] for clave in maximos if datos[clave] is not None]
+
+    firma = '|'.join([request.get_full_path(), str(request.user.pk), str(datos['cantidad'])]
+                     + [str(datos[clave]) for clave in maximos] + [str(extra)])
+    etag = f'W/"{hashlib.sha1(firma.encode()).hexdigest()}"'
+    return etag, max(fechas) if fechas else None
+
+
+def respuesta_condicional(request, queryset, construir, campos_fecha=('updated_at',), extra=''):
+    """
+    Responde 304 si el cliente ya tiene la versión vigente (If-None-Match /
+    If-Modified-Since); si no, llama a construir() y le agrega los validadores.
+    """
+    etag, ultima = validadores(request, queryset, campos_fecha, extra)
+    last_modified = int(ultima.timestamp()) if ultima else None
+
+    no_modificado = get_conditional_response(request, etag=etag, last_modified=last_modified)
+    response = no_modificado if no_modificado is not None else construir()
+    if 200 <= response.status_code < 300 or response.status_code == 304:
+        response['ETag'] = etag
+        if last_modified:
+            response['Last-Modified'] = http_date(last_modified)
+        # El navegador guarda la respuesta pero la revalida siempre (axios recibe el 200 cacheado)
+        response['Cache-Control'] = 'private, no-cache'
+        patch_vary_headers(response, ('Authorization',))
+    return response
@@ -0,0 +1,303 @@
+# eventos.py
+# Cambios de estado de pedidos en vivo por Server-Sent Events (servido por la app ASGI).
+# Cada pestaña abierta es una conexión ociosa esperando en una cola, en lugar de
+# re-pedir el listado completo de pedidos cada tanto.
+import asyncio
+import hashlib
+import json
+import logging
+import secrets
+import select
+import threading
+import time
+from collections import defaultdict
+from datetime import datetime, timedelta, timezone as dt_timezone
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import connection, connections, transaction
+from django.http import JsonResponse, StreamingHttpResponse
+from django.utils import timezone
+from django.utils.module_loading import import_string
+from rest_framework import permissions, status
+from rest_framework.decorators import api_view, permission_classes
+from rest_framework.response import Response
+
+from .authentication import obtener_usuario_activo
+from .models import TicketEventos, Usuario
+
+logger = logging.getLogger('eventos')
+
+CANAL_ADMINS = 'admins'
+
+
+def canal_usuario(usuario_id):
+    return f'usuario:{usuario_id}'
+
+
+class BrokerLocal:
+    """
+    Broker en memoria del proceso: reparte cada evento a las colas suscriptas a su
+    canal. publicar() se puede llamar desde cualquier hilo (las vistas sync corren
+    en el thread pool de asgiref); la entrega se agenda en el event loop de cada cola.
+    Solo ve las conexiones de su propio proceso: sirve en desarrollo o con un único
+    proceso web. Con varios procesos/nodos va BrokerPostgres (EVENTOS['BROKER']).
+    """
+
+    def __init__(self, max_cola=100):
+        self.max_cola = max_cola
+        self._suscriptores = defaultdict(set)
+        self._lock = threading.Lock()
+
+    def suscribir(self, canales):
+        """Cola asyncio (del loop actual) que recibe los eventos de los canales"""
+        cola = asyncio.Queue(maxsize=self.max_cola)
+        entrada = (asyncio.get_running_loop(), cola)
+        with self._lock:
+            for canal in canales:
+                self._suscriptores[canal].add(entrada)
+        return cola
+
+    def desuscribir(self, canales, cola):
+        with self._lock:
+            for canal in canales:
+                self._suscriptores[canal] = {e for e in self._suscriptores[canal] if e[1] is not cola}
+                if not self._suscriptores[canal]:
+                    del self._suscriptores[canal]
+
+    def publicar(self, canal, evento):
+        with self._lock:
+            destinos = list(self._suscriptores.get(canal, ()))
+        for loop, cola in destinos:
+            try:
+                loop.call_soon_threadsafe(_entregar, cola, evento)
+            except RuntimeError:
+                # El loop ya se cerró (conexión terminando)
+                pass
+        return len(destinos)
+
+    def cantidad_suscriptores(self):
+        with self._lock:
+            return sum(len(entradas) for entradas in self._suscriptores.values())
+
+
+class BrokerPostgres(BrokerLocal):
+    """
+    Broker compartido sobre LISTEN/NOTIFY de Postgres: publicar() hace un pg_notify
+    y cada proceso web tiene un hilo escuchando el canal que reparte lo recibido a
+    sus propias colas (como BrokerLocal). El hilo arranca con la primera suscripción
+    y se reconecta solo; mientras está caído los eventos se pierden, igual que con
+    una cola llena (el cliente recarga el listado al reconectar).
+    LISTEN necesita una conexión directa: si DATABASE_URL pasa por un pooler en modo
+    transacción (ej: el host -pooler de Neon), EVENTOS['LISTEN_URL'] apunta al directo.
+    """
+    CANAL_PG = 'suchus_eventos'
+
+    def __init__(self, max_cola=100):
+        super().__init__(max_cola)
+        self._escucha = None
+
+    def suscribir(self, canales):
+        self._iniciar_escucha()
+        return super().suscribir(canales)
+
+    def publicar(self, canal, evento):
+        # Se llama desde on_commit (autocommit): el NOTIFY sale en el momento
+        mensaje = json.dumps({'canal': canal, 'evento': evento})
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT pg_notify(%s, %s)', [self.CANAL_PG, mensaje])
+
+    def recibir(self, mensaje):
+        """Reparte a las colas de este proceso un NOTIFY recibido"""
+        datos = json.loads(mensaje)
+        return super().publicar(datos['canal'], datos['evento'])
+
+    def _iniciar_escucha(self):
+        with self._lock:
+            if self._escucha is None or not self._escucha.is_alive():
+                self._escucha = threading.Thread(target=self._escuchar, name='eventos-listen', daemon=True)
+                self._escucha.start()
+
+    def _conectar(self):
+        url = settings.EVENTOS.get('LISTEN_URL')
+        if url:
+            import psycopg2
+            conexion = psycopg2.connect(url)
+        else:
+            # Conexión propia del hilo, con la configuración de DATABASES['default']
+            conexion = connections.create_connection('default')
+            conexion.ensure_connection()
+            conexion = conexion.connection
+        conexion.autocommit = True
+        conexion.cursor().execute(f'LISTEN {self.CANAL_PG}')
+        return conexion
+
+    def _escuchar(self):
+        espera = settings.EVENTOS['HEARTBEAT']
+        while True:
+            conexion = None
+            try:
+                conexion = self._conectar()
+                while True:
+                    if select.select([conexion], [], [], espera) == ([], [], []):
+                        continue
+                    conexion.poll()
+                    while conexion.notifies:
+                        self.recibir(conexion.notifies.pop(0).payload)
+            except Exception as e:
+                logger.error(f"Se cortó la escucha de eventos en Postgres, reconectando: {e}")
+                time.sleep(5)
+            finally:
+                if conexion is not None:
+                    try:
+                        conexion.close()
+                    except Exception:
+                        pass
+
+
+def _entregar(cola, evento):
+    try:
+        cola.put_nowait(evento)
+    except asyncio.QueueFull:
+        # Cliente que no consume: se descarta el evento, al reconectar recarga el listado
+        logger.warning("Cola SSE llena, evento descartado")
+
+
+_broker = None
+_broker_lock = threading.Lock()
+
+
+def obtener_broker():
+    """Instancia única por proceso del broker configurado en EVENTOS['BROKER']"""
+    global _broker
+    if _broker is None:
+        with _broker_lock:
+            if _broker is None:
+                config = settings.EVENTOS
+                _broker = import_string(config['BROKER'])(max_cola=config['MAX_COLA'])
+    return _broker
+
+
+# --- Publicación (desde las vistas sync) ---
+
+def publicar_cambios_estado(pedidos):
+    """
+    Avisa el nuevo estado de los pedidos a su dueño y a los admins. pedidos es una
+    lista de dicts con id, fk_usuario_id, estado y version. Dentro de una
+    transacción el envío espera al commit: nadie ve un estado que se revierte.
+    """
+    pedidos = [dict(pedido) for pedido in pedidos]
+    if pedidos:
+        transaction.on_commit(lambda: _publicar(pedidos))
+
+
+def _publicar(pedidos):
+    broker = obtener_broker()
+    for pedido in pedidos:
+        evento = {
+            'tipo': 'pedido_estado',
+            'id': pedido['id'],
+            'estado': pedido['estado'],
+            'version': pedido.get('version'),
+            'motivo_correccion': pedido.get('motivo_correccion'),
+        }
+        try:
+            broker.publicar(CANAL_ADMINS, evento)
+            if pedido.get('fk_usuario_id'):
+                broker.publicar(canal_usuario(pedido['fk_usuario_id']), evento)
+        except Exception as e:
+            # Los eventos son best-effort: el cambio ya se confirmó
+            logger.error(f"No se pudo publicar el cambio del pedido #{pedido['id']}: {e}")
+
+
+# --- Endpoint SSE ---
+
+def hash_ticket(ticket):
+    return hashlib.sha256(ticket.encode()).hexdigest()
+
+
+@api_view(['POST'])
+@permission_classes([permissions.IsAuthenticated])
+def ticket_eventos(request):
+    """
+    POST /api/eventos/ticket/
+    Ticket de un solo uso, válido EVENTOS['TTL_TICKET'] segundos, para abrir el
+    stream. Va en la URL en lugar del access token, que viviría en los logs de
+    acceso de uvicorn y de los proxies hasta vencer.
+    """
+    ticket = secrets.token_urlsafe(32)
+    ahora = timezone.now()
+    ttl = settings.EVENTOS['TTL_TICKET']
+    TicketEventos.objects.filter(expira__lt=ahora).delete()
+    TicketEventos.objects.create(
+        clave=hash_ticket(ticket), fk_usuario_id=request.user.id,
+        expira=ahora + timedelta(seconds=ttl),
+        vence_stream=datetime.fromtimestamp(request.auth['exp'], tz=dt_timezone.utc),
+    )
+    return Response({'ticket': ticket, 'expira_en': ttl}, status=status.HTTP_201_CREATED)
+
+
+def canjear_ticket(ticket):
+    """
+    Consume el ticket (borrarlo es lo que lo hace de un solo uso, también entre
+    procesos). Devuelve (usuario, vencimiento epoch) o None si no es válido.
+    """
+    fila = (TicketEventos.objects
+            .filter(clave=hash_ticket(ticket), expira__gt=timezone.now())
+            .values('pk', 'fk_usuario_id', 'vence_stream')
+            .first())
+    if fila is None or not TicketEventos.objects.filter(pk=fila['pk']).delete()[0]:
+        return None
+    try:
+        usuario = obtener_usuario_activo(fila['fk_usuario_id'])
+    except Usuario.DoesNotExist:
+        return None
+    return usuario, fila['vence_stream'].timestamp()
+
+
+def formatear(evento):
+    return f"event: {evento['tipo']}\ndata: {json.dumps(evento)}\n\n"
+
+
+async def stream_pedidos(request):
+    """
+    GET /api/eventos/pedidos/?ticket=<ticket de POST /api/eventos/ticket/>
+    Stream text/event-stream con los cambios de estado: los admins reciben los de
+    todos los pedidos, el resto solo los propios. Se cierra cuando vence el access
+    token con que se pidió el ticket para que el cliente reconecte con uno nuevo.
+    """
+    ticket = request.GET.get('ticket')
+    if not ticket:
+        return JsonResponse({'error': 'Falta el parámetro ticket'}, status=401)
+    canjeado = await sync_to_async(canjear_ticket)(ticket)
+    if canjeado is None:
+        return JsonResponse({'error': 'Ticket inválido, vencido o ya usado'}, status=401)
+    usuario, vencimiento = canjeado
+
+    canales = [CANAL_ADMINS] if usuario.es_admin() else [canal_usuario(usuario.id)]
+    config = settings.EVENTOS
+
+    async def flujo():
+        broker = obtener_broker()
+        cola = broker.suscribir(canales)
+        try:
+            yield f"retry: {config['RETRY_MS']}\n\n"
+            while True:
+                restante = vencimiento - time.time()
+                if restante <= 0:
+                    yield "event: token_vencido\ndata: {}\n\n"
+                    return
+                try:
+                    evento = await asyncio.wait_for(cola.get(), timeout=min(config['HEARTBEAT'], restante))
+                except asyncio.TimeoutError:
+                    # Comentario SSE: mantiene viva la conexión a través de proxies
+                    yield ": ping\n\n"
+                    continue
+                yield formatear(evento)
+        finally:
+            broker.desuscribir(canales, cola)
+
+    response = StreamingHttpResponse(flujo(), content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'
+    return response
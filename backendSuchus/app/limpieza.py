@@ -0,0 +1,240 @@
+# limpieza.py
+# Limpieza de impresiones sin uso (POST /api/impresiones/limpiar_antiguos/) en el
+# cluster de django-q2: una tarea por lote, cada una encola la siguiente. El lote
+# borra las filas en una transacción corta y anota los objetos remotos que quedan
+# sin uso; después, ya fuera de la transacción, los borra con DeleteObjects (hasta
+# 1000 claves por llamada). Los que fallan quedan anotados y se reintentan.
+import logging
+import time
+from collections import Counter
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F, Q
+from django.utils import timezone
+from django_q.tasks import async_task
+
+from . import almacenamiento
+from .blobs import R2
+from .models import ArchivoBlob, Impresion, LimpiezaAlmacenamiento, SesionSubida
+
+logger = logging.getLogger('almacenamiento')
+
+MAX_CLAVES_DELETE = 1000   # límite de DeleteObjects
+MAX_ERRORES = 50           # errores guardados en el trabajo (el resto solo se cuenta)
+
+
+def iniciar_limpieza(dias, usuario=None):
+    """
+    Crea el trabajo y lo manda al cluster al confirmar. Devuelve el trabajo.
+    usuario puede ser un UsuarioPrincipal (JWT_CLAIMS_AUTH): solo se usa su id.
+    """
+    # last_accessed puede atrasar hasta un intervalo de volcado (accesos.py): se corre
+    # el límite ese tanto para no borrar un archivo usado recién
+    margen = timedelta(seconds=settings.ACCESOS['INTERVALO'])
+    limpieza = LimpiezaAlmacenamiento.objects.create(
+        dias=dias, fecha_limite=timezone.now() - timedelta(days=dias) - margen,
+        fk_usuario_id=getattr(usuario, 'id', None)
+    )
+    transaction.on_commit(lambda: despachar(limpieza.id))
+    return limpieza
+
+
+def despachar(limpieza_id, paso=None):
+    try:
+        async_task('app.limpieza.ejecutar_limpieza', limpieza_id, paso,
+                   task_name=f"limpieza-{limpieza_id}-{paso or 0}")
+    except Exception as e:
+        # Queda 'En curso' sin avanzar: reanudar_limpiezas lo retoma al vencer el lease
+        logger.error(f"No se pudo encolar la limpieza {limpieza_id}: {e}")
+
+
+def reservar(limpieza_id, paso=None):
+    """
+    Toma el trabajo si está pendiente, si quien lo tenía dejó de dar señales (cada
+    lote renueva updated_at) o si es la tarea que encoló el lote anterior (paso):
+    dos workers nunca lo corren a la vez. Devuelve el trabajo o None.
+    """
+    vencido = timezone.now() - timedelta(seconds=settings.LIMPIEZA['LEASE'])
+    condicion = Q(estado='Pendiente') | Q(estado='En curso', updated_at__lt=vencido)
+    if paso is not None:
+        condicion |= Q(estado='En curso', paso=paso)
+    tomado = LimpiezaAlmacenamiento.objects.filter(condicion, id=limpieza_id).update(
+        estado='En curso', updated_at=timezone.now(), paso=F('paso') + 1
+    )
+    return LimpiezaAlmacenamiento.objects.get(id=limpieza_id) if tomado else None
+
+
+def borrar_claves_r2(s3, bucket, claves):
+    """DeleteObjects en tandas de 1000. Devuelve (claves confirmadas, {clave: error})"""
+    errores = {}
+    claves = list(claves)
+    for inicio in range(0, len(claves), MAX_CLAVES_DELETE):
+        tanda = claves[inicio:inicio + MAX_CLAVES_DELETE]
+        try:
+            respuesta = s3.delete_objects(Bucket=bucket, Delete={
+                'Objects': [{'Key': clave} for clave in tanda], 'Quiet': True,
+            })
+        except Exception as e:
+            errores.update({clave: str(e) for clave in tanda})
+            continue
+        for error in respuesta.get('Errors', []):
+            errores[error['Key']] = f"{error.get('Code')}: {error.get('Message')}"
+    return set(claves) - set(errores), errores
+
+
+def borrar_rutas_cloudinary(rutas, limite=None):
+    """Una llamada por ruta; las que no entran antes de limite (time.monotonic) quedan sin intentar"""
+    storage = almacenamiento.storage_cloudinary()
+    confirmadas, errores = set(), {}
+    for ruta in rutas:
+        if limite is not None and time.monotonic() > limite:
+            break
+        try:
+            storage.delete(ruta)
+            confirmadas.add(ruta)
+        except Exception as e:
+            errores[ruta] = str(e)
+    return confirmadas, errores
+
+
+def procesar_lote(limpieza, filas):
+    """
+    filas: [(id, cloudflare_key, fk_blob_id)]. En una transacción sin llamadas de
+    red: bloquea los blobs del lote, descuenta sus referencias, elimina las
+    impresiones y anota en limpieza.pendientes los objetos remotos que quedaron sin
+    uso, junto con el avance. Devuelve esos objetos ([backend, ruta]).
+    """
+    with transaction.atomic():
+        # Bloqueados mientras se descuentan: una subida del mismo contenido espera y,
+        # si el blob se borra, sube su propia copia en vez de apuntar al objeto anotado
+        usos = Counter(blob_id for _, _, blob_id in filas if blob_id)
+        blobs = {blob.pk: blob for blob in ArchivoBlob.objects.select_for_update().filter(pk__in=list(usos))}
+        sin_referencias = sorted(blob_id for blob_id, blob in blobs.items() if blob.referencias <= usos[blob_id])
+
+        objetos = [[R2, clave] for _, clave, blob_id in filas if clave and not blob_id]
+        objetos += [[blobs[b].backend, blobs[b].ruta] for b in sin_referencias]
+        ids = [impresion_id for impresion_id, _, _ in filas]
+
+        # Las referencias se descuentan acá en lote: se desvinculan antes de borrar
+        # para que la señal de blobs.py no las descuente otra vez una por una
+        Impresion.objects.filter(id__in=ids, fk_blob__isnull=False).update(fk_blob=None)
+        ArchivoBlob.objects.filter(pk__in=sin_referencias).delete()
+        por_cantidad = {}
+        for blob_id, cantidad in usos.items():
+            if blob_id in blobs and blob_id not in sin_referencias:
+                por_cantidad.setdefault(cantidad, []).append(blob_id)
+        for cantidad, blob_ids in por_cantidad.items():
+            ArchivoBlob.objects.filter(pk__in=blob_ids).update(referencias=F('referencias') - cantidad)
+        Impresion.objects.filter(id__in=ids).delete()
+
+        limpieza.ultimo_id = filas[-1][0]
+        limpieza.eliminadas += len(ids)
+        limpieza.pendientes = limpieza.pendientes + objetos
+        limpieza.save(update_fields=['ultimo_id', 'eliminadas', 'pendientes', 'updated_at'])
+    return objetos
+
+
+def borrar_pendientes(limpieza, objetos):
+    """
+    Borra los objetos remotos [backend, ruta] fuera de toda transacción (ningún lock
+    queda tomado durante las llamadas) y saca de limpieza.pendientes los confirmados;
+    los que fallan quedan para reintentar. Devuelve cuántos se confirmaron.
+    """
+    limite = time.monotonic() + settings.LIMPIEZA['SEGUNDOS_BORRADO']
+    claves_r2 = {ruta for backend, ruta in objetos if backend == R2}
+    rutas_cloudinary = [ruta for backend, ruta in objetos if backend != R2]
+
+    confirmadas, errores = set(), {}
+    if claves_r2:
+        s3, bucket = almacenamiento.cliente_r2()
+        confirmadas, errores = borrar_claves_r2(s3, bucket, claves_r2)
+    if rutas_cloudinary:
+        ok, fallas = borrar_rutas_cloudinary(rutas_cloudinary, limite)
+        confirmadas |= ok
+        errores.update(fallas)
+
+    limpieza.pendientes = [objeto for objeto in limpieza.pendientes if objeto[1] not in confirmadas]
+    limpieza.fallidas = len(limpieza.pendientes)
+    limpieza.errores = (limpieza.errores + [f"{clave}: {error}" for clave, error in errores.items()])[-MAX_ERRORES:]
+    limpieza.save(update_fields=['pendientes', 'fallidas', 'errores', 'updated_at'])
+    for clave, error in errores.items():
+        logger.warning(f"Limpieza {limpieza.id}: no se pudo borrar {clave}: {error}")
+    return len(confirmadas)
+
+
+def abortar_subidas_vencidas():
+    """Aborta las subidas por partes abandonadas (R2 cobra las partes huérfanas)"""
+    vencimiento = timezone.now() - timedelta(hours=settings.SUBIDA_PARTES['VIGENCIA_HORAS'])
+    sesiones = list(SesionSubida.objects.filter(estado='Activa', updated_at__lt=vencimiento))
+    if not sesiones:
+        return
+    s3, bucket = almacenamiento.cliente_r2()
+    for sesion in sesiones:
+        try:
+            s3.abort_multipart_upload(Bucket=bucket, Key=sesion.cloudflare_key, UploadId=sesion.upload_id)
+        except Exception as e:
+            logger.warning(f"No se pudo abortar el multipart {sesion.upload_id}: {e}")
+    SesionSubida.objects.filter(id__in=[sesion.id for sesion in sesiones]).update(
+        estado='Cancelada', updated_at=timezone.now()
+    )
+
+
+def ejecutar_limpieza(limpieza_id, paso=None):
+    """
+    Tarea del cluster: procesa UN lote de LIMPIEZA['LOTE'] impresiones a partir de
+    ultimo_id y encola la tarea siguiente, así cada una entra holgada en
+    Q_CLUSTER['timeout']. Terminado el recorrido, vuelve sobre los objetos que no se
+    pudieron borrar hasta LIMPIEZA['REINTENTOS'] vueltas sin avance. Si el worker se
+    corta, el trabajo se retoma desde el último lote confirmado (reanudar_limpiezas).
+    """
+    limpieza = reservar(limpieza_id, paso)
+    if limpieza is None:
+        return None
+    try:
+        filas = list(Impresion.objects
+                     .filter(last_accessed__lt=limpieza.fecha_limite, id__gt=limpieza.ultimo_id)
+                     .order_by('id')
+                     .values_list('id', 'cloudflare_key', 'fk_blob_id')[:settings.LIMPIEZA['LOTE']])
+        if filas:
+            objetos = procesar_lote(limpieza, filas)
+            if objetos:
+                borrar_pendientes(limpieza, objetos)
+        elif limpieza.pendientes and limpieza.reintentos < settings.LIMPIEZA['REINTENTOS']:
+            # Recorrido terminado: otra vuelta sobre los objetos que quedaron sin borrar
+            confirmados = borrar_pendientes(limpieza, limpieza.pendientes)
+            if not confirmados:
+                LimpiezaAlmacenamiento.objects.filter(id=limpieza_id).update(reintentos=F('reintentos') + 1)
+        else:
+            abortar_subidas_vencidas()
+            limpieza.estado = 'Completada'
+            limpieza.finalizada_at = timezone.now()
+            limpieza.save(update_fields=['estado', 'finalizada_at', 'updated_at'])
+            logger.info(f"Limpieza {limpieza_id}: {limpieza.eliminadas} eliminadas, "
+                        f"{limpieza.fallidas} objetos sin borrar")
+            return limpieza.eliminadas
+    except Exception as e:
+        logger.error(f"Limpieza {limpieza_id} interrumpida en el id {limpieza.ultimo_id}: {e}")
+        LimpiezaAlmacenamiento.objects.filter(id=limpieza_id).update(
+            estado='Fallida', errores=(limpieza.errores + [str(e)])[-MAX_ERRORES:], updated_at=timezone.now()
+        )
+        raise
+    despachar(limpieza_id, limpieza.paso)
+    return None
+
+
+def reanudar_limpiezas():
+    """
+    Barrido de respaldo (agendado cada 10 minutos por la migración 0030): vuelve a
+    encolar los trabajos fallidos o cuyo worker dejó de avanzar. Retoman desde ultimo_id.
+    """
+    vencido = timezone.now() - timedelta(seconds=settings.LIMPIEZA['LEASE'])
+    trabajadas = LimpiezaAlmacenamiento.objects.filter(
+        Q(estado__in=['Pendiente', 'En curso'], updated_at__lt=vencido) | Q(estado='Fallida')
+    )
+    ids = list(trabajadas.values_list('id', flat=True))
+    LimpiezaAlmacenamiento.objects.filter(id__in=ids, estado='Fallida').update(estado='Pendiente')
+    for limpieza_id in ids:
+        despachar(limpieza_id)
+    return len(ids)
@@ -0,0 +1,37 @@
+# Generated by Django 6.0.1 on 2026-10-18 09:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0018_usuario_token_version'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='impresion',
+            index=models.Index(fields=['fk_usuario', '-id'], name='impresion_usuario_id_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='impresion',
+            index=models.Index(fields=['formato', 'color', '-id'], name='impresion_formato_id_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='pedido',
+            index=models.Index(fields=['fk_usuario', '-id'], name='pedido_usuario_id_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='pedido',
+            index=models.Index(fields=['estado', '-id'], name='pedido_estado_id_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='pedido',
+            index=models.Index(fields=['fecha', '-id'], name='pedido_fecha_id_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='usuario',
+            index=models.Index(fields=['activo', '-id'], name='usuario_activo_id_idx'),
+        ),
+    ]
@@ -0,0 +1,35 @@
+# Generated by Django 6.0.1 on 2026-10-18 12:10
+
+import django.db.models.deletion
+import uuid
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0019_indices_paginacion_cursor'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SesionSubida',
+            fields=[
+                ('id', models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False)),
+                ('nombre_archivo', models.CharField(max_length=255)),
+                ('content_type', models.CharField(default='application/pdf', max_length=100)),
+                ('tamanio', models.BigIntegerField()),
+                ('bytes_parte', models.PositiveIntegerField()),
+                ('formato', models.CharField(choices=[('A0', 'A0 (841 × 1189 mm)'), ('A1', 'A1 (594 × 841 mm)'), ('A2', 'A2 (420 × 594 mm)'), ('A3', 'A3 (297 × 420 mm)'), ('A4', 'A4 (210 × 297 mm)'), ('A5', 'A5 (148 × 210 mm)'), ('A6', 'A6 (105 × 148 mm)')], default='A4', max_length=3)),
+                ('color', models.BooleanField(default=False)),
+                ('cloudflare_key', models.CharField(max_length=500)),
+                ('upload_id', models.CharField(max_length=500)),
+                ('partes', models.JSONField(blank=True, default=dict)),
+                ('estado', models.CharField(choices=[('Activa', 'activa'), ('Completada', 'completada'), ('Cancelada', 'cancelada')], default='Activa', max_length=20)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('fk_impresion', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to='app.impresion')),
+                ('fk_usuario', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='app.usuario')),
+            ],
+        ),
+    ]
@@ -0,0 +1,35 @@
+# Generated by Django 6.0.1 on 2026-10-18 13:05
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0020_sesion_subida'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ArchivoBlob',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('sha256', models.CharField(max_length=64)),
+                ('backend', models.CharField(choices=[('cloudinary', 'Cloudinary'), ('r2', 'Cloudflare R2')], max_length=10)),
+                ('ruta', models.CharField(max_length=500)),
+                ('url', models.CharField(max_length=300)),
+                ('tamanio', models.BigIntegerField(default=0)),
+                ('referencias', models.PositiveIntegerField(default=0)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('sha256', 'backend'), name='blob_sha256_backend_unico')],
+            },
+        ),
+        migrations.AddField(
+            model_name='impresion',
+            name='fk_blob',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to='app.archivoblob'),
+        ),
+    ]
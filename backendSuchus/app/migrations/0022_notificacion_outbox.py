@@ -0,0 +1,34 @@
+# Generated by Django 6.0.1 on 2026-10-18 13:40
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0021_archivo_blob'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='NotificacionPendiente',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('tipo', models.CharField(choices=[('cambio_estado', 'Cambio de estado'), ('correccion', 'Corrección requerida')], default='cambio_estado', max_length=20)),
+                ('estado_pedido', models.CharField(choices=[('Pendiente', 'pendiente'), ('En proceso', 'en proceso'), ('Preparado', 'preparado'), ('Retirado', 'retirado'), ('Cancelado', 'cancelado'), ('Requiere Corrección', 'requiere corrección')], max_length=100)),
+                ('motivo', models.TextField(blank=True, null=True)),
+                ('estado', models.CharField(choices=[('Pendiente', 'pendiente'), ('Enviada', 'enviada'), ('Fallida', 'fallida')], default='Pendiente', max_length=20)),
+                ('intentos', models.PositiveSmallIntegerField(default=0)),
+                ('proximo_intento', models.DateTimeField(default=django.utils.timezone.now)),
+                ('ultimo_error', models.TextField(blank=True, null=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('enviada_at', models.DateTimeField(blank=True, null=True)),
+                ('fk_pedido', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='notificaciones', to='app.pedido')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['estado', 'proximo_intento'], name='notif_pendiente_idx')],
+            },
+        ),
+    ]
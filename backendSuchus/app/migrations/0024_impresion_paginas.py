@@ -0,0 +1,18 @@
+# Generated by Django 6.0.1 on 2026-10-18 15:10
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0023_pedido_version'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='impresion',
+            name='paginas',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+    ]
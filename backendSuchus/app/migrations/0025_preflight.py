@@ -0,0 +1,43 @@
+# Generated by Django 6.0.1 on 2026-10-18 16:02
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0024_impresion_paginas'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ResultadoPreflight',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('sha256', models.CharField(max_length=64, unique=True)),
+                ('paginas', models.PositiveIntegerField(blank=True, null=True)),
+                ('formato', models.CharField(blank=True, max_length=4, null=True)),
+                ('formatos', models.JSONField(blank=True, default=dict)),
+                ('color', models.BooleanField(blank=True, null=True)),
+                ('paginas_color', models.PositiveIntegerField(default=0)),
+                ('error', models.TextField(blank=True, null=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='impresion',
+            name='preflight_estado',
+            field=models.CharField(blank=True, choices=[('Pendiente', 'Pendiente'), ('Aprobada', 'Aprobada'), ('Observada', 'Observada'), ('Error', 'Error')], max_length=10, null=True),
+        ),
+        migrations.AddField(
+            model_name='impresion',
+            name='preflight_observaciones',
+            field=models.JSONField(blank=True, default=list),
+        ),
+        migrations.AddField(
+            model_name='impresion',
+            name='fk_preflight',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to='app.resultadopreflight'),
+        ),
+    ]
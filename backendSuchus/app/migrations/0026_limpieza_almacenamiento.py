@@ -0,0 +1,31 @@
+# Generated by Django 6.0.1 on 2026-10-18 11:20
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0025_preflight'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LimpiezaAlmacenamiento',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('dias', models.PositiveIntegerField()),
+                ('fecha_limite', models.DateTimeField()),
+                ('estado', models.CharField(choices=[('Pendiente', 'pendiente'), ('En curso', 'en curso'), ('Completada', 'completada'), ('Fallida', 'fallida')], default='Pendiente', max_length=20)),
+                ('ultimo_id', models.BigIntegerField(default=0)),
+                ('eliminadas', models.PositiveIntegerField(default=0)),
+                ('fallidas', models.PositiveIntegerField(default=0)),
+                ('errores', models.JSONField(blank=True, default=list)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('finalizada_at', models.DateTimeField(blank=True, null=True)),
+                ('fk_usuario', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to='app.usuario')),
+            ],
+        ),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 6.0.1 on 2026-10-18 12:05
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0026_limpieza_almacenamiento'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='impresion',
+            name='last_accessed',
+            field=models.DateTimeField(blank=True, default=django.utils.timezone.now, null=True),
+        ),
+    ]
@@ -0,0 +1,30 @@
+# Migración de datos: agenda en django-q el barrido del outbox (outbox.reintentar_pendientes)
+# para las notificaciones que quedaron pendientes porque el broker no respondió al confirmar.
+
+from django.db import migrations
+
+NOMBRE = 'reintentar-notificaciones'
+
+
+def agendar(apps, schema_editor):
+    Schedule = apps.get_model('django_q', 'Schedule')
+    Schedule.objects.update_or_create(
+        name=NOMBRE,
+        defaults={'func': 'app.outbox.reintentar_pendientes', 'schedule_type': 'I', 'minutes': 5, 'repeats': -1},
+    )
+
+
+def desagendar(apps, schema_editor):
+    apps.get_model('django_q', 'Schedule').objects.filter(name=NOMBRE).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0027_impresion_last_accessed_agrupado'),
+        ('django_q', '0014_schedule_cluster'),
+    ]
+
+    operations = [
+        migrations.RunPython(agendar, desagendar),
+    ]
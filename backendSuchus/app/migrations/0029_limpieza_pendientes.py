@@ -0,0 +1,28 @@
+# Generated by Django 6.0.1 on 2026-10-18 15:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0028_agenda_reintento_notificaciones'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='limpiezaalmacenamiento',
+            name='paso',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='limpiezaalmacenamiento',
+            name='pendientes',
+            field=models.JSONField(blank=True, default=list),
+        ),
+        migrations.AddField(
+            model_name='limpiezaalmacenamiento',
+            name='reintentos',
+            field=models.PositiveSmallIntegerField(default=0),
+        ),
+    ]
@@ -0,0 +1,30 @@
+# Migración de datos: agenda en django-q limpieza.reanudar_limpiezas, que retoma los
+# trabajos de limpieza fallidos o cuyo worker se cortó.
+
+from django.db import migrations
+
+NOMBRE = 'reanudar-limpiezas'
+
+
+def agendar(apps, schema_editor):
+    Schedule = apps.get_model('django_q', 'Schedule')
+    Schedule.objects.update_or_create(
+        name=NOMBRE,
+        defaults={'func': 'app.limpieza.reanudar_limpiezas', 'schedule_type': 'I', 'minutes': 10, 'repeats': -1},
+    )
+
+
+def desagendar(apps, schema_editor):
+    apps.get_model('django_q', 'Schedule').objects.filter(name=NOMBRE).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0029_limpieza_pendientes'),
+        ('django_q', '0014_schedule_cluster'),
+    ]
+
+    operations = [
+        migrations.RunPython(agendar, desagendar),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 6.0.1 on 2026-10-18 12:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0030_agenda_reanudar_limpiezas'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='impresion',
+            name='impresion_formato_id_idx',
+        ),
+        migrations.RemoveIndex(
+            model_name='pedido',
+            name='pedido_fecha_id_idx',
+        ),
+        migrations.AddIndex(
+            model_name='impresion',
+            index=models.Index(fields=['formato', '-id'], name='impresion_formato_id_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='impresion',
+            index=models.Index(fields=['color', '-id'], name='impresion_color_id_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='pedido',
+            index=models.Index(fields=['fecha'], name='pedido_fecha_idx'),
+        ),
+    ]
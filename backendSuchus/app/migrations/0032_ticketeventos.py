@@ -0,0 +1,24 @@
+# Generated by Django 6.0.1 on 2026-10-18 13:10
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0031_indices_cursor'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TicketEventos',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('clave', models.CharField(max_length=64, unique=True)),
+                ('expira', models.DateTimeField(db_index=True)),
+                ('vence_stream', models.DateTimeField()),
+                ('fk_usuario', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='app.usuario')),
+            ],
+        ),
+    ]
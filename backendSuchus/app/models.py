@@ -1,4 +1,7 @@
+import uuid
+
 from django.db import models
+from django.utils import timezone
 from django.core.validators import MinValueValidator, MaxValueValidator
 # Create your models here.
 class UsuarioTipo(models.Model):
@@ -21,6 +24,9 @@ class Usuario(models.Model):
     telefono = models.CharField(max_length=20, blank=True, null=True)
     usuarioTipo = models.ForeignKey(UsuarioTipo, on_delete=models.CASCADE)
     activo = models.BooleanField(default=True)
+    # Se incrementa al desactivar o cambiar el tipo del usuario para invalidar
+    # los access tokens que llevan el rol y el descuento como claims
+    token_version = models.PositiveIntegerField(default=0)
     created_at = models.DateTimeField(auto_now_add=True, null=True, blank=True)
     updated_at = models.DateTimeField(auto_now=True, null=True, blank=True)
     
@@ -30,6 +36,16 @@ class Usuario(models.Model):
     def es_admin(self):
         return self.usuarioTipo.descripcion == "Admin"
 
+    @property
+    def descuento(self):
+        """Porcentaje de descuento del tipo de usuario"""
+        return self.usuarioTipo.descuento if self.usuarioTipo_id else 0
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['activo', '-id'], name='usuario_activo_id_idx'),
+        ]
+
 
 class Pedido(models.Model):
     ESTADO = [
@@ -40,6 +56,18 @@ class Pedido(models.Model):
         ("Cancelado", "cancelado"),
         ("Requiere Corrección", "requiere corrección")
     ]
+    # Movimientos permitidos desde cada estado (se validan en memoria, sin leer el pedido).
+    # PedidoAdmin.jsx solo ofrece estos destinos: mantener las dos tablas iguales.
+    TRANSICIONES = {
+        # Retirado directo: pedidos que se preparan y retiran en el mostrador
+        "Pendiente": {"En proceso", "Preparado", "Retirado", "Cancelado", "Requiere Corrección"},
+        "En proceso": {"Pendiente", "Preparado", "Retirado", "Cancelado", "Requiere Corrección"},
+        "Preparado": {"En proceso", "Retirado", "Cancelado"},
+        "Retirado": {"Preparado"},  # solo para deshacer un retiro marcado por error
+        "Cancelado": {"Pendiente"},
+        # A sí mismo: reenviar la corrección con un motivo actualizado
+        "Requiere Corrección": {"Pendiente", "Cancelado", "Requiere Corrección"},
+    }
     estado = models.CharField(max_length=100, choices=ESTADO, default="Pendiente")
     observacion = models.TextField(null=True, blank=True)
     motivo_correccion = models.TextField(null=True, blank=True)
@@ -48,10 +76,27 @@ class Pedido(models.Model):
     fk_usuario = models.ForeignKey(Usuario, on_delete=models.CASCADE)
     created_at = models.DateTimeField(auto_now_add=True, null=True, blank=True)
     updated_at = models.DateTimeField(auto_now=True, null=True, blank=True)
+    # Control de concurrencia optimista: cada cambio de estado la incrementa (ETag / If-Match)
+    version = models.PositiveIntegerField(default=1)
     
     def __str__(self):
         return f"Pedido #{self.id} - {self.fk_usuario.nombre}"
 
+    @classmethod
+    def origenes(cls, estado):
+        """Estados desde los que se puede pasar a `estado`"""
+        return [origen for origen, destinos in cls.TRANSICIONES.items() if estado in destinos]
+
+    class Meta:
+        # Índices para la paginación por cursor (ORDER BY id DESC) con los filtros del listado
+        indexes = [
+            models.Index(fields=['fk_usuario', '-id'], name='pedido_usuario_id_idx'),
+            models.Index(fields=['estado', '-id'], name='pedido_estado_id_idx'),
+            # Con filtro por fecha el cursor (ORDER BY id DESC) recorre la PK: la fecha
+            # de alta crece con el id. Este índice es para los reportes por rango.
+            models.Index(fields=['fecha'], name='pedido_fecha_idx'),
+        ]
+
 
 class PedidoEstadoHistorial(models.Model):
     """Registro de cada cambio de estado de un pedido."""
@@ -68,6 +113,41 @@ class PedidoEstadoHistorial(models.Model):
         return f"Pedido {self.fk_pedido_id} - {self.estado} ({self.fecha})"
 
 
+class NotificacionPendiente(models.Model):
+    """
+    Outbox de emails: se escribe en la misma transacción que el cambio de
+    estado y la envía el cluster de django-q2 (ver outbox.py).
+    """
+    TIPO = [
+        ("cambio_estado", "Cambio de estado"),
+        ("correccion", "Corrección requerida"),
+    ]
+    ESTADO = [
+        ("Pendiente", "pendiente"),
+        ("Enviada", "enviada"),
+        ("Fallida", "fallida"),
+    ]
+    fk_pedido = models.ForeignKey(Pedido, on_delete=models.CASCADE, related_name='notificaciones')
+    tipo = models.CharField(max_length=20, choices=TIPO, default="cambio_estado")
+    # Estado del pedido al momento del cambio: el email informa ese, aunque después cambie otra vez
+    estado_pedido = models.CharField(max_length=100, choices=Pedido.ESTADO)
+    motivo = models.TextField(null=True, blank=True)
+    estado = models.CharField(max_length=20, choices=ESTADO, default="Pendiente")
+    intentos = models.PositiveSmallIntegerField(default=0)
+    proximo_intento = models.DateTimeField(default=timezone.now)
+    ultimo_error = models.TextField(null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    enviada_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['estado', 'proximo_intento'], name='notif_pendiente_idx'),
+        ]
+
+    def __str__(self):
+        return f"Notificación {self.tipo} pedido {self.fk_pedido_id} ({self.estado})"
+
+
 class Producto(models.Model):
     nombre = models.CharField(max_length=100, null=False)
     descripcion = models.TextField(null=False)
@@ -111,6 +191,51 @@ class TipoImpresion(models.Model):
         verbose_name_plural = 'Tipos de Impresión'
 
 
+class ArchivoBlob(models.Model):
+    """
+    Contenido único de un archivo de impresión, identificado por su SHA-256.
+    Varias Impresion pueden apuntar al mismo objeto remoto; el objeto se borra
+    cuando la última deja de referenciarlo.
+    """
+    BACKEND = [
+        ("cloudinary", "Cloudinary"),
+        ("r2", "Cloudflare R2"),
+    ]
+    sha256 = models.CharField(max_length=64)
+    backend = models.CharField(max_length=10, choices=BACKEND)
+    ruta = models.CharField(max_length=500)  # path en Cloudinary o key en R2
+    url = models.CharField(max_length=300)
+    tamanio = models.BigIntegerField(default=0)
+    referencias = models.PositiveIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"{self.sha256[:12]} ({self.backend}, {self.referencias} ref.)"
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['sha256', 'backend'], name='blob_sha256_backend_unico'),
+        ]
+
+
+class ResultadoPreflight(models.Model):
+    """
+    Análisis de un archivo de impresión (preflight.py), cacheado por SHA-256:
+    el mismo contenido subido de nuevo no se vuelve a analizar.
+    """
+    sha256 = models.CharField(max_length=64, unique=True)
+    paginas = models.PositiveIntegerField(null=True, blank=True)
+    formato = models.CharField(max_length=4, null=True, blank=True)  # el más frecuente; 'otro' si no es A0-A6
+    formatos = models.JSONField(default=dict, blank=True)            # {"A4": 10, "A3": 2}
+    color = models.BooleanField(null=True, blank=True)
+    paginas_color = models.PositiveIntegerField(default=0)
+    error = models.TextField(null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"{self.sha256[:12]}: {self.paginas} págs. {self.formato}"
+
+
 class Impresion(models.Model):
     FORMATO = [
         ("A0", "A0 (841 × 1189 mm)"),
@@ -129,12 +254,136 @@ class Impresion(models.Model):
     cloudflare_key = models.CharField(max_length=500, null=True, blank=True)
     created_at = models.DateTimeField(auto_now_add=True, null=True, blank=True)
     updated_at = models.DateTimeField(auto_now=True, null=True, blank=True)
-    last_accessed = models.DateTimeField(auto_now=True, null=True, blank=True)
+    # Se actualiza con escrituras agrupadas (accesos.py), no en cada save()
+    last_accessed = models.DateTimeField(default=timezone.now, null=True, blank=True)
     fk_usuario = models.ForeignKey(Usuario, on_delete=models.CASCADE, null=True, blank=True)
+    fk_blob = models.ForeignKey(ArchivoBlob, on_delete=models.SET_NULL, null=True, blank=True)
+    # Contadas en el servidor al subir el archivo (pdf.py); null si no es un PDF legible
+    paginas = models.PositiveIntegerField(null=True, blank=True)
+    PREFLIGHT_ESTADO = [
+        ("Pendiente", "Pendiente"),
+        ("Aprobada", "Aprobada"),
+        ("Observada", "Observada"),   # el archivo no coincide con el formato/color elegido
+        ("Error", "Error"),
+    ]
+    preflight_estado = models.CharField(max_length=10, choices=PREFLIGHT_ESTADO, null=True, blank=True)
+    preflight_observaciones = models.JSONField(default=list, blank=True)
+    fk_preflight = models.ForeignKey(ResultadoPreflight, on_delete=models.SET_NULL, null=True, blank=True)
     
     def __str__(self):
         return f"{self.nombre_archivo} - {self.formato}"
 
+    class Meta:
+        # Índices para la paginación por cursor (ORDER BY id DESC) con los filtros del listado
+        indexes = [
+            models.Index(fields=['fk_usuario', '-id'], name='impresion_usuario_id_idx'),
+            # Uno por filtro: con (formato, color, id) filtrar solo por color no usaba el índice
+            models.Index(fields=['formato', '-id'], name='impresion_formato_id_idx'),
+            models.Index(fields=['color', '-id'], name='impresion_color_id_idx'),
+        ]
+
+
+class SesionSubida(models.Model):
+    """
+    Subida por partes (reanudable) de un archivo grande. Cada parte se sube
+    como parte de un multipart upload de R2; la Impresion se crea recién
+    cuando todas las partes están confirmadas.
+    """
+    ESTADO = [
+        ("Activa", "activa"),
+        ("Completada", "completada"),
+        ("Cancelada", "cancelada"),
+    ]
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    fk_usuario = models.ForeignKey(Usuario, on_delete=models.CASCADE)
+    nombre_archivo = models.CharField(max_length=255)
+    content_type = models.CharField(max_length=100, default='application/pdf')
+    tamanio = models.BigIntegerField()
+    bytes_parte = models.PositiveIntegerField()
+    formato = models.CharField(max_length=3, choices=Impresion.FORMATO, default="A4")
+    color = models.BooleanField(default=False)
+    cloudflare_key = models.CharField(max_length=500)
+    upload_id = models.CharField(max_length=500)
+    # {"1": {"etag": "...", "sha256": "...", "bytes": 8388608}, ...}
+    partes = models.JSONField(default=dict, blank=True)
+    estado = models.CharField(max_length=20, choices=ESTADO, default="Activa")
+    fk_impresion = models.ForeignKey(Impresion, on_delete=models.SET_NULL, null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"Subida {self.id} - {self.nombre_archivo} ({self.estado})"
+
+    @property
+    def cantidad_partes(self):
+        return max(1, -(-self.tamanio // self.bytes_parte))
+
+    def bytes_de_parte(self, numero):
+        """Tamaño esperado de la parte: todas iguales salvo la última"""
+        if numero < self.cantidad_partes:
+            return self.bytes_parte
+        return self.tamanio - self.bytes_parte * (self.cantidad_partes - 1)
+
+    @property
+    def offset(self):
+        """Bytes confirmados en forma contigua desde el inicio (desde dónde reanudar)"""
+        offset = 0
+        for numero in range(1, self.cantidad_partes + 1):
+            if str(numero) not in self.partes:
+                break
+            offset += self.partes[str(numero)]['bytes']
+        return offset
+
+    @property
+    def partes_faltantes(self):
+        return [n for n in range(1, self.cantidad_partes + 1) if str(n) not in self.partes]
+
+
+class LimpiezaAlmacenamiento(models.Model):
+    """
+    Trabajo de limpieza de impresiones sin uso (ver limpieza.py). Lo ejecuta el
+    cluster por lotes, una tarea por lote; ultimo_id es el punto de control para
+    retomar si se corta. Los objetos remotos a borrar quedan en pendientes hasta
+    que se confirma su borrado.
+    """
+    ESTADO = [
+        ("Pendiente", "pendiente"),
+        ("En curso", "en curso"),
+        ("Completada", "completada"),
+        ("Fallida", "fallida"),
+    ]
+    dias = models.PositiveIntegerField()
+    fecha_limite = models.DateTimeField()
+    estado = models.CharField(max_length=20, choices=ESTADO, default="Pendiente")
+    ultimo_id = models.BigIntegerField(default=0)
+    eliminadas = models.PositiveIntegerField(default=0)
+    fallidas = models.PositiveIntegerField(default=0)   # objetos remotos que todavía no se pudieron borrar
+    errores = models.JSONField(default=list, blank=True)
+    pendientes = models.JSONField(default=list, blank=True)   # [backend, ruta] de objetos remotos por borrar
+    reintentos = models.PositiveSmallIntegerField(default=0)  # vueltas sobre pendientes sin avance
+    paso = models.PositiveIntegerField(default=0)   # tareas que tomaron el trabajo (encadena los lotes)
+    fk_usuario = models.ForeignKey(Usuario, on_delete=models.SET_NULL, null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+    finalizada_at = models.DateTimeField(null=True, blank=True)
+
+    def __str__(self):
+        return f"Limpieza {self.id} ({self.estado}): {self.eliminadas} eliminadas"
+
+
+class TicketEventos(models.Model):
+    """
+    Ticket de un solo uso para abrir el stream SSE (eventos.py): EventSource no manda
+    headers y así el JWT no queda en los logs de acceso. Se guarda solo el hash.
+    """
+    clave = models.CharField(max_length=64, unique=True)   # SHA-256 del ticket
+    fk_usuario = models.ForeignKey(Usuario, on_delete=models.CASCADE)
+    expira = models.DateTimeField(db_index=True)
+    vence_stream = models.DateTimeField()   # vencimiento del access token con que se pidió
+
+    def __str__(self):
+        return f"Ticket de eventos de {self.fk_usuario_id} (expira {self.expira})"
+
 
 class PedidoImpresionDetalle(models.Model):
     subtotal = models.FloatField(null=False)
@@ -4,7 +4,10 @@ from django.core.mail import EmailMessage, get_connection
 from django.template.loader import render_to_string
 from django.conf import settings
 import logging
+import threading
+import time
 from datetime import datetime
+import smtplib
 import ssl
 
 # Configurar logger específico para notificaciones
@@ -27,6 +30,228 @@ except Exception as e:
     print(f"[ADVERTENCIA] No se pudo configurar el log de notificaciones: {e}")
 
 
+# --- Conexión compartida y envío por lotes ---
+# Cada proceso (worker de gunicorn o del qcluster) mantiene UNA conexión abierta
+# con el backend de email y la reutiliza: un lote de notificaciones viaja por el
+# mismo handshake SMTP/TLS en lugar de abrir uno por mensaje.
+
+_conexion = None
+_conexion_backend = None
+_conexion_ultimo_uso = 0.0
+_ultimo_envio = 0.0
+_lock_envio = threading.Lock()
+
+
+def _config():
+    return getattr(settings, 'NOTIFICACIONES', {})
+
+
+def obtener_conexion():
+    """Conexión abierta del proceso; se renueva si cambió el backend o estuvo ociosa demasiado tiempo"""
+    global _conexion, _conexion_backend, _conexion_ultimo_uso
+    max_idle = _config().get('CONEXION_MAX_IDLE', 60)
+    vencida = time.monotonic() - _conexion_ultimo_uso > max_idle
+    if _conexion is not None and (_conexion_backend != settings.EMAIL_BACKEND or vencida):
+        cerrar_conexion()
+    if _conexion is None:
+        _conexion = get_connection(fail_silently=False)
+        _conexion.open()
+        _conexion_backend = settings.EMAIL_BACKEND
+        logger.info(f"Conexión de email abierta ({settings.EMAIL_BACKEND})")
+    _conexion_ultimo_uso = time.monotonic()
+    return _conexion
+
+
+def cerrar_conexion():
+    global _conexion
+    if _conexion is not None:
+        try:
+            _conexion.close()
+        except Exception:
+            pass
+        _conexion = None
+
+
+def _esperar_turno():
+    """Respeta el máximo de envíos por segundo del proceso (ENVIOS_POR_SEGUNDO)"""
+    global _ultimo_envio
+    por_segundo = _config().get('ENVIOS_POR_SEGUNDO', 0)
+    if por_segundo:
+        espera = _ultimo_envio + 1.0 / por_segundo - time.monotonic()
+        if espera > 0:
+            time.sleep(espera)
+    _ultimo_envio = time.monotonic()
+
+
+def _conexion_lista():
+    """
+    Conexión del proceso comprobada con un NOOP (solo SMTP): si el servidor cerró
+    la conexión ociosa se detecta acá, antes de mandar nada.
+    """
+    conexion = obtener_conexion()
+    smtp = getattr(conexion, 'connection', None)
+    if smtp is not None and hasattr(smtp, 'noop'):
+        smtp.noop()
+    return conexion
+
+
+def _enviar_uno(mensaje):
+    try:
+        conexion = _conexion_lista()
+    except (smtplib.SMTPServerDisconnected, smtplib.SMTPConnectError, ConnectionError) as e:
+        # Falla al establecer la conexión: todavía no se mandó nada, se reintenta una vez
+        logger.warning(f"Reabriendo la conexión de email antes de enviar a {mensaje.to}: {e}")
+        cerrar_conexion()
+        conexion = _conexion_lista()
+    # Sin reintento después de mandar: un error en la respuesta (ej: timeout tras el DATA)
+    # puede ser un mail ya aceptado. Lo reintenta el outbox, que registra el resultado
+    return conexion.send_messages([mensaje]) == 1
+
+
+def enviar_lote(mensajes, al_enviar=None):
+    """
+    Envía una lista de EmailMessage por la conexión compartida, en tandas de
+    NOTIFICACIONES['LOTE'] y respetando ENVIOS_POR_SEGUNDO.
+    Devuelve una lista de (enviado: bool, error: str | None) alineada con `mensajes`.
+    al_enviar(indice, enviado, error) se llama apenas vuelve cada envío.
+    """
+    resultados = []
+    tamanio_lote = _config().get('LOTE', 50)
+    with _lock_envio:
+        for inicio in range(0, len(mensajes), tamanio_lote):
+            tanda = mensajes[inicio:inicio + tamanio_lote]
+            enviados = 0
+            for mensaje in tanda:
+                _esperar_turno()
+                try:
+                    ok = _enviar_uno(mensaje)
+                    resultados.append((ok, None if ok else 'El backend no confirmó el envío'))
+                except Exception as e:
+                    cerrar_conexion()
+                    resultados.append((False, str(e)))
+                    ok = False
+                if al_enviar is not None:
+                    al_enviar(len(resultados) - 1, *resultados[-1])
+                enviados += ok
+            logger.info(f"Lote de emails: {enviados}/{len(tanda)} enviados por {settings.EMAIL_BACKEND}")
+            print(f"[EMAIL] Lote: {enviados}/{len(tanda)} enviados")
+    return resultados
+
+
+# --- Armado de los mensajes ---
+
+def _destinatario(pedido):
+    usuario = pedido.fk_usuario
+    if not usuario:
+        logger.warning(f"Pedido #{pedido.id} no tiene usuario asociado")
+        print(f"[EMAIL] ⚠️ Pedido #{pedido.id} no tiene usuario asociado")
+        return None
+    if not usuario.email:
+        logger.warning(f"Pedido #{pedido.id} - Usuario {usuario.id} no tiene email")
+        print(f"[EMAIL] ⚠️ Pedido #{pedido.id} no tiene email de usuario")
+        return None
+    return usuario
+
+
+def _email_html(asunto, html_content, destinatario):
+    email = EmailMessage(
+        subject=asunto,
+        body=html_content,
+        from_email=settings.DEFAULT_FROM_EMAIL,
+        to=[destinatario]
+    )
+    email.content_subtype = 'html'
+    return email
+
+
+def construir_email_cambio_estado(pedido):
+    """EmailMessage del cambio de estado, o None si el pedido no tiene a quién avisar"""
+    usuario = _destinatario(pedido)
+    if usuario is None:
+        return None
+
+    # Preparar contexto para el template
+    contexto = {
+        'pedido_id': pedido.id,
+        'estado': pedido.estado,
+        'usuario_nombre': usuario.nombre,
+        'total': pedido.total,
+        'fecha': pedido.fecha,
+    }
+    try:
+        html_content = render_to_string('emails/cambio_estado_pedido.html', contexto)
+    except Exception as template_error:
+        logger.error(f"Error al renderizar template: {template_error}")
+        # Si la template falla, usar un email simple
+        html_content = f"""
+        <html>
+        <body style="font-family: Arial; padding: 20px;">
+            <h2>Actualización de tu Pedido #{pedido.id}</h2>
+            <p>Hola {usuario.nombre},</p>
+            <p>Tu pedido ha sido actualizado al estado: <strong>{pedido.estado}</strong></p>
+            <p>Total: ${pedido.total}</p>
+            <p>Gracias por elegirnos.</p>
+        </body>
+        </html>
+        """
+    return _email_html(f"📦 Actualización de tu Pedido #{pedido.id} - {pedido.estado}",
+                       html_content, usuario.email)
+
+
+def construir_email_correccion(pedido, motivo):
+    """EmailMessage de pedido que requiere corrección, o None si no hay destinatario"""
+    usuario = _destinatario(pedido)
+    if usuario is None:
+        return None
+
+    contexto = {
+        'pedido_id': pedido.id,
+        'usuario_nombre': usuario.nombre,
+        'motivo': motivo,
+        'total': pedido.total,
+    }
+    try:
+        html_content = render_to_string('emails/pedido_requiere_correccion.html', contexto)
+    except Exception as template_error:
+        logger.error(f"Error al renderizar template de corrección: {template_error}")
+        # Si la template falla, usar un email simple
+        html_content = f"""
+        <html>
+        <body style="font-family: Arial; padding: 20px;">
+            <h2>⚠️ Tu Pedido Requiere Corrección</h2>
+            <p>Hola {usuario.nombre},</p>
+            <p>Tu pedido <strong>#{pedido.id}</strong> requiere corrección:</p>
+            <p><strong>Motivo:</strong></p>
+            <p>{motivo}</p>
+            <p>Por favor, contacta con nosotros o vuelve a cargar los archivos corregidos.</p>
+        </body>
+        </html>
+        """
+    return _email_html(f"⚠️ Tu Pedido #{pedido.id} Requiere Corrección", html_content, usuario.email)
+
+
+# --- Envío individual (compatibilidad) ---
+
+def _enviar(pedido, email, descripcion):
+    if email is None:
+        return False
+    try:
+        enviado, error = enviar_lote([email])[0]
+    except Exception as e:
+        # Si falla, logueamos el error completo pero NO lo propagamos
+        import traceback
+        logger.error(f"❌ Error al enviar email {descripcion} para pedido #{pedido.id}: {e}\n{traceback.format_exc()}")
+        print(f"[EMAIL] ❌ Error al enviar email {descripcion} para pedido #{pedido.id}: {e}")
+        return False
+    if enviado:
+        logger.info(f"✅ Email {descripcion} enviado a {email.to[0]} para pedido #{pedido.id}")
+        print(f"[EMAIL] ✅ Email {descripcion} enviado a {email.to[0]} para pedido #{pedido.id}")
+    else:
+        logger.warning(f"⚠️ Email {descripcion} para pedido #{pedido.id} no enviado: {error}")
+        print(f"[EMAIL] ⚠️ No se pudo enviar el email {descripcion}: {error}")
+    return enviado
+
+
 def enviar_notificacion_cambio_estado(pedido):
     """
     Envía un email al cliente cuando cambia el estado de su pedido.
@@ -38,91 +263,7 @@ def enviar_notificacion_cambio_estado(pedido):
     Returns:
         bool: True si el email se envió correctamente, False si falló
     """
-    try:
-        print(f"\n[EMAIL] Iniciando envío de notificación para pedido #{pedido.id}")
-        logger.info(f"Iniciando envío de notificación para pedido #{pedido.id}")
-        
-        # Obtener email del usuario
-        usuario = pedido.fk_usuario
-        if not usuario:
-            logger.warning(f"Pedido #{pedido.id} no tiene usuario asociado")
-            print(f"[EMAIL] ⚠️ Pedido #{pedido.id} no tiene usuario asociado")
-            return False
-            
-        if not usuario.email:
-            logger.warning(f"Pedido #{pedido.id} - Usuario {usuario.id} no tiene email")
-            print(f"[EMAIL] ⚠️ Pedido #{pedido.id} no tiene email de usuario")
-            return False
-        
-        print(f"[EMAIL] Usuario encontrado: {usuario.email}")
-        logger.info(f"Preparando email para {usuario.email}")
-        
-        # Preparar contexto para el template
-        contexto = {
-            'pedido_id': pedido.id,
-            'estado': pedido.estado,
-            'usuario_nombre': usuario.nombre,
-            'total': pedido.total,
-            'fecha': pedido.fecha,
-        }
-        
-        # Generar HTML del email con mejor manejo de errores
-        try:
-            html_content = render_to_string('emails/cambio_estado_pedido.html', contexto)
-            print(f"[EMAIL] Template renderizado exitosamente")
-            logger.info(f"Template renderizado exitosamente")
-        except Exception as template_error:
-            print(f"[EMAIL] ❌ Error al renderizar template: {template_error}")
-            logger.error(f"Error al renderizar template: {template_error}")
-            # Si la template falla, usar un email simple
-            html_content = f"""
-            <html>
-            <body style="font-family: Arial; padding: 20px;">
-                <h2>Actualización de tu Pedido #{pedido.id}</h2>
-                <p>Hola {usuario.nombre},</p>
-                <p>Tu pedido ha sido actualizado al estado: <strong>{pedido.estado}</strong></p>
-                <p>Total: ${pedido.total}</p>
-                <p>Gracias por elegirnos.</p>
-            </body>
-            </html>
-            """
-            print(f"[EMAIL] Usando template fallback")
-        
-        # Usar Django EmailMessage que manejará SendGrid o SMTP según la configuración
-        from django.core.mail import EmailMessage
-        
-        print(f"[EMAIL] Backend configurado: {settings.EMAIL_BACKEND}")
-        logger.info(f"Enviando email a {usuario.email} usando {settings.EMAIL_BACKEND}...")
-        
-        email = EmailMessage(
-            subject=f"📦 Actualización de tu Pedido #{pedido.id} - {pedido.estado}",
-            body=html_content,
-            from_email=settings.DEFAULT_FROM_EMAIL,
-            to=[usuario.email]
-        )
-        email.content_subtype = 'html'
-        
-        # Enviar con timeout
-        resultado = email.send(fail_silently=False)
-        
-        if resultado:
-            logger.info(f"✅ Email enviado exitosamente a {usuario.email} para pedido #{pedido.id}")
-            print(f"[EMAIL] ✅ Email enviado exitosamente a {usuario.email} para pedido #{pedido.id}\n")
-            return True
-        else:
-            logger.warning(f"⚠️ Email.send() retornó 0")
-            print(f"[EMAIL] ⚠️ No se pudo confirmar envío\n")
-            return False
-        
-    except Exception as e:
-        # Si falla, logueamos el error completo pero NO lo propagamos
-        import traceback
-        error_detail = traceback.format_exc()
-        logger.error(f"❌ Error al enviar email para pedido #{pedido.id}: {str(e)}\n{error_detail}")
-        print(f"[EMAIL] ❌ Error al enviar email para pedido #{pedido.id}:")
-        print(f"[EMAIL] {str(e)}")
-        print(f"[EMAIL] Traceback: {error_detail}\n")
-        return False
+    return _enviar(pedido, construir_email_cambio_estado(pedido), 'de cambio de estado')
 
 
 def enviar_notificacion_correccion_requerida(pedido, motivo):
@@ -137,84 +278,4 @@ def enviar_notificacion_correccion_requerida(pedido, motivo):
     Returns:
         bool: True si el email se envió correctamente, False si falló
     """
-    try:
-        print(f"\n[EMAIL] Iniciando envío de notificación de corrección para pedido #{pedido.id}")
-        logger.info(f"Iniciando envío de notificación de corrección para pedido #{pedido.id}")
-        
-        usuario = pedido.fk_usuario
-        if not usuario:
-            logger.warning(f"Pedido #{pedido.id} no tiene usuario asociado")
-            print(f"[EMAIL] ⚠️ Pedido #{pedido.id} no tiene usuario asociado")
-            return False
-            
-        if not usuario.email:
-            logger.warning(f"Pedido #{pedido.id} - Usuario {usuario.id} no tiene email")
-            print(f"[EMAIL] ⚠️ Pedido #{pedido.id} no tiene email de usuario")
-            return False
-        
-        print(f"[EMAIL] Usuario encontrado: {usuario.email}")
-        logger.info(f"Preparando email de corrección para {usuario.email}")
-        
-        contexto = {
-            'pedido_id': pedido.id,
-            'usuario_nombre': usuario.nombre,
-            'motivo': motivo,
-            'total': pedido.total,
-        }
-        
-        try:
-            html_content = render_to_string('emails/pedido_requiere_correccion.html', contexto)
-            print(f"[EMAIL] Template de corrección renderizado exitosamente")
-            logger.info(f"Template de corrección renderizado exitosamente")
-        except Exception as template_error:
-            print(f"[EMAIL] ❌ Error al renderizar template: {template_error}")
-            logger.error(f"Error al renderizar template de corrección: {template_error}")
-            # Si la template falla, usar un email simple
-            html_content = f"""
-            <html>
-            <body style="font-family: Arial; padding: 20px;">
-                <h2>⚠️ Tu Pedido Requiere Corrección</h2>
-                <p>Hola {usuario.nombre},</p>
-                <p>Tu pedido <strong>#{pedido.id}</strong> requiere corrección:</p>
-                <p><strong>Motivo:</strong></p>
-                <p>{motivo}</p>
-                <p>Por favor, contacta con nosotros o vuelve a cargar los archivos corregidos.</p>
-            </body>
-            </html>
-            """
-            print(f"[EMAIL] Usando template fallback para corrección")
-        
-        # Usar Django EmailMessage que manejará SendGrid o SMTP según la configuración
-        from django.core.mail import EmailMessage
-        
-        print(f"[EMAIL] Backend configurado: {settings.EMAIL_BACKEND}")
-        logger.info(f"Enviando email de corrección a {usuario.email} usando {settings.EMAIL_BACKEND}...")
-        
-        email = EmailMessage(
-            subject=f"⚠️ Tu Pedido #{pedido.id} Requiere Corrección",
-            body=html_content,
-            from_email=settings.DEFAULT_FROM_EMAIL,
-            to=[usuario.email]
-        )
-        email.content_subtype = 'html'
-        
-        # Enviar
-        resultado = email.send(fail_silently=False)
-        
-        if resultado:
-            logger.info(f"✅ Email de corrección enviado a {usuario.email} para pedido #{pedido.id}")
-            print(f"[EMAIL] ✅ Email de corrección enviado exitosamente a {usuario.email} para pedido #{pedido.id}\n")
-            return True
-        else:
-            logger.warning(f"⚠️ Email.send() retornó 0")
-            print(f"[EMAIL] ⚠️ No se pudo confirmar envío\n")
-            return False
-        
-    except Exception as e:
-        import traceback
-        error_detail = traceback.format_exc()
-        logger.error(f"❌ Error al enviar email de corrección para pedido #{pedido.id}: {str(e)}\n{error_detail}")
-        print(f"[EMAIL] ❌ Error al enviar email de corrección para pedido #{pedido.id}:")
-        print(f"[EMAIL] {str(e)}")
-        print(f"[EMAIL] Traceback: {error_detail}\n")
-        return False
+    return _enviar(pedido, construir_email_correccion(pedido, motivo), 'de corrección')
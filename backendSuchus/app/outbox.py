@@ -0,0 +1,164 @@
+# outbox.py
+# Notificaciones por email vía outbox: el cambio de estado solo escribe una fila
+# en NotificacionPendiente y el cluster de django-q2 hace el envío con reintentos.
+import logging
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+from django_q.models import Schedule
+from django_q.tasks import async_task, schedule
+
+from .models import NotificacionPendiente
+from .notifications import construir_email_cambio_estado, construir_email_correccion, enviar_lote
+
+logger = logging.getLogger('notificaciones')
+
+MARGEN_TAREA = 20   # segundos de holgura respecto de Q_CLUSTER['timeout']
+
+
+def encolar_notificacion(pedido, tipo='cambio_estado', motivo=None):
+    """
+    Registra la notificación del cambio de estado. Debe llamarse dentro de la
+    transacción del cambio: si se revierte, la notificación tampoco existe.
+    Se envía al cluster recién cuando la transacción confirma.
+    """
+    notificacion = NotificacionPendiente.objects.create(
+        fk_pedido=pedido,
+        tipo=tipo,
+        estado_pedido=pedido.estado,
+        motivo=motivo,
+    )
+    transaction.on_commit(lambda: despachar([notificacion.id]))
+    return notificacion
+
+
+def encolar_notificaciones(pedido_ids, estado_pedido, tipo='cambio_estado', motivo=None):
+    """
+    Versión en lote de encolar_notificacion para cambios masivos: un bulk_create
+    y una sola tarea del cluster para todas, que las envía por la misma conexión.
+    """
+    notificaciones = NotificacionPendiente.objects.bulk_create([
+        NotificacionPendiente(fk_pedido_id=pedido_id, tipo=tipo, estado_pedido=estado_pedido, motivo=motivo)
+        for pedido_id in pedido_ids
+    ])
+    ids = [notificacion.id for notificacion in notificaciones]
+    if ids:
+        transaction.on_commit(lambda: despachar(ids))
+    return notificaciones
+
+
+def por_tarea():
+    """Notificaciones que una tarea alcanza a enviar dentro de Q_CLUSTER['timeout'] a ENVIOS_POR_SEGUNDO"""
+    segundos = settings.Q_CLUSTER['timeout'] - MARGEN_TAREA
+    return max(1, int(settings.NOTIFICACIONES['ENVIOS_POR_SEGUNDO'] * segundos))
+
+
+def despachar(ids):
+    """
+    Manda las notificaciones al cluster en tareas de por_tarea(). Si la cola no
+    responde quedan pendientes para el barrido.
+    """
+    tamanio = por_tarea()
+    for inicio in range(0, len(ids), tamanio):
+        tanda = ids[inicio:inicio + tamanio]
+        try:
+            async_task('app.outbox.procesar_notificaciones', tanda, task_name=f"notificaciones-{tanda[0]}")
+        except Exception as e:
+            logger.error(f"No se pudieron encolar las notificaciones {tanda}: {e}")
+
+
+def backoff(intentos):
+    config = settings.NOTIFICACIONES
+    return min(config['BACKOFF_BASE'] * 2 ** (intentos - 1), config['BACKOFF_MAX'])
+
+
+def reservar(notificacion_id):
+    """
+    Toma la notificación corriendo su próximo intento LEASE segundos: si dos
+    workers la levantan a la vez, solo uno la envía. Si el worker muere, vuelve
+    a estar disponible cuando vence la reserva.
+    """
+    ahora = timezone.now()
+    return NotificacionPendiente.objects.filter(
+        id=notificacion_id, estado='Pendiente', proximo_intento__lte=ahora
+    ).update(proximo_intento=ahora + timedelta(seconds=settings.NOTIFICACIONES['LEASE'])) == 1
+
+
+def construir(notificacion):
+    """EmailMessage de la notificación con el estado que la originó (None si no hay destinatario)"""
+    pedido = notificacion.fk_pedido
+    pedido.estado = notificacion.estado_pedido
+    if notificacion.tipo == 'correccion':
+        return construir_email_correccion(pedido, notificacion.motivo)
+    return construir_email_cambio_estado(pedido)
+
+
+def registrar_resultado(notificacion, enviado, error=None):
+    notificacion.intentos += 1
+    if enviado:
+        notificacion.estado = 'Enviada'
+        notificacion.enviada_at = timezone.now()
+        notificacion.ultimo_error = None
+    elif notificacion.intentos >= settings.NOTIFICACIONES['MAX_INTENTOS']:
+        notificacion.estado = 'Fallida'
+        notificacion.ultimo_error = error or 'Se agotaron los reintentos (ver logs/notificaciones.log)'
+    else:
+        notificacion.proximo_intento = timezone.now() + timedelta(seconds=backoff(notificacion.intentos))
+        notificacion.ultimo_error = error or 'El backend de email no confirmó el envío'
+    notificacion.save(update_fields=['estado', 'intentos', 'proximo_intento', 'ultimo_error', 'enviada_at'])
+
+
+def procesar_notificaciones(ids):
+    """
+    Tarea del cluster: arma los emails de las notificaciones indicadas, los manda
+    en lote por la conexión compartida del worker y agenda el reintento de las
+    que fallen. Cada resultado se guarda apenas vuelve su envío: si el worker
+    muere a mitad del lote, las ya enviadas no se repiten. Devuelve cuántas se enviaron.
+    """
+    # Nunca más de lo que entra en el timeout; el resto queda para el barrido
+    pendientes = (NotificacionPendiente.objects
+                  .filter(id__in=list(ids)[:por_tarea()], estado='Pendiente')
+                  .select_related('fk_pedido__fk_usuario'))
+    a_enviar = []
+    for notificacion in pendientes:
+        if not reservar(notificacion.id):
+            continue
+        mensaje = construir(notificacion)
+        if mensaje is None:
+            # Sin destinatario no tiene sentido reintentar
+            notificacion.estado = 'Fallida'
+            notificacion.ultimo_error = 'El pedido no tiene un usuario con email'
+            notificacion.save(update_fields=['estado', 'ultimo_error'])
+            continue
+        a_enviar.append((notificacion, mensaje))
+
+    enviadas = 0
+
+    def al_enviar(indice, enviado, error):
+        nonlocal enviadas
+        notificacion = a_enviar[indice][0]
+        registrar_resultado(notificacion, enviado, error)
+        if enviado:
+            enviadas += 1
+        elif notificacion.estado == 'Pendiente':
+            schedule('app.outbox.procesar_notificaciones', [notificacion.id],
+                     name=f"reintento-notificacion-{notificacion.id}-{notificacion.intentos}",
+                     schedule_type=Schedule.ONCE, next_run=notificacion.proximo_intento)
+
+    if a_enviar:
+        enviar_lote([mensaje for _, mensaje in a_enviar], al_enviar)
+    logger.info(f"Outbox: {enviadas}/{len(a_enviar)} notificaciones enviadas")
+    return enviadas
+
+
+def reintentar_pendientes():
+    """
+    Barrido de respaldo (agendado cada 5 minutos por la migración 0028): reenvía
+    las pendientes vencidas, por ejemplo si el broker estaba caído al confirmar.
+    """
+    ids = list(NotificacionPendiente.objects
+               .filter(estado='Pendiente', proximo_intento__lte=timezone.now())
+               .values_list('id', flat=True)[:por_tarea()])
+    return procesar_notificaciones(ids) if ids else 0
@@ -0,0 +1,36 @@
+from rest_framework.pagination import CursorPagination
+
+
+class CursorPorIdPagination(CursorPagination):
+    """
+    Paginación por cursor (keyset): cada página es un WHERE id < ? ORDER BY id DESC,
+    sin OFFSET ni COUNT(*). En impresiones equivale a ordenar por -created_at
+    porque el id crece junto con la fecha de alta (que además admite NULL).
+    """
+    ordering = '-id'
+    page_size = 100
+    page_size_query_param = 'page_size'
+    max_page_size = 500
+
+
+class CursorOpcionalMixin:
+    """
+    Permite pedir paginación por cursor con ?paginacion=cursor (o enviando un
+    ?cursor=... de una respuesta anterior). Sin esos parámetros se mantiene la
+    paginación por número de página de REST_FRAMEWORK.
+    Los filtros de la query string se conservan en los links next/previous.
+    """
+    cursor_pagination_class = CursorPorIdPagination
+
+    def usa_cursor(self):
+        params = self.request.query_params
+        return params.get('paginacion') == 'cursor' or 'cursor' in params
+
+    @property
+    def paginator(self):
+        if not hasattr(self, '_paginator'):
+            if self.request is not None and self.usa_cursor():
+                self._paginator = self.cursor_pagination_class()
+            else:
+                return super().paginator
+        return self._paginator
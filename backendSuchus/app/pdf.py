@@ -0,0 +1,509 @@
+# pdf.py
+# Conteo de páginas de PDFs sin cargarlos en memoria: se leen la cola del archivo,
+# la tabla de referencias cruzadas (xref) y unos pocos objetos (catálogo y raíz del
+# árbol de páginas, que tiene /Count). Funciona con cualquier file-like con seek:
+# un UploadedFile o un objeto de R2 leído por rangos (almacenamiento.ObjetoRemoto).
+import re
+import zlib
+
+BLOQUE = 64 * 1024
+MAX_OBJETO = 8 * 1024 * 1024    # tope al leer un objeto suelto (ej: /Kids con miles de páginas)
+MAX_STREAM = 32 * 1024 * 1024   # tope al descomprimir xref streams y object streams
+
+RE_STARTXREF = re.compile(rb'startxref\s+(\d+)')
+RE_CABECERA_OBJ = re.compile(rb'\s*(\d+)\s+(\d+)\s+obj')
+RE_SUBSECCION = re.compile(rb'\s*(\d+)\s+(\d+)[ \t]*\r?\n?')
+RE_PAGINA = re.compile(rb'/Type\s{0,8}/Page(?![A-Za-z])')
+_NUM = rb'([-+]?(?:\d+\.?\d*|\.\d+))'
+RE_NUMERO = re.compile(_NUM)
+RE_COLOR_RGB = re.compile(_NUM + rb'\s+' + _NUM + rb'\s+' + _NUM + rb'\s+(?:rg|RG|sc|scn|SC|SCN)\b')
+RE_COLOR_CMYK = re.compile(_NUM + rb'\s+' + _NUM + rb'\s+' + _NUM + rb'\s+' + _NUM + rb'\s+(?:k|K|sc|scn|SC|SCN)\b')
+RE_IMAGEN_EN_LINEA_COLOR = re.compile(rb'/(?:CS|ColorSpace)\s*/(?:RGB|CMYK|DeviceRGB|DeviceCMYK)\b')
+RE_FILTRO_JPEG = re.compile(rb'/(?:DCTDecode|DCT|JPXDecode)\b')
+
+
+class PDFInvalido(ValueError):
+    """La estructura del PDF no se pudo leer (se recurre al escaneo)"""
+
+
+def referencia(texto, clave):
+    m = re.search(rb'/' + clave + rb'\s+(\d+)\s+\d+\s+R', texto)
+    return int(m.group(1)) if m else None
+
+
+def entero(texto, clave):
+    m = re.search(rb'/' + clave + rb'\s+(\d+)\b(?!\s+\d+\s+R)', texto)
+    return int(m.group(1)) if m else None
+
+
+def arreglo(texto, clave):
+    m = re.search(rb'/' + clave + rb'\s*\[([\d\s]*)\]', texto)
+    return [int(n) for n in m.group(1).split()] if m else None
+
+
+class _Seccion:
+    """Una sección de la xref (tabla clásica o xref stream)"""
+
+    def __init__(self, subsecciones, buscar):
+        self.subsecciones = subsecciones   # [(primer objeto, cantidad, posición)]
+        self._buscar = buscar
+
+    def buscar(self, numero):
+        for primero, cantidad, posicion in self.subsecciones:
+            if primero <= numero < primero + cantidad:
+                return self._buscar(posicion, numero - primero)
+        return None
+
+
+class _LectorPDF:
+
+    def __init__(self, archivo):
+        self.archivo = archivo
+        archivo.seek(0, 2)
+        self.tamanio = archivo.tell()
+        self.secciones = []       # la más nueva primero (actualizaciones incrementales)
+        self.raiz = None
+        self._object_streams = {}
+
+    def leer(self, offset, cantidad):
+        self.archivo.seek(offset)
+        return self.archivo.read(cantidad)
+
+    # --- xref ---
+
+    def cargar_xref(self):
+        cola = self.leer(max(0, self.tamanio - 2048), 2048)
+        offsets = RE_STARTXREF.findall(cola)
+        if not offsets:
+            raise PDFInvalido('No se encontró startxref')
+        pendientes, vistos = [int(offsets[-1])], set()
+        while pendientes:
+            offset = pendientes.pop(0)
+            if offset in vistos or offset >= self.tamanio:
+                continue
+            vistos.add(offset)
+            if self.leer(offset, 32).lstrip().startswith(b'xref'):
+                seccion, trailer = self.tabla_clasica(offset)
+            else:
+                seccion, trailer = self.xref_stream(offset)
+            self.secciones.append(seccion)
+            if self.raiz is None:
+                self.raiz = referencia(trailer, b'Root')
+            # Archivos híbridos: /XRefStm se consulta antes que /Prev
+            for clave in (b'XRefStm', b'Prev'):
+                siguiente = entero(trailer, clave)
+                if siguiente is not None:
+                    pendientes.append(siguiente)
+        if self.raiz is None:
+            raise PDFInvalido('El trailer no tiene /Root')
+
+    def tabla_clasica(self, offset):
+        """
+        No carga las entradas: guarda dónde empieza cada subsección y lee los 20
+        bytes de una entrada recién cuando se la busca.
+        """
+        inicio = self.leer(offset, 64)
+        posicion = offset + inicio.index(b'xref') + 4
+        subsecciones = []
+        ancho = 20
+        while True:
+            linea = self.leer(posicion, 64)
+            if linea.lstrip().startswith(b'trailer'):
+                break
+            m = RE_SUBSECCION.match(linea)
+            if not m:
+                raise PDFInvalido(f'Subsección de xref inválida en {posicion}')
+            primero, cantidad = int(m.group(1)), int(m.group(2))
+            posicion += m.end()
+            if cantidad:
+                # Las entradas miden 20 bytes ("nnnnnnnnnn ggggg n\r\n"); algunos generadores usan 19
+                entrada = self.leer(posicion, 20)
+                ancho = 20 if entrada[19:20] in (b'\n', b'\r', b' ') else 19
+                subsecciones.append((primero, cantidad, posicion))
+            posicion += cantidad * ancho
+
+        trailer = self.leer(posicion, BLOQUE)
+        trailer = trailer.split(b'startxref')[0]
+
+        def buscar(posicion_subseccion, indice):
+            entrada = self.leer(posicion_subseccion + indice * ancho, ancho).split()
+            if len(entrada) < 3:
+                return None
+            if entrada[2] == b'n':
+                return 1, int(entrada[0]), int(entrada[1])
+            return 0, 0, 0
+
+        return _Seccion(subsecciones, buscar), trailer
+
+    def xref_stream(self, offset):
+        diccionario, datos = self.objeto_con_stream(offset)
+        if b'/XRef' not in diccionario:
+            raise PDFInvalido(f'No hay una xref en {offset}')
+        anchos = arreglo(diccionario, b'W')
+        indices = arreglo(diccionario, b'Index') or [0, entero(diccionario, b'Size') or 0]
+        if not anchos or len(anchos) != 3:
+            raise PDFInvalido('xref stream sin /W')
+        largo_fila = sum(anchos)
+
+        subsecciones, fila = [], 0
+        for primero, cantidad in zip(indices[::2], indices[1::2]):
+            subsecciones.append((primero, cantidad, fila))
+            fila += cantidad
+
+        def campo(fila_bytes, desde, ancho, defecto):
+            return int.from_bytes(fila_bytes[desde:desde + ancho], 'big') if ancho else defecto
+
+        def buscar(fila_subseccion, indice):
+            inicio = (fila_subseccion + indice) * largo_fila
+            fila_bytes = datos[inicio:inicio + largo_fila]
+            if len(fila_bytes) < largo_fila:
+                return None
+            tipo = campo(fila_bytes, 0, anchos[0], 1)
+            return (tipo,
+                    campo(fila_bytes, anchos[0], anchos[1], 0),
+                    campo(fila_bytes, anchos[0] + anchos[1], anchos[2], 0))
+
+        return _Seccion(subsecciones, buscar), diccionario
+
+    # --- objetos ---
+
+    def objeto_en(self, offset):
+        """(texto del objeto hasta 'stream' o 'endobj', offset del stream o None)"""
+        datos = b''
+        while len(datos) < MAX_OBJETO:
+            bloque = self.leer(offset + len(datos), BLOQUE)
+            if not bloque:
+                break
+            datos += bloque
+            fin = re.search(rb'endobj|stream\r?\n', datos)
+            if fin:
+                if not RE_CABECERA_OBJ.match(datos):
+                    raise PDFInvalido(f'No hay un objeto en {offset}')
+                if fin.group(0).startswith(b'stream'):
+                    return datos[:fin.start()], offset + fin.end()
+                return datos[:fin.start()], None
+        raise PDFInvalido(f'Objeto sin cierre en {offset}')
+
+    def objeto_con_stream(self, offset):
+        diccionario, inicio_stream = self.objeto_en(offset)
+        if inicio_stream is None:
+            raise PDFInvalido(f'El objeto en {offset} no tiene stream')
+        largo = entero(diccionario, b'Length')
+        if largo is None:
+            ref = referencia(diccionario, b'Length')
+            if ref is None:
+                raise PDFInvalido('Stream sin /Length')
+            largo = int(self.objeto(ref).split(b'obj', 1)[-1].split()[0])
+        if largo > MAX_STREAM:
+            raise PDFInvalido('Stream demasiado grande')
+        return diccionario, decodificar(diccionario, self.leer(inicio_stream, largo))
+
+    def objeto(self, numero):
+        for seccion in self.secciones:
+            entrada = seccion.buscar(numero)
+            if entrada is None or entrada[0] == 0:
+                continue
+            tipo, a, b = entrada
+            if tipo == 1:
+                return self.objeto_en(a)[0]
+            if tipo == 2:
+                return self.objeto_comprimido(a, numero)
+        raise PDFInvalido(f'No se encontró el objeto {numero}')
+
+    def objeto_comprimido(self, numero_stream, numero):
+        """Objeto guardado dentro de un object stream (PDF 1.5+)"""
+        if numero_stream not in self._object_streams:
+            if len(self._object_streams) >= 4:
+                self._object_streams.clear()
+            diccionario, datos = self.objeto_con_stream_numero(numero_stream)
+            primero = entero(diccionario, b'First') or 0
+            cabecera = [int(n) for n in datos[:primero].split()]
+            offsets = dict(zip(cabecera[::2], cabecera[1::2]))
+            self._object_streams[numero_stream] = (datos, primero, offsets, sorted(offsets.values()))
+        datos, primero, offsets, ordenados = self._object_streams[numero_stream]
+        if numero not in offsets:
+            raise PDFInvalido(f'El objeto {numero} no está en el object stream {numero_stream}')
+        inicio = offsets[numero]
+        siguientes = [o for o in ordenados if o > inicio]
+        fin = primero + siguientes[0] if siguientes else len(datos)
+        return datos[primero + inicio:fin]
+
+    def objeto_con_stream_numero(self, numero):
+        for seccion in self.secciones:
+            entrada = seccion.buscar(numero)
+            if entrada is not None and entrada[0] == 1:
+                return self.objeto_con_stream(entrada[1])
+        raise PDFInvalido(f'No se encontró el object stream {numero}')
+
+    def paginas(self):
+        self.cargar_xref()
+        catalogo = self.objeto(self.raiz)
+        raiz_paginas = referencia(catalogo, b'Pages')
+        if raiz_paginas is None:
+            raise PDFInvalido('El catálogo no tiene /Pages')
+        cantidad = entero(self.objeto(raiz_paginas), b'Count')
+        if cantidad is None:
+            raise PDFInvalido('El árbol de páginas no tiene /Count')
+        return cantidad
+
+    # --- recorrido de páginas (preflight) ---
+
+    def valor(self, texto, clave):
+        """Diccionario << >> o arreglo [ ] de una clave, resolviendo referencias indirectas"""
+        m = re.search(rb'/' + clave + rb'\s*(<<|\[|(\d+)\s+\d+\s+R)', texto)
+        if m is None:
+            return None
+        if m.group(2):
+            return self.objeto(int(m.group(2))).split(b'obj', 1)[-1]
+        return balanceado(texto, m.start(1))
+
+    def recorrer_paginas(self, limite):
+        """
+        Genera (diccionario de la página, MediaBox, diccionario de recursos) de hasta
+        `limite` páginas, en orden, con los atributos heredados del árbol.
+        """
+        self.cargar_xref()
+        raiz = referencia(self.objeto(self.raiz), b'Pages')
+        pila, vistos, generadas = [(raiz, None, None)], set(), 0
+        while pila and generadas < limite:
+            numero, caja, recursos = pila.pop()
+            if numero in vistos:
+                continue
+            vistos.add(numero)
+            texto = self.objeto(numero)
+            caja = self.valor(texto, b'MediaBox') or caja
+            recursos = self.valor(texto, b'Resources') or recursos
+            hijos = self.valor(texto, b'Kids')
+            if hijos is not None and re.search(rb'/Type\s*/Pages\b', texto):
+                refs = [int(n) for n in re.findall(rb'(\d+)\s+\d+\s+R', hijos)]
+                pila.extend((hijo, caja, recursos) for hijo in reversed(refs))
+                continue
+            generadas += 1
+            yield texto, numeros(caja), recursos or b''
+
+    def streams_de(self, texto, clave=b'Contents'):
+        """Datos decodificados de los streams referenciados por la clave (ej: /Contents)"""
+        m = re.search(rb'/' + clave + rb'\s*(\[[^\]]*\]|\d+\s+\d+\s+R)', texto)
+        if m is None:
+            return
+        for ref in re.findall(rb'(\d+)\s+\d+\s+R', m.group(1)):
+            try:
+                yield self.objeto_con_stream_numero(int(ref))[1]
+            except PDFInvalido:
+                continue
+
+    def pagina_a_color(self, texto, recursos):
+        """
+        Si la página usa color: operadores de color en el contenido (rg, k, sc con
+        componentes distintas) o imágenes en espacios de color RGB/CMYK. Las
+        imágenes JPEG / JPEG 2000 no se decodifican: decide el espacio de color
+        declarado. Las demás imágenes RGB se revisan pixel por pixel.
+        """
+        for contenido in self.streams_de(texto):
+            if contenido_a_color(contenido):
+                return True
+        xobjects = self.valor(recursos, b'XObject') or b''
+        for ref in re.findall(rb'(\d+)\s+\d+\s+R', xobjects):
+            try:
+                diccionario = self.objeto(int(ref))
+                if RE_FILTRO_JPEG.search(diccionario) and re.search(rb'/Subtype\s*/Image\b', diccionario):
+                    if b'/ImageMask true' not in diccionario and self.imagen_a_color(diccionario):
+                        return True
+                    continue
+                diccionario, datos = self.objeto_con_stream_numero(int(ref))
+            except PDFInvalido:
+                continue
+            if re.search(rb'/Subtype\s*/Form\b', diccionario):
+                if contenido_a_color(datos):
+                    return True
+            elif re.search(rb'/Subtype\s*/Image\b', diccionario) and b'/ImageMask true' not in diccionario:
+                if self.imagen_a_color(diccionario, datos):
+                    return True
+        return False
+
+    def imagen_a_color(self, diccionario, datos=None):
+        """Por el /ColorSpace; con los pixels decodificados (datos) se descartan los RGB grises"""
+        espacio = self.valor(diccionario, b'ColorSpace')
+        if espacio is None:
+            m = re.search(rb'/ColorSpace\s*/(\w+)', diccionario)
+            espacio = b'/' + m.group(1) if m else b''
+        if re.match(rb'\s*\[?\s*/ICCBased', espacio):
+            ref = re.search(rb'(\d+)\s+\d+\s+R', espacio)
+            componentes = entero(self.objeto(int(ref.group(1))), b'N') if ref else 3
+            if componentes == 1:
+                return False
+            es_rgb = componentes == 3
+        elif re.match(rb'\s*\[?\s*/(DeviceGray|CalGray|G)\b', espacio):
+            return False
+        elif re.match(rb'\s*\[?\s*/Separation\s*/(Black|All)\b', espacio):
+            return False
+        else:
+            es_rgb = re.match(rb'\s*\[?\s*/(DeviceRGB|CalRGB|RGB)\b', espacio) is not None
+        # Escaneos guardados en RGB que en realidad son grises: R == G == B en todos los pixels
+        if datos is not None and es_rgb and entero(diccionario, b'BitsPerComponent') == 8 \
+                and b'DecodeParms' not in diccionario and len(datos) % 3 == 0:
+            return not (datos[0::3] == datos[1::3] == datos[2::3])
+        return True
+
+
+def balanceado(texto, inicio):
+    """Subcadena de un << diccionario >> o [ arreglo ] que empieza en inicio (respeta anidados)"""
+    abre, cierra = (b'<<', b'>>') if texto[inicio:inicio + 2] == b'<<' else (b'[', b']')
+    nivel, i = 0, inicio
+    while i < len(texto):
+        if texto.startswith(abre, i):
+            nivel += 1
+            i += len(abre)
+        elif texto.startswith(cierra, i):
+            nivel -= 1
+            i += len(cierra)
+            if nivel == 0:
+                return texto[inicio:i]
+        else:
+            i += 1
+    return texto[inicio:]
+
+
+def numeros(texto):
+    return [float(n) for n in RE_NUMERO.findall(texto or b'')]
+
+
+def contenido_a_color(contenido):
+    """Operadores de color del contenido de una página con componentes que no son grises"""
+    for componentes in RE_COLOR_RGB.findall(contenido):
+        if len(set(float(c) for c in componentes)) > 1:
+            return True
+    for componentes in RE_COLOR_CMYK.findall(contenido):
+        cian, magenta, amarillo = (float(c) for c in componentes[:3])
+        if max(cian, magenta, amarillo) - min(cian, magenta, amarillo) > 0.01:
+            return True
+    # Imágenes en línea (BI ... ID ... EI) en RGB o CMYK
+    return RE_IMAGEN_EN_LINEA_COLOR.search(contenido) is not None
+
+
+def decodificar(diccionario, datos):
+    """FlateDecode con predictor PNG (lo que usan las xref streams); otros filtros no se soportan"""
+    filtro = re.search(rb'/Filter\s*\[?\s*/(\w+)', diccionario)
+    if filtro is None:
+        return datos
+    if filtro.group(1) != b'FlateDecode':
+        raise PDFInvalido(f'Filtro no soportado: {filtro.group(1).decode()}')
+    descompresor = zlib.decompressobj()
+    datos = descompresor.decompress(datos, MAX_STREAM)
+    if descompresor.unconsumed_tail:
+        raise PDFInvalido('Stream demasiado grande')
+
+    predictor = entero(diccionario, b'Predictor') or 1
+    if predictor < 10:
+        if predictor != 1:
+            raise PDFInvalido('Predictor TIFF no soportado')
+        return datos
+    return sin_predictor_png(datos, entero(diccionario, b'Columns') or 1)
+
+
+def sin_predictor_png(datos, columnas):
+    """Deshace el predictor PNG por filas (1 byte por pixel, como en las xref streams)"""
+    salida = bytearray()
+    anterior = bytearray(columnas)
+    for inicio in range(0, len(datos) - columnas, columnas + 1):
+        tipo = datos[inicio]
+        fila = bytearray(datos[inicio + 1:inicio + 1 + columnas])
+        if tipo == 1:
+            for i in range(1, columnas):
+                fila[i] = (fila[i] + fila[i - 1]) & 0xFF
+        elif tipo == 2:
+            fila = bytearray((a + b) & 0xFF for a, b in zip(fila, anterior))
+        elif tipo == 3:
+            for i in range(columnas):
+                izquierda = fila[i - 1] if i else 0
+                fila[i] = (fila[i] + (izquierda + anterior[i]) // 2) & 0xFF
+        elif tipo == 4:
+            for i in range(columnas):
+                a = fila[i - 1] if i else 0
+                b = anterior[i]
+                c = anterior[i - 1] if i else 0
+                p = a + b - c
+                pa, pb, pc = abs(p - a), abs(p - b), abs(p - c)
+                fila[i] = (fila[i] + (a if pa <= pb and pa <= pc else b if pb <= pc else c)) & 0xFF
+        salida += fila
+        anterior = fila
+    return bytes(salida)
+
+
+def contar_por_escaneo(archivo):
+    """
+    Respaldo para PDFs con la xref dañada: cuenta los objetos /Type /Page leyendo
+    por bloques con un solapamiento chico. No ve las páginas dentro de object streams.
+    """
+    archivo.seek(0)
+    cantidad = 0
+    base = 0            # posición absoluta de datos[0]
+    contadas_hasta = 0  # coincidencias que terminan antes de esta posición ya se contaron
+    datos = b''
+    while True:
+        bloque = archivo.read(16 * BLOQUE)
+        datos += bloque
+        # Se deja un margen al final para no confundir un /Pages partido con un /Page
+        limite = len(datos) if not bloque else len(datos) - 32
+        for m in RE_PAGINA.finditer(datos):
+            if contadas_hasta < base + m.end() <= base + limite:
+                cantidad += 1
+        if not bloque:
+            break
+        contadas_hasta = base + limite
+        corte = max(limite - 64, 0)
+        datos = datos[corte:]
+        base += corte
+    return cantidad or None
+
+
+def contar_paginas(archivo):
+    """
+    Cantidad de páginas de un PDF (file-like con seek) o None si no es un PDF o no
+    se pudo determinar. Deja el archivo posicionado al principio.
+    """
+    try:
+        archivo.seek(0)
+        if b'%PDF-' not in archivo.read(1024):
+            return None
+        try:
+            paginas = _LectorPDF(archivo).paginas()
+        except (TimeoutError, MemoryError):
+            raise  # los límites del análisis tienen que llegar al que los puso
+        except Exception:
+            # Un PDF malformado puede romper el lector de formas muy variadas
+            # (offsets enormes, recursión, tipos inesperados): se cae al escaneo
+            try:
+                paginas = contar_por_escaneo(archivo)
+            except (TimeoutError, MemoryError):
+                raise
+            except Exception:
+                return None
+        return paginas or None
+    finally:
+        archivo.seek(0)
+
+
+def analizar_paginas(archivo, max_paginas):
+    """
+    Medidas en puntos y si usa color cada página: [(ancho, alto, color)].
+    Solo PDFs con la estructura legible; lanza PDFInvalido si no se puede recorrer.
+    """
+    archivo.seek(0)
+    if b'%PDF-' not in archivo.read(1024):
+        raise PDFInvalido('No es un PDF')
+    lector = _LectorPDF(archivo)
+    resultado = []
+    try:
+        for texto, caja, recursos in lector.recorrer_paginas(max_paginas):
+            if len(caja) != 4:
+                raise PDFInvalido('Página sin /MediaBox')
+            unidad = float(RE_NUMERO.search(texto[texto.find(b'/UserUnit'):]).group(1)) \
+                if b'/UserUnit' in texto else 1.0
+            ancho, alto = abs(caja[2] - caja[0]) * unidad, abs(caja[3] - caja[1]) * unidad
+            resultado.append((ancho, alto, lector.pagina_a_color(texto, recursos)))
+    except (zlib.error, IndexError, AttributeError) as e:
+        raise PDFInvalido(str(e))
+    finally:
+        archivo.seek(0)
+    return resultado
@@ -0,0 +1,189 @@
+# planificacion.py
+# Plan de impresión: agrupa los trabajos de los pedidos abiertos por formato y color
+# para cambiar de papel / modo lo menos posible, sin dejar esperando a los pedidos viejos.
+# El estado se mantiene en memoria por proceso y se actualiza solo con los pedidos
+# que cambiaron desde la última consulta.
+import threading
+from collections import defaultdict
+from datetime import datetime, timedelta, timezone as dt_timezone
+
+from django.conf import settings
+from django.db.models import Q
+from django.utils import timezone
+
+from .models import Pedido, PedidoImpresionDetalle
+
+ESTADOS_PLANIFICADOS = ("Pendiente", "En proceso")
+# Pedidos viejos sin created_at: van primero
+SIN_FECHA = datetime(2000, 1, 1, tzinfo=dt_timezone.utc)
+
+
+class Trabajo:
+    """Una línea PedidoImpresionDetalle lista para imprimir"""
+
+    __slots__ = ('detalle_id', 'pedido_id', 'impresion_id', 'nombre_archivo', 'fecha_pedido',
+                 'formato', 'color', 'copias', 'paginas')
+
+    def __init__(self, detalle_id, pedido_id, impresion_id, nombre_archivo, fecha_pedido,
+                 formato, color, copias, paginas):
+        self.detalle_id = detalle_id
+        self.pedido_id = pedido_id
+        self.impresion_id = impresion_id
+        self.nombre_archivo = nombre_archivo
+        self.fecha_pedido = fecha_pedido or SIN_FECHA
+        self.formato = formato
+        self.color = color
+        self.copias = copias
+        self.paginas = paginas
+
+    @property
+    def clave(self):
+        return (self.formato, self.color)
+
+    @property
+    def orden(self):
+        return (self.fecha_pedido, self.pedido_id, self.detalle_id)
+
+    @property
+    def hojas(self):
+        # Sin páginas contadas (archivo no legible) se toma 1 por copia
+        return (self.paginas or 1) * self.copias
+
+    def datos(self):
+        return {
+            'detalle_id': self.detalle_id,
+            'pedido_id': self.pedido_id,
+            'impresion_id': self.impresion_id,
+            'nombre_archivo': self.nombre_archivo,
+            'copias': self.copias,
+            'paginas': self.paginas,
+            'hojas': self.hojas,
+            'fecha_pedido': self.fecha_pedido,
+        }
+
+
+def costo_cambio(desde, hasta):
+    """0 si no hay cambio, 1 si solo cambia el color, 2 si hay que cambiar el papel"""
+    if desde is None or desde == hasta:
+        return 0
+    return 1 if desde[0] == hasta[0] else 2
+
+
+def armar_plan(grupos, ventana, max_hojas):
+    """
+    Ordena los grupos {(formato, color): [trabajos del más viejo al más nuevo]} en lotes.
+    El próximo lote sale de los grupos cuyo trabajo más viejo llegó dentro de `ventana`
+    respecto del más viejo de todos (ese siempre es candidato, así nada espera de más);
+    entre ellos gana el que menos cambio de papel/color implica. Un lote se corta en
+    max_hojas para que un grupo grande no frene al resto.
+    """
+    posiciones = {clave: 0 for clave, trabajos in grupos.items() if trabajos}
+    lotes = []
+    actual = None
+    while posiciones:
+        mas_viejo = min(grupos[clave][i].fecha_pedido for clave, i in posiciones.items())
+        candidatos = [clave for clave, i in posiciones.items() if grupos[clave][i].fecha_pedido <= mas_viejo + ventana]
+        clave = min(candidatos, key=lambda c: (costo_cambio(actual, c), grupos[c][posiciones[c]].orden))
+
+        trabajos, hojas = [], 0
+        pendientes = grupos[clave]
+        i = posiciones[clave]
+        while i < len(pendientes) and (not trabajos or hojas + pendientes[i].hojas <= max_hojas):
+            trabajos.append(pendientes[i])
+            hojas += pendientes[i].hojas
+            i += 1
+        if i < len(pendientes):
+            posiciones[clave] = i
+        else:
+            del posiciones[clave]
+
+        lotes.append({
+            'formato': clave[0],
+            'color': clave[1],
+            'cambio': ('ninguno', 'color', 'papel')[costo_cambio(actual, clave)] if actual else 'inicio',
+            'hojas': hojas,
+            'trabajos': [trabajo.datos() for trabajo in trabajos],
+        })
+        actual = clave
+    return lotes
+
+
+class Planificador:
+    """
+    Trabajos de los pedidos abiertos agrupados por (formato, color). _sincronizar()
+    trae solo los pedidos modificados desde la última vez (por updated_at del pedido
+    o de sus impresiones); cada tanto, o si el conteo no cierra (bajas), se rearma entero.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._trabajos = {}                  # detalle_id -> Trabajo
+        self._por_pedido = defaultdict(set)  # pedido_id -> detalle_ids
+        self._pedidos = set()                # pedidos abiertos (con o sin impresiones)
+        self._cursor = None
+        self._ultima_completa = None
+        self._plan = None
+
+    def invalidar(self):
+        with self._lock:
+            self._cursor = None
+
+    def _cargar(self, pedidos=None):
+        """Reemplaza los trabajos de esos pedidos (None: todos los abiertos) por lo que hay en la base"""
+        filas = PedidoImpresionDetalle.objects.filter(fk_pedido__estado__in=ESTADOS_PLANIFICADOS)
+        if pedidos is not None:
+            for pedido_id in pedidos:
+                for detalle_id in self._por_pedido.pop(pedido_id, ()):
+                    self._trabajos.pop(detalle_id, None)
+            filas = filas.filter(fk_pedido__in=pedidos)
+        filas = (filas
+                 .values_list('id', 'fk_pedido_id', 'fk_impresion_id', 'fk_impresion__nombre_archivo',
+                              'fk_pedido__created_at', 'fk_impresion__formato', 'fk_impresion__color',
+                              'cantidadCopias', 'fk_impresion__paginas'))
+        for fila in filas:
+            trabajo = Trabajo(*fila)
+            self._trabajos[trabajo.detalle_id] = trabajo
+            self._por_pedido[trabajo.pedido_id].add(trabajo.detalle_id)
+
+    def _sincronizar(self, ahora):
+        config = settings.PLAN_IMPRESION
+        abiertos = Pedido.objects.filter(estado__in=ESTADOS_PLANIFICADOS)
+        completa = (self._cursor is None
+                    or ahora - self._ultima_completa > timedelta(seconds=config['RESINCRONIZAR']))
+        if not completa:
+            # Margen: un cambio confirmado tarde puede tener un updated_at anterior al cursor
+            desde = self._cursor - timedelta(seconds=config['MARGEN'])
+            cambiados = set(Pedido.objects.filter(
+                Q(updated_at__gt=desde) | Q(pedidoimpresiondetalle__fk_impresion__updated_at__gt=desde)
+            ).values_list('id', flat=True))
+            if cambiados:
+                abiertos_cambiados = set(abiertos.filter(id__in=cambiados).values_list('id', flat=True))
+                self._pedidos = (self._pedidos - cambiados) | abiertos_cambiados
+                self._cargar(cambiados)
+                self._plan = None
+            # Un pedido borrado no deja rastro en updated_at
+            completa = abiertos.count() != len(self._pedidos)
+        if completa:
+            self._trabajos.clear()
+            self._por_pedido.clear()
+            self._pedidos = set(abiertos.values_list('id', flat=True))
+            self._cargar()
+            self._ultima_completa = ahora
+            self._plan = None
+        self._cursor = ahora
+
+    def plan(self):
+        config = settings.PLAN_IMPRESION
+        with self._lock:
+            self._sincronizar(timezone.now())
+            if self._plan is None:
+                grupos = defaultdict(list)
+                for trabajo in self._trabajos.values():
+                    grupos[trabajo.clave].append(trabajo)
+                for trabajos in grupos.values():
+                    trabajos.sort(key=lambda t: t.orden)
+                self._plan = armar_plan(grupos, timedelta(hours=config['VENTANA_HORAS']), config['MAX_HOJAS_LOTE'])
+            return self._plan
+
+
+planificador = Planificador()
@@ -0,0 +1,138 @@
+# precios.py
+# Motor de precios del servidor: el total de un pedido no depende de lo que mande el cliente.
+# Las tarifas por hoja salen de TipoImpresion y se mantienen en memoria por proceso.
+from django.conf import settings
+from django.db import transaction
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+
+from .cache_local import CacheTTL
+from .models import Producto, TipoImpresion
+
+_config = getattr(settings, 'PRECIOS', {})
+
+# Una sola entrada: {(formato, color): precio por hoja} de los tipos activos.
+# El TTL acota cuánto tarda en verse un cambio hecho desde otro worker.
+_tabla_cache = CacheTTL(ttl=_config.get('TTL', 300), max_entradas=1)
+
+
+class PrecioNoDisponible(ValueError):
+    """No hay un TipoImpresion activo para el formato/color pedido"""
+
+
+def tabla_precios():
+    tabla = _tabla_cache.get('tabla')
+    if tabla is None:
+        tabla = {(formato, color): precio for formato, color, precio
+                 in TipoImpresion.objects.filter(activo=True).values_list('formato', 'color', 'precio')}
+        _tabla_cache.set('tabla', tabla)
+    return tabla
+
+
+def invalidar_precios():
+    _tabla_cache.clear()
+
+
+@receiver([post_save, post_delete], sender=TipoImpresion)
+def invalidar_por_tipo(sender, instance, **kwargs):
+    # actualizar_precio / activar / desactivar guardan con save(). Se limpia ya y
+    # otra vez al confirmar, por si otro request recargó la tabla vieja antes del commit.
+    invalidar_precios()
+    transaction.on_commit(invalidar_precios)
+
+
+def es_color(valor):
+    """El front manda 'color' / 'bn' / 'blanco y negro' (o un booleano)"""
+    return str(valor).strip().lower() in ('color', 'true', '1')
+
+
+def entero_positivo(valor, campo):
+    try:
+        numero = int(valor)
+    except (TypeError, ValueError):
+        raise ValueError(f"'{campo}' debe ser un número entero")
+    if numero < 1:
+        raise ValueError(f"'{campo}' debe ser mayor a 0")
+    return numero
+
+
+def precio_hoja(formato, color, tabla=None):
+    tabla = tabla_precios() if tabla is None else tabla
+    precio = tabla.get((formato, color))
+    if precio is None:
+        raise PrecioNoDisponible(
+            f"No hay tarifa activa para {formato} {'color' if color else 'blanco y negro'}"
+        )
+    return precio
+
+
+def precio_impresion(formato, color, copias, paginas, tabla=None):
+    """(precio por hoja, subtotal) de una impresión"""
+    precio = precio_hoja(formato, color, tabla)
+    return precio, precio * paginas * copias
+
+
+class Cotizacion:
+    """Resultado de cotizar un carrito: líneas con precio y totales"""
+
+    def __init__(self, productos, impresiones, descuento):
+        self.productos = productos
+        self.impresiones = impresiones
+        self.descuento = descuento
+        self.total_bruto = (sum(linea['subtotal'] for linea in productos)
+                            + sum(linea['subtotal'] for linea in impresiones))
+        self.total = self.total_bruto * (1 - (descuento / 100))
+
+    def datos(self):
+        return {
+            'productos': self.productos,
+            'impresiones': self.impresiones,
+            'total_bruto': self.total_bruto,
+            'descuento': self.descuento,
+            'total': self.total,
+        }
+
+
+def cotizar(productos, impresiones, descuento=0):
+    """
+    Cotiza un carrito completo en una pasada: una query para los productos y la
+    tabla de tarifas en memoria para las impresiones.
+    productos: [{'fk_producto': id, 'cantidad': n}]
+    impresiones: [{'formato': 'A4', 'color': 'color' | 'bn', 'copias': n, 'paginas': n}]
+    Lanza Producto.DoesNotExist, PrecioNoDisponible o ValueError si algo no es válido.
+    """
+    ids = [int(det['fk_producto']) for det in productos]
+    catalogo = Producto.objects.in_bulk(ids)
+    faltantes = sorted(set(ids) - set(catalogo))
+    if faltantes:
+        raise Producto.DoesNotExist(f"Productos inexistentes: {faltantes}")
+
+    lineas_productos = []
+    for det, producto_id in zip(productos, ids):
+        cantidad = entero_positivo(det.get('cantidad', 1), 'cantidad')
+        precio = float(catalogo[producto_id].precioUnitario)
+        lineas_productos.append({
+            'fk_producto': producto_id,
+            'cantidad': cantidad,
+            'precio_unitario': precio,
+            'subtotal': precio * cantidad,
+        })
+
+    tabla = tabla_precios() if impresiones else {}
+    lineas_impresiones = []
+    for imp in impresiones:
+        formato = imp.get('formato', 'A4')
+        color = es_color(imp.get('color'))
+        copias = entero_positivo(imp.get('copias', 1), 'copias')
+        paginas = entero_positivo(imp.get('paginas') or 1, 'paginas')
+        precio, subtotal = precio_impresion(formato, color, copias, paginas, tabla)
+        lineas_impresiones.append({
+            'formato': formato,
+            'color': color,
+            'copias': copias,
+            'paginas': paginas,
+            'precio_hoja': precio,
+            'subtotal': subtotal,
+        })
+
+    return Cotizacion(lineas_productos, lineas_impresiones, descuento or 0)
@@ -0,0 +1,276 @@
+# preflight.py
+# Revisión de los archivos de impresión subidos: páginas, tamaño de cada página
+# (A0-A6) y si realmente tienen color. Corre en el cluster de django-q2, nunca en
+# el request; cada archivo se analiza en un proceso del pool (analisis.py) con
+# tiempo y memoria acotados. El resultado se guarda por SHA-256 del contenido.
+import hashlib
+import logging
+import math
+import os
+import tempfile
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+from django_q.tasks import async_task
+
+from .almacenamiento import bloques_archivo
+from .analisis import analizar, inicializar_proceso
+from .models import Impresion, ResultadoPreflight
+
+logger = logging.getLogger('preflight')
+
+_pool = None
+_pool_lock = threading.Lock()
+
+MARGEN_TAREA = 10   # segundos de holgura respecto de Q_CLUSTER['timeout']
+
+
+class ArchivoNoDisponible(Exception):
+    """No se pudo descargar el archivo o supera PREFLIGHT['MAX_BYTES']"""
+
+    def __init__(self, mensaje, transitorio=False):
+        super().__init__(mensaje)
+        self.transitorio = transitorio
+
+
+def obtener_pool():
+    """Pool de procesos por worker del cluster (se crea al primer uso)"""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            config = settings.PREFLIGHT
+            # max_tasks_per_child recicla los procesos (y arranca con spawn: analisis.py no usa Django)
+            _pool = ProcessPoolExecutor(
+                max_workers=config['PROCESOS'],
+                initializer=inicializar_proceso,
+                initargs=(config['MEMORIA_MB'],),
+                max_tasks_per_child=config['TAREAS_POR_PROCESO'],
+            )
+        return _pool
+
+
+def reiniciar_pool():
+    """Descarta el pool: después de un proceso colgado o muerto (ej: por el límite de memoria)"""
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            # Un proceso trabado en código C no atiende la cancelación: se termina a mano
+            for proceso in list((_pool._processes or {}).values()):
+                proceso.kill()
+            _pool.shutdown(wait=False, cancel_futures=True)
+            _pool = None
+
+
+# --- Encolado (desde las vistas) ---
+
+def archivos_por_tarea():
+    """
+    Cuántos archivos entran en una tarea sin pasar Q_CLUSTER['timeout']: cada uno
+    puede tardar hasta la descarga más el análisis.
+    """
+    config = settings.PREFLIGHT
+    por_archivo = config['TIMEOUT_DESCARGA'] + config['TIMEOUT'] + 5
+    return max(1, (settings.Q_CLUSTER['timeout'] - MARGEN_TAREA) // por_archivo)
+
+
+def encolar_preflight(impresion_ids, intento=1):
+    """
+    Marca las impresiones como pendientes de revisión y, cuando la transacción
+    confirma, las manda al cluster en tareas de archivos_por_tarea() archivos.
+    """
+    ids = [impresion_id for impresion_id in impresion_ids if impresion_id]
+    if not ids:
+        return
+    Impresion.objects.filter(id__in=ids).update(
+        preflight_estado='Pendiente', preflight_observaciones=[], fk_preflight=None,
+        updated_at=timezone.now(),
+    )
+    transaction.on_commit(lambda: despachar(ids, intento))
+
+
+def despachar(ids, intento=1):
+    tamanio = archivos_por_tarea()
+    for inicio in range(0, len(ids), tamanio):
+        tanda = ids[inicio:inicio + tamanio]
+        try:
+            async_task('app.preflight.procesar_preflight', tanda, intento, task_name=f"preflight-{tanda[0]}")
+        except Exception as e:
+            logger.error(f"No se pudo encolar el preflight de {tanda}: {e}")
+
+
+# --- Tarea del cluster ---
+
+def descargar(impresion, carpeta):
+    """Baja el archivo a disco calculando su SHA-256. Devuelve (ruta, sha256)"""
+    ruta = os.path.join(carpeta, str(impresion.id))
+    digest = hashlib.sha256()
+    tamanio = 0
+    limite = time.monotonic() + settings.PREFLIGHT['TIMEOUT_DESCARGA']
+    try:
+        with open(ruta, 'wb') as destino:
+            for bloque in bloques_archivo(impresion):
+                tamanio += len(bloque)
+                if tamanio > settings.PREFLIGHT['MAX_BYTES']:
+                    raise ArchivoNoDisponible('El archivo es demasiado grande para revisarlo')
+                if time.monotonic() > limite:
+                    raise ArchivoNoDisponible('La descarga del archivo no terminó a tiempo', transitorio=True)
+                digest.update(bloque)
+                destino.write(bloque)
+    except ArchivoNoDisponible:
+        raise
+    except Exception as e:
+        raise ArchivoNoDisponible(f'No se pudo descargar el archivo: {e}', transitorio=True)
+    return ruta, digest.hexdigest()
+
+
+def analizar_en_pool(rutas):
+    """
+    {sha256: dict de analisis.analizar} de los archivos {sha256: ruta}. Los que no
+    terminan a tiempo o rompen el proceso quedan con 'error' y 'transitorio' (no se cachean).
+    """
+    config = settings.PREFLIGHT
+    if not rutas:
+        return {}
+    try:
+        pool = obtener_pool()
+        futuros = {pool.submit(analizar, ruta, config['MAX_PAGINAS'], config['TIMEOUT']): sha256
+                   for sha256, ruta in rutas.items()}
+    except BrokenProcessPool:
+        reiniciar_pool()
+        return {sha256: {'error': 'El análisis falló', 'transitorio': True} for sha256 in rutas}
+
+    # Cada proceso corta su archivo en TIMEOUT; esto cubre además la espera en la cola del pool
+    tandas = math.ceil(len(futuros) / config['PROCESOS'])
+    terminados, colgados = wait(futuros, timeout=config['TIMEOUT'] * tandas + 5)
+
+    resultados = {}
+    for futuro in terminados:
+        try:
+            resultados[futuros[futuro]] = futuro.result()
+        except Exception as e:
+            logger.error(f"Preflight de {futuros[futuro][:12]} falló: {e!r}")
+            resultados[futuros[futuro]] = {'error': 'El análisis falló', 'transitorio': True}
+    for futuro in colgados:
+        resultados[futuros[futuro]] = {'error': 'El análisis no terminó a tiempo', 'transitorio': True}
+    if colgados or any(isinstance(f.exception(), BrokenProcessPool) for f in terminados):
+        reiniciar_pool()
+    return resultados
+
+
+def guardar_resultado(sha256, datos):
+    campos = {
+        'paginas': datos.get('paginas'),
+        'formato': datos.get('formato'),
+        'formatos': datos.get('formatos') or {},
+        'color': datos.get('color'),
+        'paginas_color': datos.get('paginas_color') or 0,
+        'error': datos.get('error'),
+    }
+    try:
+        return ResultadoPreflight.objects.create(sha256=sha256, **campos)
+    except IntegrityError:
+        # Otro worker lo analizó en paralelo
+        return ResultadoPreflight.objects.get(sha256=sha256)
+
+
+def observaciones_de(impresion, resultado):
+    """(estado, observaciones) comparando el archivo con el formato/color elegido"""
+    if resultado.error:
+        return 'Error', [resultado.error]
+    observaciones = []
+    if len(resultado.formatos) > 1:
+        detalle = ', '.join(f"{formato} ({cantidad})" for formato, cantidad in sorted(resultado.formatos.items()))
+        observaciones.append(f"El archivo mezcla tamaños de página: {detalle}")
+    if resultado.formato == 'otro':
+        observaciones.append("El tamaño de página no es un formato A0-A6")
+    elif resultado.formato and resultado.formato != impresion.formato:
+        observaciones.append(f"Se eligió {impresion.formato} pero el archivo es {resultado.formato}")
+    if not impresion.color and resultado.color:
+        observaciones.append(f"Se eligió blanco y negro pero {resultado.paginas_color} página(s) tienen color")
+    if impresion.color and resultado.color is False:
+        observaciones.append("Se eligió color pero el archivo está todo en escala de grises")
+    return ('Observada' if observaciones else 'Aprobada'), observaciones
+
+
+def aplicar(impresion, resultado=None, error=None):
+    if resultado is not None:
+        estado, observaciones = observaciones_de(impresion, resultado)
+    else:
+        estado, observaciones = 'Error', [error]
+    campos = {
+        'preflight_estado': estado,
+        'preflight_observaciones': observaciones,
+        'fk_preflight': resultado,
+        'updated_at': timezone.now(),
+    }
+    if impresion.paginas is None and resultado is not None and resultado.paginas:
+        campos['paginas'] = resultado.paginas
+    # Si el archivo se reemplazó mientras tanto (corrección), la fila ya tiene otro preflight en curso
+    Impresion.objects.filter(id=impresion.id, url=impresion.url).update(**campos)
+
+
+def procesar_preflight(impresion_ids, intento=1):
+    """
+    Tarea del cluster. Primero busca en la caché por el SHA-256 del blob (sin
+    descargar nada); el resto se baja a un directorio temporal, se vuelve a buscar
+    por el digest calculado y lo que falta se analiza en el pool de procesos.
+    Las fallas transitorias (descarga, tiempo, memoria) se vuelven a encolar hasta
+    PREFLIGHT['INTENTOS'] veces; después quedan en 'Error'.
+    """
+    impresiones = list(Impresion.objects.filter(id__in=impresion_ids).select_related('fk_blob'))
+    conocidos = {imp.id: imp.fk_blob.sha256 for imp in impresiones if imp.fk_blob_id}
+    cache = ResultadoPreflight.objects.in_bulk(set(conocidos.values()), field_name='sha256')
+
+    digests = {}
+    reintentar = {}   # impresion_id -> mensaje de la falla transitoria
+    with tempfile.TemporaryDirectory(prefix='preflight-') as carpeta:
+        rutas = {}
+        for impresion in impresiones:
+            sha256 = conocidos.get(impresion.id)
+            if sha256 in cache:
+                digests[impresion.id] = sha256
+                continue
+            try:
+                ruta, sha256 = descargar(impresion, carpeta)
+            except ArchivoNoDisponible as e:
+                logger.warning(f"Preflight de la impresión #{impresion.id}: {e}")
+                if e.transitorio:
+                    reintentar[impresion.id] = str(e)
+                else:
+                    aplicar(impresion, error=str(e))
+                continue
+            digests[impresion.id] = sha256
+            rutas.setdefault(sha256, ruta)
+
+        faltantes = set(rutas) - set(cache)
+        cache.update(ResultadoPreflight.objects.in_bulk(faltantes, field_name='sha256'))
+        analizados = analizar_en_pool({sha256: rutas[sha256] for sha256 in faltantes if sha256 not in cache})
+
+    transitorios = {}
+    for sha256, datos in analizados.items():
+        if datos.pop('transitorio', False):
+            transitorios[sha256] = datos['error']
+        else:
+            cache[sha256] = guardar_resultado(sha256, datos)
+
+    for impresion in impresiones:
+        sha256 = digests.get(impresion.id)
+        if sha256 in cache:
+            aplicar(impresion, cache[sha256])
+        elif sha256 in transitorios:
+            reintentar[impresion.id] = transitorios[sha256]
+
+    if not reintentar:
+        return
+    if intento < settings.PREFLIGHT['INTENTOS']:
+        logger.info(f"Preflight: reintento {intento + 1} de {sorted(reintentar)}")
+        encolar_preflight(list(reintentar), intento + 1)
+    else:
+        for impresion in impresiones:
+            if impresion.id in reintentar:
+                aplicar(impresion, error=reintentar[impresion.id])
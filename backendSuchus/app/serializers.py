@@ -1,5 +1,5 @@
 from rest_framework import serializers
-from .models import Usuario, UsuarioTipo, Pedido, Impresion, Producto, PedidoProductoDetalle, PedidoImpresionDetalle, PedidoEstadoHistorial, Reporte, TipoImpresion
+from .models import Usuario, UsuarioTipo, Pedido, Impresion, Producto, PedidoProductoDetalle, PedidoImpresionDetalle, PedidoEstadoHistorial, Reporte, TipoImpresion, SesionSubida
 
 
 
@@ -167,6 +167,9 @@ class UsuarioUpdateSerializer(serializers.ModelSerializer):
         if tipo_usuario:
             try:
                 usuario_tipo_obj = UsuarioTipo.objects.get(descripcion=tipo_usuario)
+                if usuario_tipo_obj.pk != instance.usuarioTipo_id:
+                    # El tipo viaja en los claims del token: invalidar los emitidos
+                    instance.token_version += 1
                 instance.usuarioTipo = usuario_tipo_obj
             except UsuarioTipo.DoesNotExist:
                 raise serializers.ValidationError({
@@ -189,7 +192,23 @@ class ImpresionSerializer(serializers.ModelSerializer):
         model = Impresion
         # Agregamos 'url' a la lista de campos
         # Puedes quitar 'archivo' y 'archivo_url' si ya no los necesitas en el JSON
-        fields = ['id', 'nombre_archivo', 'formato', 'color', 'url', 'archivo']
+        fields = ['id', 'nombre_archivo', 'formato', 'color', 'url', 'archivo', 'paginas',
+                  'preflight_estado', 'preflight_observaciones']
+        read_only_fields = ['paginas', 'preflight_estado', 'preflight_observaciones']
+
+class SesionSubidaSerializer(serializers.ModelSerializer):
+    cantidad_partes = serializers.IntegerField(read_only=True)
+    offset = serializers.IntegerField(read_only=True)
+    partes_faltantes = serializers.ListField(child=serializers.IntegerField(), read_only=True)
+    impresion = ImpresionSerializer(source='fk_impresion', read_only=True)
+
+    class Meta:
+        model = SesionSubida
+        fields = ['id', 'nombre_archivo', 'content_type', 'tamanio', 'bytes_parte', 'formato', 'color',
+                  'estado', 'cantidad_partes', 'offset', 'partes_faltantes', 'impresion',
+                  'created_at', 'updated_at']
+        read_only_fields = ['estado', 'bytes_parte']
+
 # Asegúrate de que PedidoImpresionDetalleSerializer incluya la impresión serializada
 class PedidoImpresionDetalleSerializer(serializers.ModelSerializer):
     # Usamos fk_impresion porque ese es el nombre real en tu modelo
@@ -226,14 +245,16 @@ class PedidoSerializer(serializers.ModelSerializer):
     class Meta:
         model = Pedido
         fields = ['id', 'estado', 'observacion', 'motivo_correccion', 'total', 'fecha', 'fk_usuario',
-                  'usuario_nombre', 'usuario_apellido', 'usuario_email', 'detalles', 'detalle_impresiones', 'historial_estados', 'updated_at']
-        read_only_fields = ['id', 'updated_at']
+                  'usuario_nombre', 'usuario_apellido', 'usuario_email', 'detalles', 'detalle_impresiones', 'historial_estados', 'updated_at', 'version']
+        read_only_fields = ['id', 'updated_at', 'version']
 
     def get_historial_estados(self, obj):
         from django.utils import timezone
         try:
-            historial = obj.historial_estados.all().order_by('fecha')
-            if historial.exists():
+            # .all() a secas para leer del prefetch (ya viene ordenado por fecha);
+            # order_by()/exists() lo descartarían y harían 2 queries por pedido
+            historial = list(obj.historial_estados.all())
+            if historial:
                 lista = PedidoEstadoHistorialSerializer(historial, many=True).data
                 # Siempre incluir el estado inicial "Pendiente" si no está en el historial
                 primera_fecha = obj.created_at if obj.created_at else timezone.now()
@@ -1,3 +1,1506 @@
-from django.test import TestCase
+import asyncio
+import hashlib
+import io
+import json
+import os
+import smtplib
+import tempfile
+import threading
+import time
+import zlib
+from datetime import timedelta
+from unittest import mock
 
-# Create your tests here.
+from asgiref.sync import sync_to_async
+from botocore.response import StreamingBody
+from django.conf import settings
+from django.contrib.auth.hashers import make_password
+from django.core import mail
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from django_q.models import Schedule
+from rest_framework.test import APIClient
+from rest_framework_simplejwt.exceptions import InvalidToken
+
+from . import accesos, cache_archivos, eventos, limpieza, notifications, outbox, precios, preflight
+from .analisis import analizar
+from .planificacion import planificador
+from .authentication import CustomJWTAuthentication, UsuarioPrincipal, usuarios_cache, versiones_cache
+from .models import (Usuario, UsuarioTipo, Pedido, Producto, Impresion,
+                     PedidoProductoDetalle, PedidoImpresionDetalle, PedidoEstadoHistorial, SesionSubida, ArchivoBlob,
+                     NotificacionPendiente, TipoImpresion, ResultadoPreflight,
+                     LimpiezaAlmacenamiento, TicketEventos)
+from .pdf import contar_paginas
+from .views import CustomTokenObtainPairSerializer
+
+
+def crear_usuario(email, tipo):
+    return Usuario.objects.create(
+        email=email, contraseña=make_password('clave123'),
+        nombre='Test', apellido='Suchus', usuarioTipo=tipo
+    )
+
+
+def crear_tarifas():
+    TipoImpresion.objects.create(formato='A4', color=False, descripcion='A4 B/N', precio=50)
+    TipoImpresion.objects.create(formato='A4', color=True, descripcion='A4 color', precio=80)
+
+
+def cliente_autenticado(usuario):
+    client = APIClient()
+    token = CustomTokenObtainPairSerializer.get_token(usuario).access_token
+    client.credentials(HTTP_AUTHORIZATION=f'Bearer {token}')
+    return client
+
+
+class PedidoQueryBudgetTests(TestCase):
+    """Los listados de pedidos deben costar las mismas queries sin importar cuántos haya"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.tipo_cliente = UsuarioTipo.objects.create(descripcion='Cliente')
+        cls.tipo_admin = UsuarioTipo.objects.create(descripcion='Admin')
+        cls.cliente = crear_usuario('cliente@test.com', cls.tipo_cliente)
+        cls.admin = crear_usuario('admin@test.com', cls.tipo_admin)
+        cls.producto = Producto.objects.create(nombre='Anillado', descripcion='-', precioUnitario=100)
+
+    def setUp(self):
+        usuarios_cache.clear()
+
+    def crear_pedidos(self, cantidad):
+        for _ in range(cantidad):
+            pedido = Pedido.objects.create(fk_usuario=self.cliente, total=0)
+            PedidoProductoDetalle.objects.create(
+                fk_pedido=pedido, fk_producto=self.producto, cantidad=2, subtotal=200
+            )
+            for _ in range(2):
+                impresion = Impresion.objects.create(
+                    color=False, formato='A4', url='https://example.com/a.pdf',
+                    nombre_archivo='a.pdf', fk_usuario=self.cliente
+                )
+                PedidoImpresionDetalle.objects.create(
+                    fk_pedido=pedido, fk_impresion=impresion, cantidadCopias=1, subtotal=20
+                )
+            PedidoEstadoHistorial.objects.create(fk_pedido=pedido, estado='Pendiente')
+            PedidoEstadoHistorial.objects.create(fk_pedido=pedido, estado='En proceso')
+
+    def contar_queries(self, client, url):
+        usuarios_cache.clear()
+        with CaptureQueriesContext(connection) as queries:
+            response = client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return len(queries), response
+
+    def assert_queries_constantes(self, client, url):
+        self.crear_pedidos(1)
+        pocas, _ = self.contar_queries(client, url)
+        self.crear_pedidos(9)
+        muchas, response = self.contar_queries(client, url)
+        self.assertEqual(pocas, muchas)
+        return response
+
+    def test_list_admin(self):
+        response = self.assert_queries_constantes(cliente_autenticado(self.admin), '/api/pedidos/')
+        self.assertEqual(response.data['count'], 10)
+
+    def test_mis_pedidos(self):
+        response = self.assert_queries_constantes(
+            cliente_autenticado(self.cliente), '/api/pedidos/mis_pedidos/'
+        )
+        primero = response.data['results'][0]
+        self.assertEqual(len(primero['detalle_impresiones']), 2)
+        self.assertEqual(primero['detalles'][0]['fk_producto_nombre'], 'Anillado')
+        self.assertEqual([h['estado'] for h in primero['historial_estados']],
+                         ['Pendiente', 'En proceso'])
+
+    def test_retrieve(self):
+        client = cliente_autenticado(self.cliente)
+        self.crear_pedidos(1)
+        pedido = Pedido.objects.get()
+        pocas, _ = self.contar_queries(client, f'/api/pedidos/{pedido.id}/')
+        for _ in range(5):
+            impresion = Impresion.objects.create(color=True, formato='A3', url='u', fk_usuario=self.cliente)
+            PedidoImpresionDetalle.objects.create(
+                fk_pedido=pedido, fk_impresion=impresion, cantidadCopias=1, subtotal=60
+            )
+            PedidoEstadoHistorial.objects.create(fk_pedido=pedido, estado='Preparado')
+        muchas, response = self.contar_queries(client, f'/api/pedidos/{pedido.id}/')
+        self.assertEqual(pocas, muchas)
+        self.assertEqual(len(response.data['detalle_impresiones']), 7)
+
+
+class PaginacionCursorTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        tipo_admin = UsuarioTipo.objects.create(descripcion='Admin')
+        cls.admin = crear_usuario('admin@test.com', tipo_admin)
+        for i in range(5):
+            Pedido.objects.create(fk_usuario=cls.admin, total=i,
+                                  estado='Pendiente' if i % 2 else 'Preparado')
+
+    def test_recorre_paginas_conservando_filtros(self):
+        client = cliente_autenticado(self.admin)
+        response = client.get('/api/pedidos/?paginacion=cursor&page_size=1&estado=Pendiente')
+        ids = [p['id'] for p in response.data['results']]
+        self.assertNotIn('count', response.data)
+
+        siguiente = response.data['next']
+        self.assertIn('estado=Pendiente', siguiente)
+        ids += [p['id'] for p in client.get(siguiente).data['results']]
+
+        esperados = list(Pedido.objects.filter(estado='Pendiente').order_by('-id').values_list('id', flat=True))
+        self.assertEqual(ids, esperados)
+
+    def test_sin_parametro_usa_paginas_numeradas(self):
+        response = cliente_autenticado(self.admin).get('/api/pedidos/')
+        self.assertEqual(response.data['count'], 5)
+
+
+class AutenticacionTests(TestCase):
+    """Cache de usuarios del JWT y tokens con claims de rol"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.tipo_cliente = UsuarioTipo.objects.create(descripcion='Cliente', descuento=5)
+        cls.tipo_admin = UsuarioTipo.objects.create(descripcion='Admin')
+        cls.cliente = crear_usuario('cliente@test.com', cls.tipo_cliente)
+
+    def setUp(self):
+        usuarios_cache.clear()
+        versiones_cache.clear()
+        self.auth = CustomJWTAuthentication()
+
+    def token(self):
+        return CustomTokenObtainPairSerializer.get_token(self.cliente).access_token
+
+    def test_usuario_desactivado_deja_de_autenticar(self):
+        token = self.token()
+        self.auth.get_user(token)
+        with self.assertNumQueries(0):
+            self.auth.get_user(token)
+
+        usuario = Usuario.objects.get(pk=self.cliente.pk)
+        usuario.activo = False
+        usuario.save()
+        self.assertIsNone(usuarios_cache.get(self.cliente.pk))
+        with self.assertRaises(InvalidToken):
+            self.auth.get_user(token)
+
+    def test_cambio_de_tipo_invalida_la_cache(self):
+        token = self.token()
+        self.assertFalse(self.auth.get_user(token).es_admin())
+
+        usuario = Usuario.objects.get(pk=self.cliente.pk)
+        usuario.usuarioTipo = self.tipo_admin
+        usuario.save()
+        self.assertTrue(self.auth.get_user(token).es_admin())
+
+    def test_cambio_del_tipo_llega_a_los_usuarios_cacheados(self):
+        token = self.token()
+        self.assertEqual(self.auth.get_user(token).descuento, 5)
+        self.tipo_cliente.descuento = 15
+        self.tipo_cliente.save()
+        self.assertIsNone(usuarios_cache.get(self.cliente.pk))
+        self.assertEqual(self.auth.get_user(token).descuento, 15)
+
+    def test_la_instancia_cacheada_no_se_comparte(self):
+        token = self.token()
+        self.auth.get_user(token).nombre = 'Otro'
+        self.assertEqual(self.auth.get_user(token).nombre, 'Test')
+
+    @override_settings(JWT_CLAIMS_AUTH=True)
+    def test_token_con_claims_rechazado_al_subir_la_version(self):
+        token = self.token()
+        self.assertIsInstance(self.auth.get_user(token), UsuarioPrincipal)
+
+        # Guardar un tipo existente sube la versión de los tokens de sus usuarios
+        self.tipo_cliente.descuento = 20
+        self.tipo_cliente.save()
+        with self.assertRaises(InvalidToken):
+            self.auth.get_user(token)
+        response = cliente_autenticado(Usuario.objects.get(pk=self.cliente.pk)).get('/api/pedidos/mis_pedidos/')
+        self.assertEqual(response.status_code, 200)
+
+        client = APIClient()
+        client.credentials(HTTP_AUTHORIZATION=f'Bearer {token}')
+        self.assertEqual(client.get('/api/pedidos/mis_pedidos/').status_code, 401)
+
+    @override_settings(JWT_CLAIMS_AUTH=True)
+    def test_token_con_claims_de_usuario_desactivado(self):
+        token = self.token()
+        Usuario.objects.filter(pk=self.cliente.pk).update(activo=False)
+        versiones_cache.clear()
+        with self.assertRaises(InvalidToken):
+            self.auth.get_user(token)
+
+    @override_settings(JWT_CLAIMS_AUTH=True)
+    def test_principal_sale_de_los_claims_y_resuelve_el_resto(self):
+        token = self.token()
+        self.auth.get_user(token)
+        with self.assertNumQueries(0):
+            principal = self.auth.get_user(token)
+            self.assertTrue(principal.is_authenticated)
+            self.assertFalse(principal.is_anonymous)
+            self.assertFalse(principal.es_admin())
+            self.assertEqual((principal.id, principal.usuarioTipo_id, principal.descuento),
+                             (self.cliente.pk, self.tipo_cliente.pk, 5))
+
+        # Lo que no viaja en el token se lee una sola vez del Usuario real
+        with self.assertNumQueries(1):
+            self.assertEqual(principal.apellido, 'Suchus')
+            self.assertEqual(principal.usuarioTipo.descripcion, 'Cliente')
+        with self.assertRaises(AttributeError):
+            principal._privado
+
+    def test_sin_claims_auth_consulta_la_base(self):
+        with override_settings(JWT_CLAIMS_AUTH=True):
+            token = self.token()
+        self.assertIn('tv', token)
+        usuario = self.auth.get_user(token)
+        self.assertIsInstance(usuario, Usuario)
+        self.assertTrue(usuario.is_authenticated)
+        self.assertTrue(usuario.is_active)
+        self.assertNotIn('tipo_id', self.token())
+
+
+class PedidoResumenTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        tipo_cliente = UsuarioTipo.objects.create(descripcion='Cliente')
+        cls.cliente = crear_usuario('cliente@test.com', tipo_cliente)
+        producto = Producto.objects.create(nombre='Anillado', descripcion='-', precioUnitario=100)
+        for _ in range(3):
+            pedido = Pedido.objects.create(fk_usuario=cls.cliente, total=200)
+            PedidoProductoDetalle.objects.create(fk_pedido=pedido, fk_producto=producto,
+                                                 cantidad=2, subtotal=200)
+
+    def test_view_summary_sin_relaciones(self):
+        client = cliente_autenticado(self.cliente)
+        usuarios_cache.clear()
+        with CaptureQueriesContext(connection) as queries:
+            response = client.get('/api/pedidos/mis_pedidos/?view=summary')
+        # usuario + validadores del GET condicional + COUNT de la paginación + la página,
+        # sin prefetch de detalles
+        self.assertEqual(len(queries), 4)
+        fila = response.data['results'][0]
+        self.assertEqual(fila['usuario_nombre'], 'Test')
+        self.assertNotIn('detalles', fila)
+
+    def test_fields(self):
+        response = cliente_autenticado(self.cliente).get('/api/pedidos/?fields=estado,total')
+        self.assertEqual(set(response.data['results'][0]), {'id', 'estado', 'total'})
+
+    def test_fields_invalido(self):
+        response = cliente_autenticado(self.cliente).get('/api/pedidos/?fields=contraseña')
+        self.assertEqual(response.status_code, 400)
+
+    def test_get_condicional(self):
+        client = cliente_autenticado(self.cliente)
+        response = client.get('/api/pedidos/mis_pedidos/?view=summary')
+        etag = response['ETag']
+        self.assertEqual(client.get('/api/pedidos/mis_pedidos/?view=summary',
+                                    HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        # Otra vista u otra página tiene su propio validador
+        self.assertEqual(client.get('/api/pedidos/mis_pedidos/',
+                                    HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+        Pedido.objects.filter(fk_usuario=self.cliente).update(estado='Preparado', updated_at=timezone.now())
+        response = client.get('/api/pedidos/mis_pedidos/?view=summary', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+    def test_get_condicional_ve_el_preflight_de_las_impresiones(self):
+        pedido = Pedido.objects.filter(fk_usuario=self.cliente).first()
+        impresion = Impresion.objects.create(color=False, formato='A4', url='https://x/a.pdf',
+                                             fk_usuario=self.cliente, preflight_estado='Pendiente')
+        PedidoImpresionDetalle.objects.create(fk_pedido=pedido, fk_impresion=impresion,
+                                              cantidadCopias=1, subtotal=50)
+        client = cliente_autenticado(self.cliente)
+        for url in ('/api/pedidos/', '/api/pedidos/mis_pedidos/'):
+            etag = client.get(url)['ETag']
+            self.assertEqual(client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+
+            # El preflight solo toca la fila de la impresión
+            resultado = ResultadoPreflight.objects.create(sha256=url, paginas=3, formato='A4', color=False)
+            preflight.aplicar(Impresion.objects.get(pk=impresion.pk), resultado)
+            response = client.get(url, HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(response.status_code, 200)
+            fila = next(p for p in response.data['results'] if p['id'] == pedido.id)
+            self.assertEqual(fila['detalle_impresiones'][0]['fk_impresion_data']['paginas'], 3)
+            Impresion.objects.filter(pk=impresion.pk).update(paginas=None)
+
+        # Volver a encolar el preflight (ej: corrección del archivo) también invalida
+        etag = client.get('/api/pedidos/')['ETag']
+        with mock.patch('app.preflight.async_task'), self.captureOnCommitCallbacks(execute=True):
+            preflight.encolar_preflight([impresion.id])
+        self.assertEqual(client.get('/api/pedidos/', HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+
+class PedidoCreateTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        tipo = UsuarioTipo.objects.create(descripcion='Alumno', descuento=10)
+        cls.cliente = crear_usuario('alumno@test.com', tipo)
+        cls.productos = [
+            Producto.objects.create(nombre=f'P{i}', descripcion='-', precioUnitario=100)
+            for i in range(15)
+        ]
+        crear_tarifas()
+
+    def crear_pedido(self, productos, impresiones):
+        return cliente_autenticado(self.cliente).post('/api/pedidos/', {
+            'detalles': json.dumps([{'fk_producto': p.id, 'cantidad': 2} for p in productos]),
+            'impresiones': json.dumps([
+                {'nombre_archivo': f'{i}.pdf', 'formato': 'A4', 'color': 'bn', 'copias': 1, 'subtotal': 50}
+                for i in range(impresiones)
+            ]),
+        })
+
+    def test_queries_no_crecen_con_las_lineas(self):
+        usuarios_cache.clear()
+        precios.invalidar_precios()
+        with CaptureQueriesContext(connection) as pocas:
+            self.crear_pedido(self.productos[:1], 1)
+        usuarios_cache.clear()
+        precios.invalidar_precios()
+        with CaptureQueriesContext(connection) as muchas:
+            response = self.crear_pedido(self.productos, 15)
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(len(pocas), len(muchas))
+
+        pedido = Pedido.objects.get(pk=response.data['id'])
+        self.assertAlmostEqual(pedido.total, (15 * 200 + 15 * 50) * 0.9)
+        self.assertEqual(len(response.data['detalle_impresiones']), 15)
+
+    def test_precio_del_servidor_ignora_el_subtotal_del_cliente(self):
+        response = cliente_autenticado(self.cliente).post('/api/pedidos/', {
+            'impresiones': json.dumps([{'formato': 'A4', 'color': 'color', 'copias': 2, 'paginas': 3, 'subtotal': 1}]),
+        })
+        self.assertEqual(response.status_code, 201)
+        self.assertAlmostEqual(response.data['detalle_impresiones'][0]['subtotal'], 80 * 3 * 2)
+        self.assertAlmostEqual(response.data['total'], 80 * 3 * 2 * 0.9)
+
+    def test_pedido_del_admin_con_paginas_y_sin_archivo(self):
+        # Lo que arma PedidoAdmin.jsx: páginas contadas en el navegador, sin archivo ni precio
+        precios.invalidar_precios()
+        response = cliente_autenticado(self.cliente).post('/api/pedidos/', {
+            'impresiones': json.dumps([{'nombre_archivo': 'plano.pdf', 'paginas': 7, 'formato': 'A4',
+                                        'color': 'blanco y negro', 'copias': 2}]),
+        })
+        self.assertEqual(response.status_code, 201)
+        self.assertAlmostEqual(response.data['detalle_impresiones'][0]['subtotal'], 50 * 7 * 2)
+        self.assertAlmostEqual(Pedido.objects.get(pk=response.data['id']).total, 50 * 7 * 2 * 0.9)
+
+    def test_cotizar_y_tarifa_actualizada(self):
+        client = cliente_autenticado(self.cliente)
+        carrito = {'detalles': [{'fk_producto': self.productos[0].id, 'cantidad': 2}],
+                   'impresiones': [{'formato': 'A4', 'color': 'bn', 'copias': 1, 'paginas': 10}]}
+        response = client.post('/api/pedidos/cotizar/', carrito, format='json')
+        self.assertAlmostEqual(response.data['total'], (200 + 500) * 0.9)
+
+        tipo = TipoImpresion.objects.get(formato='A4', color=False)
+        tipo.precio = 60
+        tipo.save()
+        response = client.post('/api/pedidos/cotizar/', carrito, format='json')
+        self.assertAlmostEqual(response.data['total_bruto'], 200 + 600)
+
+        carrito['impresiones'][0]['formato'] = 'A0'
+        self.assertEqual(client.post('/api/pedidos/cotizar/', carrito, format='json').status_code, 400)
+
+    def test_producto_inexistente_no_crea_pedido(self):
+        response = cliente_autenticado(self.cliente).post('/api/pedidos/', {
+            'detalles': json.dumps([{'fk_producto': 999999, 'cantidad': 1}]),
+        })
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(Pedido.objects.exists())
+
+
+class StorageFalso:
+    """Reemplaza a Cloudinary en los tests: cada subida tarda un poco"""
+
+    def __init__(self, demora=0.2):
+        self.demora = demora
+        self.guardados = []
+        self.borrados = []
+        self._lock = threading.Lock()
+
+    def save(self, nombre, archivo):
+        time.sleep(self.demora)
+        with self._lock:
+            self.guardados.append(nombre)
+        return nombre
+
+    def url(self, nombre):
+        return f'https://cdn.test/{nombre}'
+
+    def delete(self, nombre):
+        self.borrados.append(nombre)
+
+
+class PedidoSubidaArchivosTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.cliente = crear_usuario('cliente@test.com', UsuarioTipo.objects.create(descripcion='Cliente'))
+        crear_tarifas()
+
+    def post_con_archivos(self, cantidad):
+        datos = {'impresiones': json.dumps([{'formato': 'A4', 'color': 'bn', 'subtotal': 10}] * cantidad)}
+        for i in range(cantidad):
+            datos[f'archivo_impresion_{i}'] = SimpleUploadedFile(f'{i}.pdf', f'%PDF-1.4 {i}'.encode(), 'application/pdf')
+        return cliente_autenticado(self.cliente).post('/api/pedidos/', datos)
+
+    def test_subidas_en_paralelo_antes_de_la_transaccion(self):
+        storage = StorageFalso(demora=0.2)
+        with mock.patch('app.almacenamiento.storage_cloudinary', return_value=storage):
+            inicio = time.monotonic()
+            response = self.post_con_archivos(6)
+            duracion = time.monotonic() - inicio
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(len(storage.guardados), 6)
+        self.assertLess(duracion, 6 * 0.2)
+        # El FileField guarda el path ya subido, sin una segunda subida al hacer el INSERT
+        impresion = Impresion.objects.first()
+        self.assertIn(impresion.archivo.name, storage.guardados)
+        self.assertEqual(impresion.url, f'https://cdn.test/{impresion.archivo.name}')
+
+    def test_limpia_archivos_si_falla_la_transaccion(self):
+        storage = StorageFalso(demora=0)
+        with mock.patch('app.almacenamiento.storage_cloudinary', return_value=storage), \
+                mock.patch.object(PedidoImpresionDetalle.objects, 'bulk_create', side_effect=RuntimeError('falla')):
+            response = self.post_con_archivos(3)
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(Pedido.objects.exists())
+        self.assertEqual(sorted(storage.borrados), sorted(storage.guardados))
+
+
+class DeduplicacionArchivosTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.cliente = crear_usuario('cliente@test.com', UsuarioTipo.objects.create(descripcion='Cliente'))
+        crear_tarifas()
+
+    def setUp(self):
+        self.storage = StorageFalso(demora=0)
+        patcher = mock.patch('app.almacenamiento.storage_cloudinary', return_value=self.storage)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def pedido_con(self, *contenidos):
+        datos = {'impresiones': json.dumps([{'formato': 'A4', 'color': 'bn', 'subtotal': 10}] * len(contenidos))}
+        for i, contenido in enumerate(contenidos):
+            datos[f'archivo_impresion_{i}'] = SimpleUploadedFile(f'apunte{i}.pdf', contenido, 'application/pdf')
+        response = cliente_autenticado(self.cliente).post('/api/pedidos/', datos)
+        self.assertEqual(response.status_code, 201)
+        return response
+
+    def test_mismo_contenido_se_sube_una_vez(self):
+        self.pedido_con(b'apunte', b'apunte', b'otro')
+        self.pedido_con(b'apunte')
+        self.assertEqual(len(self.storage.guardados), 2)
+
+        blob = ArchivoBlob.objects.get(sha256=hashlib.sha256(b'apunte').hexdigest())
+        self.assertEqual(blob.referencias, 3)
+        self.assertEqual(set(Impresion.objects.filter(fk_blob=blob).values_list('archivo', flat=True)), {blob.ruta})
+
+    def test_el_objeto_se_borra_con_la_ultima_referencia(self):
+        self.pedido_con(b'apunte', b'apunte')
+        primera, segunda = Impresion.objects.order_by('id')
+        with self.captureOnCommitCallbacks(execute=True):
+            primera.delete()
+        self.assertEqual(self.storage.borrados, [])
+        self.assertEqual(ArchivoBlob.objects.get().referencias, 1)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            segunda.delete()
+        self.assertEqual(self.storage.borrados, [segunda.archivo.name])
+        self.assertFalse(ArchivoBlob.objects.exists())
+
+
+def pdf_de_prueba(paginas, comprimido=False, relleno=0, medidas=(595, 842), contenido=None, imagen=None):
+    """
+    PDF mínimo con N páginas. comprimido=True guarda el árbol de páginas en un
+    object stream con xref stream (PDF 1.5); relleno agrega un stream de ese tamaño.
+    medidas (en puntos, A4 por defecto) se heredan del árbol; contenido es el
+    stream de contenido compartido por todas las páginas. imagen: diccionario de
+    un XObject imagen en los recursos del árbol (solo sin comprimir).
+    """
+    kids = ' '.join(f'{3 + i} 0 R' for i in range(paginas))
+    recursos = b' /Resources << /XObject << /Im0 %d 0 R >> >>' % (4 + paginas) if imagen else b''
+    objetos = {1: b'<< /Type /Catalog /Pages 2 0 R >>',
+               2: f'<< /Type /Pages /Kids [{kids}] /Count {paginas} /MediaBox [0 0 {medidas[0]} {medidas[1]}]'.encode()
+               + recursos + b' >>'}
+    for i in range(paginas):
+        objetos[3 + i] = b'<< /Type /Page /Parent 2 0 R /Contents %d 0 R >>' % (3 + paginas)
+    contenido = b'0' * relleno if contenido is None else contenido
+    salida = io.BytesIO()
+    salida.write(b'%PDF-1.5\n')
+    offsets = {}
+
+    def escribir(numero, cuerpo):
+        offsets[numero] = salida.tell()
+        salida.write(b'%d 0 obj\n' % numero + cuerpo + b'\nendobj\n')
+
+    escribir(1, objetos.pop(1))
+    escribir(3 + paginas, b'<< /Length %d >>\nstream\n' % len(contenido) + contenido + b'\nendstream')
+    if not comprimido:
+        for numero, cuerpo in objetos.items():
+            escribir(numero, cuerpo)
+        total = 4 + paginas
+        if imagen:
+            # Bytes de un JPEG (no se decodifican)
+            datos = b'\xff\xd8\xff\xe0' + b'\x00' * 60 + b'\xff\xd9'
+            escribir(total, b'<< /Type /XObject /Subtype /Image /Width 8 /Height 8 ' + imagen
+                     + b' /Length %d >>\nstream\n' % len(datos) + datos + b'\nendstream')
+            total += 1
+        inicio_xref = salida.tell()
+        salida.write(b'xref\n0 %d\n0000000000 65535 f \n' % total)
+        for numero in range(1, total):
+            salida.write(b'%010d 00000 n \n' % offsets[numero])
+        salida.write(b'trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n' % (total, inicio_xref))
+        return salida.getvalue()
+    # Object stream con las páginas y xref stream con predictor PNG (Up)
+    numero_stm = 4 + paginas
+    cabecera, cuerpo = [], b''
+    for numero, texto in objetos.items():
+        cabecera.append(b'%d %d' % (numero, len(cuerpo)))
+        cuerpo += texto + b' '
+    cabecera = b' '.join(cabecera) + b' '
+    datos = zlib.compress(cabecera + cuerpo)
+    escribir(numero_stm, b'<< /Type /ObjStm /N %d /First %d /Filter /FlateDecode /Length %d >>\nstream\n'
+             % (len(objetos), len(cabecera), len(datos)) + datos + b'\nendstream')
+    total = numero_stm + 2
+    offsets[total - 1] = salida.tell()
+    filas = [bytes([0, 0, 0, 0, 0, 0xFF, 0xFF])]
+    indices = {numero: i for i, numero in enumerate(objetos)}
+    for numero in range(1, total):
+        if numero in indices:
+            filas.append(bytes([2]) + numero_stm.to_bytes(4, 'big') + indices[numero].to_bytes(2, 'big'))
+        else:
+            filas.append(bytes([1]) + offsets[numero].to_bytes(4, 'big') + bytes(2))
+    crudo, anterior = b'', bytes(7)
+    for fila in filas:
+        crudo += b'\x02' + bytes((a - b) & 0xFF for a, b in zip(fila, anterior))
+        anterior = fila
+    datos = zlib.compress(crudo)
+    salida.write(b'%d 0 obj\n<< /Type /XRef /Size %d /W [1 4 2] /Root 1 0 R /Filter /FlateDecode '
+                 b'/DecodeParms << /Columns 7 /Predictor 12 >> /Length %d >>\nstream\n'
+                 % (total - 1, total, len(datos)) + datos + b'\nendstream\nendobj\n')
+    salida.write(b'startxref\n%d\n%%%%EOF\n' % offsets[total - 1])
+    return salida.getvalue()
+
+
+def cliente_s3_local():
+    """Cliente contra un S3 local; los tests lo envuelven con un Stubber de botocore"""
+    import boto3
+    return boto3.client('s3', endpoint_url='http://localhost:9000', region_name='us-east-1',
+                        aws_access_key_id='test', aws_secret_access_key='test')
+
+
+class ClienteR2Tests(TestCase):
+
+    def test_un_cliente_por_proceso(self):
+        from . import almacenamiento
+        almacenamiento._olvidar_clientes()
+        s3, _ = almacenamiento.cliente_r2()
+        self.assertIs(almacenamiento.cliente_r2()[0], s3)
+        self.assertEqual(s3.meta.config.max_pool_connections, settings.R2_CLIENTE['MAX_CONEXIONES'])
+        # Lo que corre después de un fork arma su propio cliente
+        almacenamiento._olvidar_clientes()
+        self.assertIsNot(almacenamiento.cliente_r2()[0], s3)
+
+
+@override_settings(ACCESOS={'INTERVALO': 0, 'LOTE': 2, 'MAX_PENDIENTES': 100})
+class AccesosAgrupadosTests(TestCase):
+
+    def test_un_update_por_lote_y_sin_retroceder(self):
+        hace_un_rato = timezone.now() - timedelta(hours=1)
+        impresiones = [Impresion.objects.create(color=False, url='x') for _ in range(3)]
+        Impresion.objects.update(last_accessed=hace_un_rato)
+        usuario = crear_usuario('cliente@test.com', UsuarioTipo.objects.create(descripcion='Cliente'))
+        cliente = cliente_autenticado(usuario)
+        usuarios_cache.clear()
+        cliente.patch(f'/api/impresiones/{impresiones[0].id}/actualizar_acceso/')  # cachea al usuario
+        for impresion in impresiones * 2:
+            with self.assertNumQueries(1):  # solo el get_object, ningún UPDATE
+                self.assertEqual(cliente.patch(f'/api/impresiones/{impresion.id}/actualizar_acceso/').status_code, 200)
+        self.assertEqual(Impresion.objects.filter(last_accessed=hace_un_rato).count(), 3)
+
+        # Un acceso más viejo que el guardado no lo pisa
+        nuevo = timezone.now() + timedelta(minutes=5)
+        Impresion.objects.filter(pk=impresiones[0].pk).update(last_accessed=nuevo)
+        with self.assertNumQueries(2):  # 3 accesos en lotes de 2
+            self.assertEqual(accesos.volcar_accesos(), 3)
+        self.assertEqual(Impresion.objects.get(pk=impresiones[0].pk).last_accessed, nuevo)
+        self.assertFalse(Impresion.objects.filter(last_accessed=hace_un_rato).exists())
+
+
+
+class CacheArchivosTests(TestCase):
+
+    def setUp(self):
+        carpeta = tempfile.TemporaryDirectory()
+        self.addCleanup(carpeta.cleanup)
+        ajustes = override_settings(CACHE_ARCHIVOS={**settings.CACHE_ARCHIVOS, 'DIRECTORIO': carpeta.name,
+                                                    'MAX_BYTES': 25, 'SENDFILE': ''})
+        ajustes.enable()
+        self.addCleanup(ajustes.disable)
+        cache_archivos._cache = None
+        self.addCleanup(setattr, cache_archivos, '_cache', None)
+        self.contenido = bytes(range(20))
+        patcher = mock.patch('app.cache_archivos.bloques_archivo',
+                             side_effect=lambda impresion: iter([self.contenido[:8], self.contenido[8:]]))
+        self.bloques = patcher.start()
+        self.addCleanup(patcher.stop)
+        usuario = crear_usuario('cliente@test.com', UsuarioTipo.objects.create(descripcion='Cliente'))
+        self.cliente = cliente_autenticado(usuario)
+
+    def test_descarga_una_vez_y_sirve_rangos(self):
+        impresion = Impresion.objects.create(color=False, url='https://x/a.pdf', nombre_archivo='a.pdf')
+        url = f'/api/impresiones/{impresion.id}/descargar/'
+        respuesta = self.cliente.get(url)
+        self.assertEqual(respuesta.status_code, 200)
+        self.assertEqual(b''.join(respuesta.streaming_content), self.contenido)
+        self.assertEqual(respuesta['Accept-Ranges'], 'bytes')
+
+        respuesta = self.cliente.get(url, HTTP_RANGE='bytes=5-9')
+        self.assertEqual(respuesta.status_code, 206)
+        self.assertEqual(respuesta['Content-Range'], 'bytes 5-9/20')
+        self.assertEqual(b''.join(respuesta.streaming_content), self.contenido[5:10])
+        respuesta = self.cliente.get(url, HTTP_RANGE='bytes=-3')
+        self.assertEqual(b''.join(respuesta.streaming_content), self.contenido[-3:])
+        self.assertEqual(self.cliente.get(url, HTTP_RANGE='bytes=50-').status_code, 416)
+        # If-Range con otro ETag: el archivo cambió, va entero
+        self.assertEqual(self.cliente.get(url, HTTP_RANGE='bytes=5-9', HTTP_IF_RANGE='"otro"').status_code, 200)
+        self.assertEqual(self.bloques.call_count, 1)
+
+    def test_asgi_entrega_por_bloques_sin_cargar_el_archivo(self):
+        impresion = Impresion.objects.create(color=False, url='https://x/a.pdf')
+        ruta = cache_archivos.cache_archivos().obtener(impresion)
+        request = mock.Mock(META={}, headers={'Range': 'bytes=2-'})   # sin wsgi.*: ASGI
+
+        async def leer(respuesta):
+            return [bloque async for bloque in respuesta]
+
+        with mock.patch('app.cache_archivos.BLOQUE_LECTURA', 5):
+            respuesta = cache_archivos.servir(request, ruta, 'a.pdf', '"e"')
+            self.assertTrue(respuesta.is_async)
+            bloques = asyncio.run(leer(respuesta))
+        self.assertEqual(respuesta.status_code, 206)
+        self.assertEqual([len(b) for b in bloques], [5, 5, 5, 3])
+        self.assertEqual(b''.join(bloques), self.contenido[2:])
+
+    def test_desalojado_antes_de_abrir_se_vuelve_a_bajar(self):
+        impresion = Impresion.objects.create(color=False, url='https://x/a.pdf')
+        obtener = cache_archivos.CacheDisco.obtener
+        desalojos = []
+
+        def obtener_y_desalojar(cache, imp):
+            ruta = obtener(cache, imp)
+            if not desalojos:
+                desalojos.append(ruta)
+                os.unlink(ruta)
+            return ruta
+
+        with mock.patch.object(cache_archivos.CacheDisco, 'obtener', obtener_y_desalojar):
+            respuesta = self.cliente.get(f'/api/impresiones/{impresion.id}/descargar/')
+        self.assertEqual(respuesta.status_code, 200)
+        self.assertEqual(b''.join(respuesta.streaming_content), self.contenido)
+        self.assertEqual(self.bloques.call_count, 2)
+
+    def test_desaloja_el_menos_usado(self):
+        viejo, nuevo = (Impresion.objects.create(color=False, url=f'https://x/{n}.pdf') for n in 'ab')
+        cache = cache_archivos.cache_archivos()
+        ruta_vieja = cache.obtener(viejo)
+        os.utime(ruta_vieja, (1, 1))
+        cache.obtener(nuevo)
+        # 40 bytes con un máximo de 25: se va el de uso más antiguo
+        self.assertFalse(cache.contiene(viejo))
+        self.assertTrue(cache.contiene(nuevo))
+
+
+@override_settings(LIMPIEZA={**settings.LIMPIEZA, 'LOTE': 2, 'REINTENTOS': 2})
+class LimpiezaAlmacenamientoTests(TestCase):
+
+    def setUp(self):
+        from botocore.stub import ANY, Stubber
+        self.s3 = cliente_s3_local()
+        self.stubber = Stubber(self.s3)
+        self.stubber.activate()
+        self.addCleanup(self.stubber.deactivate)
+        self.ANY = ANY
+        patcher = mock.patch('app.almacenamiento.cliente_r2', return_value=(self.s3, 'bucket-test'))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def impresion(self, clave=None, blob=None, vieja=True):
+        impresion = Impresion.objects.create(color=False, url='x', cloudflare_key=clave, fk_blob=blob)
+        if vieja:
+            Impresion.objects.filter(pk=impresion.pk).update(last_accessed=timezone.now() - timedelta(days=90))
+        return impresion
+
+    def ejecutar_cadena(self, limpieza_id):
+        """Corre las tareas encadenadas como el cluster. Devuelve cuántas fueron."""
+        tareas = [(limpieza_id, None)]
+        corridas = 0
+        with mock.patch('app.limpieza.async_task') as async_task:
+            while tareas and corridas < 20:
+                async_task.reset_mock()
+                limpieza.ejecutar_limpieza(*tareas.pop(0))
+                corridas += 1
+                tareas += [llamada.args[1:] for llamada in async_task.call_args_list]
+        return corridas
+
+    def borrado(self, claves, errores=()):
+        self.stubber.add_response('delete_objects', {'Errors': [
+            {'Key': clave, 'Code': 'AccessDenied', 'Message': 'denegado'} for clave in errores]}, {
+            'Bucket': 'bucket-test', 'Delete': {'Objects': [{'Key': c} for c in claves], 'Quiet': True}})
+
+    def test_borra_por_lotes_y_reintenta_lo_que_fallo(self):
+        compartido = ArchivoBlob.objects.create(sha256='x', backend='r2', ruta='blobs/x.pdf', url='u', referencias=2)
+        en_uso = ArchivoBlob.objects.create(sha256='y', backend='r2', ruta='blobs/y.pdf', url='u', referencias=2)
+        self.impresion('viejo/a.pdf')
+        self.impresion('viejo/b.pdf')
+        self.impresion(blob=compartido)
+        self.impresion(blob=compartido)
+        self.impresion(blob=en_uso)
+        reciente = self.impresion(blob=en_uso, vieja=False)
+
+        # Un DeleteObjects por lote con objetos a borrar; el blob que sigue en uso no se toca.
+        # Lo que falla se reintenta al terminar el recorrido.
+        self.stubber.add_response('delete_objects', {'Errors': [
+            {'Key': 'viejo/b.pdf', 'Code': 'AccessDenied', 'Message': 'denegado'}]},
+            {'Bucket': 'bucket-test', 'Delete': self.ANY})
+        self.borrado(['blobs/x.pdf'])
+        self.borrado(['viejo/b.pdf'])
+
+        with mock.patch('app.limpieza.async_task') as tarea, self.captureOnCommitCallbacks(execute=True):
+            response = cliente_autenticado(crear_usuario('admin@test.com', UsuarioTipo.objects.create(
+                descripcion='Admin'))).post('/api/impresiones/limpiar_antiguos/', {'dias': 30}, format='json')
+        self.assertEqual(response.status_code, 202)
+        tarea.assert_called_once()
+        # 3 lotes, el recorrido vacío que reintenta y el cierre: una tarea cada uno
+        self.assertEqual(self.ejecutar_cadena(response.data['id']), 5)
+        self.stubber.assert_no_pending_responses()
+
+        trabajo = LimpiezaAlmacenamiento.objects.get()
+        self.assertEqual((trabajo.estado, trabajo.eliminadas, trabajo.fallidas, trabajo.pendientes),
+                         ('Completada', 5, 0, []))
+        self.assertIn('AccessDenied', trabajo.errores[0])
+        self.assertEqual(set(Impresion.objects.values_list('id', flat=True)), {reciente.id})
+        self.assertFalse(ArchivoBlob.objects.filter(pk=compartido.pk).exists())
+        self.assertEqual(ArchivoBlob.objects.get(pk=en_uso.pk).referencias, 1)
+
+        # Retomar un trabajo terminado no hace nada
+        self.assertIsNone(limpieza.ejecutar_limpieza(trabajo.id))
+
+    def test_objetos_que_siguen_fallando_quedan_anotados(self):
+        self.impresion('viejo/a.pdf')
+        self.borrado(['viejo/a.pdf'], errores=['viejo/a.pdf'])
+        # Dos vueltas sin avance (REINTENTOS) y se cierra sin perder la clave
+        self.borrado(['viejo/a.pdf'], errores=['viejo/a.pdf'])
+        self.borrado(['viejo/a.pdf'], errores=['viejo/a.pdf'])
+        trabajo = limpieza.iniciar_limpieza(30)
+        self.ejecutar_cadena(trabajo.id)
+        self.stubber.assert_no_pending_responses()
+        trabajo.refresh_from_db()
+        self.assertEqual((trabajo.estado, trabajo.fallidas, trabajo.pendientes),
+                         ('Completada', 1, [['r2', 'viejo/a.pdf']]))
+
+    def test_una_sola_tarea_por_trabajo_y_barrido_agendado(self):
+        trabajo = limpieza.iniciar_limpieza(30)
+        self.assertIsNotNone(limpieza.reservar(trabajo.id))
+        # Otra tarea (ej: un reenvío del barrido) no lo toma mientras el lease esté vigente
+        self.assertIsNone(limpieza.reservar(trabajo.id))
+        self.assertIsNone(limpieza.reservar(trabajo.id, paso=0))
+        self.assertIsNotNone(limpieza.reservar(trabajo.id, paso=1))
+        self.assertEqual(Schedule.objects.get(name='reanudar-limpiezas').func, 'app.limpieza.reanudar_limpiezas')
+
+    @override_settings(JWT_CLAIMS_AUTH=True)
+    def test_con_usuario_de_los_claims_del_token(self):
+        admin = crear_usuario('admin@test.com', UsuarioTipo.objects.create(descripcion='Admin'))
+        with mock.patch('app.limpieza.async_task'), self.captureOnCommitCallbacks(execute=True):
+            response = cliente_autenticado(admin).post('/api/impresiones/limpiar_antiguos/', {'dias': 30},
+                                                       format='json')
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(LimpiezaAlmacenamiento.objects.get().fk_usuario_id, admin.id)
+
+
+@override_settings(SUBIDA_DIRECTA={'EXPIRACION': 600, 'UMBRAL_MULTIPART': 10, 'BYTES_PARTE': 4})
+class SubidaDirectaTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        tipo = UsuarioTipo.objects.create(descripcion='Cliente')
+        cls.cliente = crear_usuario('cliente@test.com', tipo)
+        cls.otro = crear_usuario('otro@test.com', tipo)
+
+    def setUp(self):
+        from botocore.stub import Stubber
+        self.s3 = cliente_s3_local()
+        self.stubber = Stubber(self.s3)
+        self.stubber.activate()
+        patcher = mock.patch('app.views.cliente_r2', return_value=(self.s3, 'bucket-test'))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_put_prefirmado_y_completar(self):
+        client = cliente_autenticado(self.cliente)
+        response = client.post('/api/impresiones/solicitar_subida/',
+                               {'nombre_archivo': 'plano.pdf', 'tamanio': 8}, format='json')
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.data['metodo'], 'PUT')
+        self.assertIn('bucket-test', response.data['url'])
+        self.assertIn('Signature', response.data['url'])
+
+        key = response.data['cloudflare_key']
+        contenido = pdf_de_prueba(4)
+        self.stubber.add_response('head_object', {'ContentLength': len(contenido)},
+                                  {'Bucket': 'bucket-test', 'Key': key})
+        # Las páginas se cuentan leyendo el objeto por rangos
+        self.stubber.add_response('get_object', {'Body': StreamingBody(io.BytesIO(contenido), len(contenido))},
+                                  {'Bucket': 'bucket-test', 'Key': key, 'Range': f'bytes=0-{len(contenido) - 1}'})
+        response = client.post('/api/impresiones/completar_subida/', {
+            'token_subida': response.data['token_subida'], 'formato': 'A3', 'color': 'true',
+        }, format='json')
+        self.assertEqual(response.status_code, 201)
+        impresion = Impresion.objects.get(cloudflare_key=key)
+        self.assertEqual((impresion.formato, impresion.color, impresion.fk_usuario_id, impresion.paginas),
+                         ('A3', True, self.cliente.id, 4))
+
+    def test_multipart_para_archivos_grandes(self):
+        self.stubber.add_response('create_multipart_upload', {'UploadId': 'up-1'})
+        response = cliente_autenticado(self.cliente).post(
+            '/api/impresiones/solicitar_subida/', {'nombre_archivo': 'a0.pdf', 'tamanio': 11}, format='json'
+        )
+        self.assertEqual(response.data['metodo'], 'MULTIPART')
+        self.assertEqual([p['numero'] for p in response.data['partes']], [1, 2, 3])
+
+        key = response.data['cloudflare_key']
+        self.stubber.add_response('complete_multipart_upload', {}, {
+            'Bucket': 'bucket-test', 'Key': key, 'UploadId': 'up-1',
+            'MultipartUpload': {'Parts': [{'PartNumber': 1, 'ETag': '"a"'}, {'PartNumber': 2, 'ETag': '"b"'},
+                                          {'PartNumber': 3, 'ETag': '"c"'}]},
+        })
+        self.stubber.add_response('head_object', {'ContentLength': 12})
+        self.stubber.add_response('get_object', {'Body': StreamingBody(io.BytesIO(b'no es un pdf'), 12)})
+        response = cliente_autenticado(self.cliente).post('/api/impresiones/completar_subida/', {
+            'token_subida': response.data['token_subida'],
+            'partes': [{'numero': 3, 'etag': '"c"'}, {'numero': 1, 'etag': '"a"'}, {'numero': 2, 'etag': '"b"'}],
+        }, format='json')
+        self.assertEqual(response.status_code, 201)
+        self.stubber.assert_no_pending_responses()
+
+    def test_no_acepta_token_de_otro_usuario(self):
+        response = cliente_autenticado(self.cliente).post(
+            '/api/impresiones/solicitar_subida/', {'nombre_archivo': 'a.pdf', 'tamanio': 1}, format='json'
+        )
+        response = cliente_autenticado(self.otro).post(
+            '/api/impresiones/completar_subida/', {'token_subida': response.data['token_subida']}, format='json'
+        )
+        self.assertEqual(response.status_code, 403)
+        self.assertFalse(Impresion.objects.exists())
+
+
+@override_settings(SUBIDA_PARTES={'BYTES_PARTE': 4, 'TAMANIO_MAXIMO': 100, 'VIGENCIA_HORAS': 48})
+class SubidaPorPartesTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        tipo = UsuarioTipo.objects.create(descripcion='Cliente')
+        cls.cliente = crear_usuario('cliente@test.com', tipo)
+        cls.otro = crear_usuario('otro@test.com', tipo)
+
+    def setUp(self):
+        from botocore.stub import Stubber
+        self.s3 = cliente_s3_local()
+        self.stubber = Stubber(self.s3)
+        self.stubber.activate()
+        patcher = mock.patch('app.views.cliente_r2', return_value=(self.s3, 'bucket-test'))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.client = cliente_autenticado(self.cliente)
+
+    def abrir_sesion(self, tamanio=10):
+        self.stubber.add_response('create_multipart_upload', {'UploadId': 'up-1'})
+        response = self.client.post('/api/subidas/', {
+            'nombre_archivo': 'a0.pdf', 'tamanio': tamanio, 'formato': 'A3', 'color': 'true'
+        }, format='json')
+        self.assertEqual(response.status_code, 201)
+        return response.data
+
+    def subir(self, sesion_id, numero, datos, checksum=None):
+        return self.client.generic(
+            'PUT', f'/api/subidas/{sesion_id}/partes/{numero}/', datos,
+            content_type='application/octet-stream',
+            HTTP_X_CHECKSUM_SHA256=checksum or hashlib.sha256(datos).hexdigest(),
+        )
+
+    def test_subida_reanudable_completa(self):
+        sesion = self.abrir_sesion()
+        self.assertEqual(sesion['cantidad_partes'], 3)
+
+        # Partes 1 y 3 llegan; la 2 se "corta": el estado indica desde dónde seguir
+        for numero, datos in ((1, b'abcd'), (3, b'ij')):
+            self.stubber.add_response('upload_part', {'ETag': f'"e{numero}"'})
+            self.assertEqual(self.subir(sesion['id'], numero, datos).status_code, 200)
+        estado = self.client.get(f"/api/subidas/{sesion['id']}/").data
+        self.assertEqual((estado['offset'], estado['partes_faltantes']), (4, [2]))
+
+        # Completar antes de tiempo no crea nada
+        self.assertEqual(self.client.post(f"/api/subidas/{sesion['id']}/completar/").status_code, 409)
+        self.assertFalse(Impresion.objects.exists())
+
+        # Reenviar una parte ya confirmada no vuelve a subirla
+        self.assertEqual(self.subir(sesion['id'], 1, b'abcd').status_code, 200)
+        self.stubber.add_response('upload_part', {'ETag': '"e2"'})
+        self.assertEqual(self.subir(sesion['id'], 2, b'efgh').data['offset'], 10)
+
+        self.stubber.add_response('complete_multipart_upload', {}, {
+            'Bucket': 'bucket-test', 'Key': SesionSubida.objects.get().cloudflare_key, 'UploadId': 'up-1',
+            'MultipartUpload': {'Parts': [{'PartNumber': 1, 'ETag': '"e1"'}, {'PartNumber': 2, 'ETag': '"e2"'},
+                                          {'PartNumber': 3, 'ETag': '"e3"'}]},
+        })
+        self.stubber.add_response('get_object', {'Body': StreamingBody(io.BytesIO(b'abcdefghij'), 10)})
+        response = self.client.post(f"/api/subidas/{sesion['id']}/completar/")
+        self.assertEqual(response.status_code, 201)
+        impresion = Impresion.objects.get()
+        self.assertEqual((impresion.formato, impresion.color, impresion.fk_usuario_id), ('A3', True, self.cliente.id))
+        self.assertEqual(response.data['impresion']['id'], impresion.id)
+        self.stubber.assert_no_pending_responses()
+
+    def test_rechaza_parte_corrupta_o_de_otro_tamanio(self):
+        sesion = self.abrir_sesion()
+        self.assertEqual(self.subir(sesion['id'], 1, b'abcd', checksum='0' * 64).status_code, 422)
+        self.assertEqual(self.subir(sesion['id'], 1, b'abc').status_code, 400)
+        self.assertEqual(self.subir(sesion['id'], 4, b'ab').status_code, 400)
+        self.assertEqual(SesionSubida.objects.get().partes, {})
+
+    def test_sesion_de_otro_usuario(self):
+        sesion = self.abrir_sesion()
+        response = cliente_autenticado(self.otro).get(f"/api/subidas/{sesion['id']}/")
+        self.assertEqual(response.status_code, 404)
+
+
+class NotificacionOutboxTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.admin = crear_usuario('admin@test.com', UsuarioTipo.objects.create(descripcion='Admin'))
+        cls.cliente = crear_usuario('cliente@test.com', UsuarioTipo.objects.create(descripcion='Cliente'))
+
+    def setUp(self):
+        self.pedido = Pedido.objects.create(fk_usuario=self.cliente, total=100, estado='Pendiente')
+
+    def test_cambiar_estado_no_envia_en_el_request(self):
+        with mock.patch('app.outbox.async_task') as async_task, \
+                self.captureOnCommitCallbacks(execute=True):
+            response = cliente_autenticado(self.admin).patch(
+                f'/api/pedidos/{self.pedido.id}/cambiar_estado/', {'estado': 'Preparado'}, format='json'
+            )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(mail.outbox), 0)
+        notificacion = NotificacionPendiente.objects.get()
+        self.assertEqual((notificacion.estado_pedido, notificacion.estado), ('Preparado', 'Pendiente'))
+        async_task.assert_called_once_with('app.outbox.procesar_notificaciones', [notificacion.id],
+                                           task_name=mock.ANY)
+
+    def test_el_cluster_envia_y_reintenta_con_backoff(self):
+        fallida = NotificacionPendiente.objects.create(fk_pedido=self.pedido, estado_pedido='Cancelado')
+        enviada = NotificacionPendiente.objects.create(fk_pedido=self.pedido, estado_pedido='Preparado')
+        envio_real = notifications._enviar_uno
+
+        def envio(mensaje):
+            if 'Cancelado' in mensaje.subject:
+                raise ConnectionError('SMTP caído')
+            return envio_real(mensaje)
+
+        with mock.patch('app.notifications._enviar_uno', side_effect=envio), \
+                mock.patch('app.outbox.schedule') as schedule:
+            self.assertEqual(outbox.procesar_notificaciones([fallida.id, enviada.id]), 1)
+
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertIn('Preparado', mail.outbox[0].subject)
+        enviada.refresh_from_db()
+        self.assertEqual(enviada.estado, 'Enviada')
+        fallida.refresh_from_db()
+        self.assertEqual((fallida.estado, fallida.intentos, fallida.ultimo_error), ('Pendiente', 1, 'SMTP caído'))
+        self.assertEqual(schedule.call_args.kwargs['next_run'], fallida.proximo_intento)
+        # La reprogramada no se vuelve a tomar antes de tiempo
+        self.assertFalse(outbox.reservar(fallida.id))
+
+    def test_barrido_agendado_toma_las_pendientes_vencidas(self):
+        agenda = Schedule.objects.get(name='reintentar-notificaciones')
+        self.assertEqual((agenda.func, agenda.schedule_type), ('app.outbox.reintentar_pendientes', Schedule.MINUTES))
+        # El broker no respondió al confirmar: la fila quedó pendiente sin tarea
+        with mock.patch('app.outbox.async_task', side_effect=ConnectionError('broker caído')), \
+                self.captureOnCommitCallbacks(execute=True):
+            outbox.encolar_notificacion(Pedido(pk=self.pedido.pk, estado='Preparado'))
+        varada = NotificacionPendiente.objects.get()
+        futura = NotificacionPendiente.objects.create(fk_pedido=self.pedido, estado_pedido='Cancelado',
+                                                      proximo_intento=timezone.now() + timedelta(hours=1))
+        self.assertEqual(outbox.reintentar_pendientes(), 1)
+        self.assertEqual(NotificacionPendiente.objects.get(pk=varada.pk).estado, 'Enviada')
+        self.assertEqual(NotificacionPendiente.objects.get(pk=futura.pk).estado, 'Pendiente')
+
+    def test_cada_envio_se_registra_al_volver(self):
+        notificaciones = [NotificacionPendiente.objects.create(fk_pedido=self.pedido, estado_pedido=estado)
+                          for estado in ('Preparado', 'Cancelado')]
+        envio_real = notifications._enviar_uno
+
+        class WorkerTerminado(BaseException):
+            pass
+
+        def envio(mensaje):
+            if 'Cancelado' in mensaje.subject:
+                raise WorkerTerminado()   # el cluster mata la tarea a mitad del lote
+            return envio_real(mensaje)
+
+        with mock.patch('app.notifications._enviar_uno', side_effect=envio), self.assertRaises(WorkerTerminado):
+            outbox.procesar_notificaciones([n.id for n in notificaciones])
+        # La que ya salió no vuelve a quedar pendiente
+        self.assertEqual(NotificacionPendiente.objects.get(pk=notificaciones[0].pk).estado, 'Enviada')
+        self.assertEqual(NotificacionPendiente.objects.get(pk=notificaciones[1].pk).estado, 'Pendiente')
+
+    @override_settings(NOTIFICACIONES={**settings.NOTIFICACIONES, 'ENVIOS_POR_SEGUNDO': 0.1})
+    def test_despacho_en_tareas_que_entran_en_el_timeout(self):
+        por_tarea = int(0.1 * (settings.Q_CLUSTER['timeout'] - outbox.MARGEN_TAREA))
+        ids = list(range(1, 2 * por_tarea + 2))
+        with mock.patch('app.outbox.async_task') as async_task:
+            outbox.despachar(ids)
+        self.assertEqual([c.args[1] for c in async_task.call_args_list],
+                         [ids[:por_tarea], ids[por_tarea:2 * por_tarea], ids[2 * por_tarea:]])
+        self.assertGreater(settings.NOTIFICACIONES['LEASE'], settings.Q_CLUSTER['timeout'])
+
+
+class EnvioPorLotesTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cliente = crear_usuario('cliente@test.com', UsuarioTipo.objects.create(descripcion='Cliente'))
+        cls.pedidos = [Pedido.objects.create(fk_usuario=cliente, total=10, estado='Preparado') for _ in range(5)]
+
+    def setUp(self):
+        notifications.cerrar_conexion()
+        self.addCleanup(notifications.cerrar_conexion)
+
+    @override_settings(NOTIFICACIONES={'LOTE': 2, 'ENVIOS_POR_SEGUNDO': 50, 'CONEXION_MAX_IDLE': 60})
+    def test_una_conexion_para_todo_el_lote(self):
+        mensajes = [notifications.construir_email_cambio_estado(p) for p in self.pedidos]
+        with mock.patch('app.notifications.get_connection', wraps=notifications.get_connection) as conexiones:
+            inicio = time.monotonic()
+            resultados = notifications.enviar_lote(mensajes)
+            duracion = time.monotonic() - inicio
+        self.assertEqual(resultados, [(True, None)] * 5)
+        self.assertEqual(len(mail.outbox), 5)
+        self.assertEqual(conexiones.call_count, 1)
+        # 5 envíos a 50 por segundo: al menos 4 intervalos de 20 ms
+        self.assertGreaterEqual(duracion, 0.08)
+
+    def conexion_smtp(self, noop=None, envio=None):
+        conexion = mock.Mock()
+        conexion.connection.noop.side_effect = noop
+        conexion.send_messages.side_effect = envio or (lambda mensajes: len(mensajes))
+        return conexion
+
+    def test_reabre_la_conexion_cerrada_antes_de_enviar(self):
+        cerrada = self.conexion_smtp(noop=smtplib.SMTPServerDisconnected('cerrada'))
+        nueva = self.conexion_smtp()
+        with mock.patch('app.notifications.get_connection', side_effect=[cerrada, nueva]):
+            resultados = notifications.enviar_lote([notifications.construir_email_cambio_estado(self.pedidos[0])])
+        self.assertEqual(resultados, [(True, None)])
+        cerrada.send_messages.assert_not_called()
+        nueva.send_messages.assert_called_once()
+
+    def test_no_reenvia_si_falla_despues_de_mandar(self):
+        # Timeout esperando la respuesta al DATA: el mail pudo haber salido, lo decide el outbox
+        conexion = self.conexion_smtp(envio=smtplib.SMTPServerDisconnected('sin respuesta'))
+        with mock.patch('app.notifications.get_connection', return_value=conexion) as conexiones:
+            resultados = notifications.enviar_lote([notifications.construir_email_cambio_estado(self.pedidos[0])])
+        self.assertEqual(resultados, [(False, 'sin respuesta')])
+        conexion.send_messages.assert_called_once()
+        self.assertEqual(conexiones.call_count, 1)
+
+
+class CambioEstadoBulkTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.admin = crear_usuario('admin@test.com', UsuarioTipo.objects.create(descripcion='Admin'))
+        cls.cliente = crear_usuario('cliente@test.com', UsuarioTipo.objects.create(descripcion='Cliente'))
+
+    def cambiar(self, usuario, ids, estado='Preparado'):
+        return cliente_autenticado(usuario).post('/api/pedidos/cambiar_estado_bulk/',
+                                                 {'ids': ids, 'estado': estado}, format='json')
+
+    def test_resultado_por_id_y_un_lote_de_notificaciones(self):
+        pendientes = [Pedido.objects.create(fk_usuario=self.cliente, total=10) for _ in range(3)]
+        listo = Pedido.objects.create(fk_usuario=self.cliente, total=10, estado='Preparado')
+        ids = [p.id for p in pendientes] + [listo.id, 999999]
+
+        with mock.patch('app.outbox.async_task') as async_task, \
+                self.captureOnCommitCallbacks(execute=True):
+            response = self.cambiar(self.admin, ids)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['actualizados'], 3)
+        self.assertEqual(response.data['resultados'][str(listo.id)], 'sin_cambios')
+        self.assertEqual(response.data['resultados']['999999'], 'no_encontrado')
+        self.assertEqual(Pedido.objects.filter(estado='Preparado').count(), 4)
+        self.assertEqual(PedidoEstadoHistorial.objects.count(), 3)
+        self.assertEqual(NotificacionPendiente.objects.count(), 3)
+        async_task.assert_called_once()
+        self.assertEqual(len(async_task.call_args.args[1]), 3)
+
+    def test_queries_no_crecen_con_los_ids(self):
+        pedidos = [Pedido.objects.create(fk_usuario=self.cliente, total=10) for _ in range(20)]
+        usuarios_cache.clear()
+        with CaptureQueriesContext(connection) as pocas:
+            self.cambiar(self.admin, [pedidos[0].id])
+        usuarios_cache.clear()
+        with CaptureQueriesContext(connection) as muchas:
+            self.cambiar(self.admin, [p.id for p in pedidos[1:]])
+        self.assertEqual(len(pocas), len(muchas))
+
+    def test_solo_admins(self):
+        pedido = Pedido.objects.create(fk_usuario=self.cliente, total=10)
+        self.assertEqual(self.cambiar(self.cliente, [pedido.id]).status_code, 403)
+
+    def test_claim_next_reparte_sin_repetir(self):
+        pedidos = [Pedido.objects.create(fk_usuario=self.cliente, total=10) for _ in range(5)]
+        Pedido.objects.create(fk_usuario=self.cliente, total=10, estado='Preparado')
+        tomados = []
+        with mock.patch('app.outbox.async_task'):
+            for _ in range(3):
+                response = cliente_autenticado(self.admin).post('/api/pedidos/claim_next/', {'cantidad': 2},
+                                                                format='json')
+                self.assertEqual(response.status_code, 200)
+                tomados.append([pedido['id'] for pedido in response.data['pedidos']])
+        self.assertEqual(tomados, [[p.id for p in pedidos[:2]], [p.id for p in pedidos[2:4]], [pedidos[4].id]])
+        self.assertEqual(Pedido.objects.filter(estado='En proceso').count(), 5)
+        self.assertEqual(PedidoEstadoHistorial.objects.filter(estado='En proceso').count(), 5)
+
+    def test_claim_next_identifica_sus_filas_sin_la_marca_de_tiempo(self):
+        # Otro pedido tomado en el mismo instante no se confunde con los de esta llamada
+        ahora = timezone.now()
+        ajeno = Pedido.objects.create(fk_usuario=self.cliente, total=10)
+        Pedido.objects.filter(pk=ajeno.pk).update(estado='En proceso', updated_at=ahora)
+        propio = Pedido.objects.create(fk_usuario=self.cliente, total=10)
+        with mock.patch('app.outbox.async_task'), mock.patch('app.views.timezone.now', return_value=ahora), \
+                CaptureQueriesContext(connection) as queries:
+            response = cliente_autenticado(self.admin).post('/api/pedidos/claim_next/', {'cantidad': 5},
+                                                            format='json')
+        self.assertEqual([pedido['id'] for pedido in response.data['pedidos']], [propio.id])
+        self.assertEqual(PedidoEstadoHistorial.objects.count(), 1)
+        self.assertFalse([q['sql'] for q in queries if q['sql'].startswith('SELECT') and '"updated_at" =' in q['sql']])
+
+        response = self.cambiar(self.admin, [ajeno.id, propio.id], estado='Preparado')
+        self.assertEqual(response.data['resultados'], {str(ajeno.id): 'actualizado', str(propio.id): 'actualizado'})
+
+
+class PlanImpresionTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.admin = crear_usuario('admin@test.com', UsuarioTipo.objects.create(descripcion='Admin'))
+        cls.cliente = crear_usuario('cliente@test.com', UsuarioTipo.objects.create(descripcion='Cliente'))
+
+    def setUp(self):
+        planificador.invalidar()
+
+    def pedido(self, formato, color, paginas=10, estado='Pendiente'):
+        pedido = Pedido.objects.create(fk_usuario=self.cliente, total=10, estado=estado)
+        impresion = Impresion.objects.create(formato=formato, color=color, url='x', paginas=paginas)
+        PedidoImpresionDetalle.objects.create(fk_pedido=pedido, fk_impresion=impresion, cantidadCopias=2, subtotal=1)
+        return pedido
+
+    def test_agrupa_por_papel_y_color(self):
+        viejo = self.pedido('A4', False)
+        self.pedido('A3', True)
+        self.pedido('A4', False)
+        self.pedido('A4', True)
+        self.pedido('A4', False, estado='Retirado')
+
+        response = cliente_autenticado(self.admin).get('/api/pedidos/plan_impresion/')
+        self.assertEqual(response.status_code, 200)
+        lotes = response.data['lotes']
+        self.assertEqual([(l['formato'], l['color']) for l in lotes], [('A4', False), ('A4', True), ('A3', True)])
+        self.assertEqual(lotes[0]['trabajos'][0]['pedido_id'], viejo.id)
+        self.assertEqual(lotes[0]['hojas'], 40)
+        self.assertEqual(response.data['cambios_papel'], 1)
+        self.assertEqual(cliente_autenticado(self.cliente).get('/api/pedidos/plan_impresion/').status_code, 403)
+
+    def test_actualizacion_incremental(self):
+        self.pedido('A4', False)
+        planificador.plan()
+        # Sin cambios (y sin margen de solapamiento): solo buscar modificados y contar abiertos
+        with override_settings(PLAN_IMPRESION={**settings.PLAN_IMPRESION, 'MARGEN': 0}), \
+                self.assertNumQueries(2):
+            planificador.plan()
+        nuevo = self.pedido('A4', False)
+        Pedido.objects.filter(pk=nuevo.pk).update(estado='Preparado', updated_at=timezone.now())
+        self.pedido('A5', True)
+        lotes = planificador.plan()
+        self.assertEqual([(l['formato'], len(l['trabajos'])) for l in lotes], [('A4', 1), ('A5', 1)])
+
+
+class ConcurrenciaOptimistaTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.admin = crear_usuario('admin@test.com', UsuarioTipo.objects.create(descripcion='Admin'))
+        cls.cliente = crear_usuario('cliente@test.com', UsuarioTipo.objects.create(descripcion='Cliente'))
+
+    def setUp(self):
+        self.pedido = Pedido.objects.create(fk_usuario=self.cliente, total=10)
+
+    def cambiar(self, estado, **headers):
+        return cliente_autenticado(self.admin).patch(
+            f'/api/pedidos/{self.pedido.id}/cambiar_estado/', {'estado': estado}, format='json', **headers
+        )
+
+    def test_if_match_vigente_y_desactualizado(self):
+        response = self.cambiar('En proceso', HTTP_IF_MATCH='"1"')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual((response['ETag'], response.data['version']), ('"2"', 2))
+
+        # Otro operador con la versión vieja: 412 solo con el UPDATE condicional, sin leer el pedido
+        with CaptureQueriesContext(connection) as queries:
+            response = self.cambiar('Cancelado', HTTP_IF_MATCH='"1"')
+        self.assertEqual(response.status_code, 412)
+        sobre_pedidos = [q['sql'] for q in queries if 'app_pedido"' in q['sql']]
+        self.assertEqual(len(sobre_pedidos), 1)
+        self.assertTrue(sobre_pedidos[0].startswith('UPDATE'))
+        self.pedido.refresh_from_db()
+        self.assertEqual((self.pedido.estado, self.pedido.version), ('En proceso', 2))
+        self.assertEqual(PedidoEstadoHistorial.objects.count(), 1)
+
+    def test_transicion_invalida(self):
+        Pedido.objects.filter(pk=self.pedido.pk).update(estado='Retirado')
+        response = self.cambiar('Pendiente')
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(response.data['permitidos'], ['Preparado'])
+        self.assertEqual(NotificacionPendiente.objects.count(), 0)
+
+    def test_retiro_en_mostrador_y_reenvio_de_correccion(self):
+        self.assertEqual(self.cambiar('Retirado').status_code, 200)
+
+        Pedido.objects.filter(pk=self.pedido.pk).update(estado='Requiere Corrección', motivo_correccion='Falta la tapa')
+        response = cliente_autenticado(self.admin).patch(
+            f'/api/pedidos/{self.pedido.id}/cambiar_estado/',
+            {'estado': 'Requiere Corrección', 'motivo_correccion': 'Falta la tapa en color'}, format='json'
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['motivo_correccion'], 'Falta la tapa en color')
+        self.assertEqual(NotificacionPendiente.objects.filter(tipo='correccion').count(), 1)
+        # Para el resto de los estados, el mismo estado sigue sin admitirse
+        Pedido.objects.filter(pk=self.pedido.pk).update(estado='Preparado')
+        self.assertEqual(self.cambiar('Preparado').status_code, 409)
+
+
+class EventosPedidosTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.admin = crear_usuario('admin@test.com', UsuarioTipo.objects.create(descripcion='Admin'))
+        cls.cliente = crear_usuario('cliente@test.com', UsuarioTipo.objects.create(descripcion='Cliente'))
+
+    def test_publica_al_confirmar_al_duenio_y_admins(self):
+        pedido = Pedido.objects.create(fk_usuario=self.cliente, total=10)
+        broker = mock.Mock()
+        with mock.patch('app.eventos.obtener_broker', return_value=broker), \
+                mock.patch('app.outbox.async_task'), \
+                self.captureOnCommitCallbacks(execute=True):
+            cliente_autenticado(self.admin).patch(f'/api/pedidos/{pedido.id}/cambiar_estado/',
+                                                  {'estado': 'En proceso'}, format='json')
+        canales = [llamada.args[0] for llamada in broker.publicar.call_args_list]
+        self.assertEqual(canales, ['admins', f'usuario:{self.cliente.id}'])
+        evento = broker.publicar.call_args.args[1]
+        self.assertEqual((evento['id'], evento['estado'], evento['version']), (pedido.id, 'En proceso', 2))
+
+    def test_sin_ticket(self):
+        self.assertEqual(self.client.get('/api/eventos/pedidos/').status_code, 401)
+        self.assertEqual(APIClient().post('/api/eventos/ticket/').status_code, 401)
+
+    def test_ticket_de_un_solo_uso(self):
+        response = cliente_autenticado(self.cliente).post('/api/eventos/ticket/')
+        self.assertEqual((response.status_code, response.data['expira_en']), (201, 30))
+        ticket = response.data['ticket']
+        # Solo se guarda el hash
+        self.assertFalse(TicketEventos.objects.filter(clave=ticket).exists())
+
+        usuario, vencimiento = eventos.canjear_ticket(ticket)
+        self.assertEqual(usuario.id, self.cliente.id)
+        self.assertGreater(vencimiento, time.time())
+        self.assertIsNone(eventos.canjear_ticket(ticket))
+
+    def test_ticket_vencido(self):
+        ticket = cliente_autenticado(self.cliente).post('/api/eventos/ticket/').data['ticket']
+        TicketEventos.objects.update(expira=timezone.now() - timedelta(seconds=1))
+        self.assertIsNone(eventos.canjear_ticket(ticket))
+        # El próximo pedido de ticket limpia los vencidos
+        cliente_autenticado(self.cliente).post('/api/eventos/ticket/')
+        self.assertEqual(TicketEventos.objects.count(), 1)
+
+    async def test_stream_recibe_solo_sus_pedidos(self):
+        broker = eventos.BrokerLocal()
+        ticket = (await sync_to_async(cliente_autenticado(self.cliente).post)('/api/eventos/ticket/')).data['ticket']
+        with mock.patch('app.eventos.obtener_broker', return_value=broker):
+            self.assertEqual((await self.async_client.get('/api/eventos/pedidos/?ticket=otro')).status_code, 401)
+            response = await self.async_client.get(f'/api/eventos/pedidos/?ticket={ticket}')
+            self.assertEqual(response['Content-Type'], 'text/event-stream')
+            contenido = response.streaming_content
+            self.assertTrue((await anext(contenido)).startswith(b'retry:'))
+
+            eventos._publicar([{'id': 1, 'fk_usuario_id': self.admin.id, 'estado': 'Preparado'},
+                               {'id': 2, 'fk_usuario_id': self.cliente.id, 'estado': 'Preparado'}])
+            self.assertIn(b'"id": 2', await anext(contenido))
+
+            # Al desconectarse el cliente, el handler ASGI cancela la lectura del stream
+            lectura = asyncio.ensure_future(anext(contenido))
+            await asyncio.sleep(0)
+            lectura.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await lectura
+        self.assertEqual(broker.cantidad_suscriptores(), 0)
+
+    async def test_broker_postgres_reparte_lo_notificado(self):
+        broker = eventos.BrokerPostgres()
+        with mock.patch.object(eventos.BrokerPostgres, '_iniciar_escucha') as escucha:
+            cola = broker.suscribir([f'usuario:{self.cliente.id}'])
+        escucha.assert_called_once()
+
+        # publicar() no entrega local: manda un NOTIFY que reciben todos los procesos
+        with mock.patch('app.eventos.connection') as conexion:
+            broker.publicar(f'usuario:{self.cliente.id}', {'tipo': 'pedido_estado', 'id': 7})
+        sql, (canal_pg, mensaje) = conexion.cursor.return_value.__enter__.return_value.execute.call_args.args
+        self.assertEqual((sql, canal_pg), ('SELECT pg_notify(%s, %s)', 'suchus_eventos'))
+        self.assertTrue(cola.empty())
+
+        self.assertEqual(broker.recibir(mensaje), 1)
+        self.assertEqual((await asyncio.wait_for(cola.get(), 1))['id'], 7)
+        self.assertEqual(broker.recibir(json.dumps({'canal': 'admins', 'evento': {}})), 0)
+
+
+class LecturaPorRangos(io.BytesIO):
+    """Archivo en memoria que registra cuántos bytes se leyeron"""
+    leidos = 0
+
+    def read(self, cantidad=-1):
+        datos = super().read(cantidad)
+        self.leidos += len(datos)
+        return datos
+
+
+class ContarPaginasTests(TestCase):
+
+    def test_xref_clasica_y_comprimida(self):
+        for comprimido in (False, True):
+            for paginas in (1, 250):
+                self.assertEqual(contar_paginas(io.BytesIO(pdf_de_prueba(paginas, comprimido))), paginas)
+        self.assertIsNone(contar_paginas(io.BytesIO(b'no es un pdf')))
+
+    def test_plano_grande_con_memoria_acotada(self):
+        archivo = LecturaPorRangos(pdf_de_prueba(3, comprimido=True, relleno=40 * 1024 * 1024))
+        self.assertEqual(contar_paginas(archivo), 3)
+        self.assertLess(archivo.leidos, 512 * 1024)
+
+    def test_xref_danada_cuenta_por_escaneo(self):
+        roto = pdf_de_prueba(9).replace(b'startxref', b'startxrfe')
+        self.assertEqual(contar_paginas(io.BytesIO(roto)), 9)
+
+    def test_offset_enorme_en_la_xref_no_rompe(self):
+        # Una xref comprimida con /W [1 9 1] admite offsets que no entran en un seek
+        filas = b'\x00' + bytes(9) + b'\xff' + b'\x01' + (2 ** 70).to_bytes(9, 'big') + b'\x00'
+        cuerpo = b'%PDF-1.5\n1 0 obj\n<< /Type /Page >>\nendobj\n'
+        inicio = len(cuerpo)
+        cuerpo += (b'2 0 obj\n<< /Type /XRef /Size 2 /W [1 9 1] /Root 1 0 R /Length %d >>\nstream\n' % len(filas)
+                   + filas + b'\nendstream\nendobj\n')
+        datos = cuerpo + b'startxref\n%d\n%%%%EOF\n' % inicio
+        self.assertEqual(contar_paginas(io.BytesIO(datos)), 1)
+
+    def test_el_pedido_se_cotiza_con_las_paginas_del_pdf(self):
+        crear_tarifas()
+        cliente = crear_usuario('cliente@test.com', UsuarioTipo.objects.create(descripcion='Cliente'))
+        storage = StorageFalso(demora=0)
+        with mock.patch('app.almacenamiento.storage_cloudinary', return_value=storage):
+            response = cliente_autenticado(cliente).post('/api/pedidos/', {
+                'impresiones': json.dumps([{'formato': 'A4', 'color': 'bn', 'copias': 2, 'paginas': 1}]),
+                'archivo_impresion_0': SimpleUploadedFile('apunte.pdf', pdf_de_prueba(7), 'application/pdf'),
+            })
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(Impresion.objects.get().paginas, 7)
+        self.assertAlmostEqual(response.data['total'], 50 * 7 * 2)
+
+
+class PreflightTests(TestCase):
+
+    def analizar_bytes(self, datos):
+        with tempfile.NamedTemporaryFile(suffix='.pdf') as archivo:
+            archivo.write(datos)
+            archivo.flush()
+            return analizar(archivo.name, max_paginas=100, timeout=10)
+
+    def test_formato_y_color(self):
+        resultado = self.analizar_bytes(pdf_de_prueba(3, medidas=(842, 1191), contenido=b'0 0 0 rg 0.5 G'))
+        self.assertEqual((resultado['paginas'], resultado['formato'], resultado['color']), (3, 'A3', False))
+        resultado = self.analizar_bytes(pdf_de_prueba(2, comprimido=True, contenido=b'1 0 0 rg 0 0 10 10 re f'))
+        self.assertEqual((resultado['formato'], resultado['paginas_color']), ('A4', 2))
+        self.assertEqual(self.analizar_bytes(b'no es un pdf')['error'], 'No es un PDF legible')
+
+    def test_imagenes_jpeg_por_espacio_de_color(self):
+        jpeg = b'/BitsPerComponent 8 /Filter /DCTDecode /ColorSpace '
+        self.assertTrue(self.analizar_bytes(pdf_de_prueba(1, imagen=jpeg + b'/DeviceRGB'))['color'])
+        self.assertTrue(self.analizar_bytes(pdf_de_prueba(1, imagen=jpeg + b'/DeviceCMYK'))['color'])
+        self.assertFalse(self.analizar_bytes(pdf_de_prueba(1, imagen=jpeg + b'/DeviceGray'))['color'])
+        jpx = b'/Filter [/JPXDecode] /ColorSpace /DeviceRGB'
+        self.assertTrue(self.analizar_bytes(pdf_de_prueba(1, imagen=jpx))['color'])
+
+    def test_observa_y_cachea_por_digest(self):
+        datos = pdf_de_prueba(4, contenido=b'0 0.2 0.9 rg')
+        impresiones = [Impresion.objects.create(color=False, formato='A4', url=f'https://x/{i}.pdf') for i in range(2)]
+        with mock.patch('app.preflight.async_task') as tarea, self.captureOnCommitCallbacks(execute=True):
+            preflight.encolar_preflight([impresion.id for impresion in impresiones])
+        # Un archivo por tarea: descarga + análisis de cada uno ya se acerca al timeout del cluster
+        self.assertEqual(tarea.call_args_list, [
+            mock.call('app.preflight.procesar_preflight', [i.id], 1, task_name=f'preflight-{i.id}')
+            for i in impresiones
+        ])
+
+        with mock.patch('app.preflight.bloques_archivo', side_effect=lambda imp: iter([datos])), \
+                mock.patch('app.preflight.analizar_en_pool', wraps=lambda rutas: {
+                    sha256: analizar(ruta, 100, 10) for sha256, ruta in rutas.items()}) as pool:
+            preflight.procesar_preflight([impresiones[0].id])
+            preflight.procesar_preflight([impresiones[1].id])
+        # El mismo contenido se analiza una sola vez
+        self.assertEqual(ResultadoPreflight.objects.count(), 1)
+        self.assertEqual(pool.call_args_list[1], mock.call({}))
+        for impresion in Impresion.objects.all():
+            self.assertEqual(impresion.preflight_estado, 'Observada')
+            self.assertEqual(impresion.paginas, 4)
+            self.assertIn('blanco y negro', impresion.preflight_observaciones[0])
+
+    @override_settings(PREFLIGHT={**settings.PREFLIGHT, 'INTENTOS': 2})
+    def test_fallas_transitorias_se_reintentan_y_no_se_cachean(self):
+        impresion = Impresion.objects.create(color=False, formato='A4', url='https://x/t.pdf')
+        vencido = {'error': 'Se superó el tiempo de análisis', 'transitorio': True}
+        with mock.patch('app.preflight.bloques_archivo', side_effect=lambda imp: iter([b'%PDF-1.4'])), \
+                mock.patch('app.preflight.analizar_en_pool', side_effect=lambda rutas: {
+                    sha256: dict(vencido) for sha256 in rutas}), \
+                mock.patch('app.preflight.async_task') as tarea:
+            with self.captureOnCommitCallbacks(execute=True):
+                preflight.procesar_preflight([impresion.id])
+            tarea.assert_called_once_with('app.preflight.procesar_preflight', [impresion.id], 2,
+                                          task_name=f'preflight-{impresion.id}')
+            self.assertEqual(Impresion.objects.get(pk=impresion.pk).preflight_estado, 'Pendiente')
+            preflight.procesar_preflight([impresion.id], 2)
+        impresion.refresh_from_db()
+        self.assertEqual((impresion.preflight_estado, impresion.preflight_observaciones),
+                         ('Error', ['Se superó el tiempo de análisis']))
+        self.assertFalse(ResultadoPreflight.objects.exists())
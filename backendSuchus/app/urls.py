@@ -2,12 +2,15 @@ from django.urls import path, include
 from rest_framework.routers import DefaultRouter
 from rest_framework_simplejwt.views import TokenRefreshView
 from .views import (UsuarioRegisterView, UsuarioLoginView, CustomTokenObtainPairView,
-                   LogoutView, PedidoViewSet, ImpresionViewSet, ProductoViewSet, UsuarioViewSet, UsuarioTipoViewSet, ReporteViewSet, TipoImpresionViewSet)
+                   LogoutView, PedidoViewSet, ImpresionViewSet, ProductoViewSet, UsuarioViewSet, UsuarioTipoViewSet, ReporteViewSet, TipoImpresionViewSet,
+                   SubidaViewSet)
 from .pago import crear_preferencia
+from .eventos import stream_pedidos, ticket_eventos
 
 router = DefaultRouter()
 router.register(r'pedidos', PedidoViewSet, basename='pedido')
 router.register(r'impresiones', ImpresionViewSet, basename='impresion')
+router.register(r'subidas', SubidaViewSet, basename='subida')
 router.register(r'productos', ProductoViewSet, basename='producto')
 router.register(r'tipo-impresion', TipoImpresionViewSet, basename='tipo-impresion')
 router.register(r'usuarios', UsuarioViewSet, basename='usuario')
@@ -20,6 +23,8 @@ urlpatterns = [
     path("logout/", LogoutView.as_view(), name='logout'),
     path("token/refresh/", TokenRefreshView.as_view(), name='token_refresh'),
     path("mercadopago/crear-preferencia/", crear_preferencia),
+    path("eventos/ticket/", ticket_eventos, name='eventos-ticket'),
+    path("eventos/pedidos/", stream_pedidos, name='eventos-pedidos'),
 
     path("", include(router.urls)),
 ]
\ No newline at end of file
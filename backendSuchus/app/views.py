@@ -1,8 +1,9 @@
 from django.shortcuts import render
-from rest_framework import generics, status, viewsets, permissions
+from rest_framework import generics, status, viewsets, permissions, mixins
 from rest_framework.views import APIView
 from rest_framework.response import Response
-from django.db import transaction
+from rest_framework.exceptions import ValidationError
+from django.db import transaction, connection, connections
 import json
 from rest_framework.decorators import action
 from rest_framework.parsers import MultiPartParser, FormParser, JSONParser
@@ -11,23 +12,43 @@ from rest_framework_simplejwt.serializers import TokenObtainPairSerializer
 from django.contrib.auth.hashers import check_password, make_password
 from django.utils import timezone
 from django.db.models import Q
-from datetime import timedelta
 import traceback
 from cloudinary_storage.storage import RawMediaCloudinaryStorage
 import io
 from django.core.files.base import ContentFile
-import boto3
-import uuid
-import os
 import pandas as pd
 from django.db import models
-from django.db.models import Sum, Count, F
-from .models import Usuario, Pedido, Impresion, Producto, UsuarioTipo, PedidoProductoDetalle, PedidoImpresionDetalle, PedidoEstadoHistorial, Reporte, TipoImpresion
+from django.db.models import Sum, Count, F, Max, Subquery
+from django.db.models.sql import UpdateQuery
+from django.core.exceptions import EmptyResultSet
+from .models import Usuario, Pedido, Impresion, Producto, UsuarioTipo, PedidoProductoDetalle, PedidoImpresionDetalle, PedidoEstadoHistorial, Reporte, TipoImpresion, SesionSubida, LimpiezaAlmacenamiento
 from .serializers import (UsuarioRegisterSerializer, UsuarioLoginSerializer, PedidoSerializer, 
                           ImpresionSerializer, ProductoSerializer, UsuarioSerializer,
-                          UsuarioCreateSerializer, UsuarioUpdateSerializer, ReporteSerializer, TipoImpresionSerializer)
+                          UsuarioCreateSerializer, UsuarioUpdateSerializer, ReporteSerializer, TipoImpresionSerializer,
+                          SesionSubidaSerializer)
 from .serializers import UsuarioTipoSerializer
-from .notifications import enviar_notificacion_cambio_estado, enviar_notificacion_correccion_requerida
+from .outbox import encolar_notificacion, encolar_notificaciones
+from .eventos import publicar_cambios_estado
+from .preflight import encolar_preflight
+from .planificacion import planificador
+from .limpieza import iniciar_limpieza
+from .accesos import registrar_acceso
+from .cache_archivos import cache_archivos, clave_de, precargar_pedidos, servir
+from . import precios
+from .pdf import contar_paginas
+from .authentication import agregar_claims_de_rol
+from .pagination import CursorOpcionalMixin
+from .condicional import respuesta_condicional
+from .almacenamiento import (eliminar_subidos, cliente_r2, url_publica_r2, nueva_clave_r2,
+                             leer_parte, ArchivoSubido, contar_paginas_r2)
+from .blobs import preparar_subidas, vincular_blobs, liberar_blob, sha256_archivo, buscar_blobs
+from . import blobs
+from django.conf import settings
+from django.core import signing
+import logging
+
+logger = logging.getLogger('pedidos')
+
 # Create your views here.
 
 class CustomTokenObtainPairSerializer(TokenObtainPairSerializer):
@@ -41,6 +62,8 @@ class CustomTokenObtainPairSerializer(TokenObtainPairSerializer):
         # Add custom claims
         token['email'] = user.email
         token['nombre'] = user.nombre
+        if settings.JWT_CLAIMS_AUTH:
+            agregar_claims_de_rol(token, user)
         return token
     
     def validate(self, attrs):
@@ -52,7 +75,7 @@ class CustomTokenObtainPairSerializer(TokenObtainPairSerializer):
         
         # Primero verificar si el usuario existe (activo o inactivo)
         try:
-            user = Usuario.objects.get(email=email)
+            user = Usuario.objects.select_related('usuarioTipo').get(email=email)
         except Usuario.DoesNotExist:
             raise AuthenticationFailed('Credenciales inválidas')
         
@@ -118,31 +141,150 @@ class LogoutView(APIView):
             status=status.HTTP_200_OK
         )
 
-class PedidoViewSet(viewsets.ModelViewSet):
+def version_if_match(request):
+    """Versión de pedido del header If-Match ("3" o W/"3"); None si no vino o es *"""
+    valor = request.headers.get('If-Match', '').strip()
+    if not valor or valor == '*':
+        return None
+    try:
+        return int(valor.removeprefix('W/').strip('"'))
+    except ValueError:
+        raise ValidationError({"If-Match": "Debe ser la versión del pedido, por ejemplo \"3\""})
+
+
+def etag_pedido(version):
+    return f'"{version}"'
+
+
+def actualizar_devolviendo_ids(queryset, **cambios):
+    """
+    queryset.update(**cambios) con RETURNING: devuelve los ids de las filas que
+    cambió ESTE update (Postgres y SQLite >= 3.35), sin volver a leer la tabla.
+    """
+    query = queryset.query.chain(UpdateQuery)
+    query.add_update_values(cambios)
+    compilador = query.get_compiler(queryset.db)
+    compilador.pre_sql_setup()
+    try:
+        sql, params = compilador.as_sql()
+    except EmptyResultSet:
+        return []
+    columna = connections[queryset.db].ops.quote_name(queryset.model._meta.pk.column)
+    with connections[queryset.db].cursor() as cursor:
+        cursor.execute(f'{sql} RETURNING {columna}', params)
+        return [fila[0] for fila in cursor.fetchall()]
+
+
+def pedidos_con_relaciones(queryset):
+    """
+    Carga todo lo que lee PedidoSerializer en un número fijo de queries:
+    el usuario por JOIN y cada detalle con su producto/impresión en un prefetch.
+    """
+    from django.db.models import Prefetch
+
+    return queryset.select_related('fk_usuario').prefetch_related(
+        Prefetch('pedidoproductodetalle_set',
+                 queryset=PedidoProductoDetalle.objects.select_related('fk_producto')),
+        Prefetch('pedidoimpresiondetalle_set',
+                 queryset=PedidoImpresionDetalle.objects.select_related('fk_impresion')),
+        Prefetch('historial_estados',
+                 queryset=PedidoEstadoHistorial.objects.order_by('fecha', 'id')),
+    )
+
+
+class PedidoViewSet(CursorOpcionalMixin, viewsets.ModelViewSet):
     queryset = Pedido.objects.all()
     serializer_class = PedidoSerializer
     permission_classes = [permissions.IsAuthenticated]
     parser_classes = (MultiPartParser, FormParser, JSONParser)
 
+    # Columnas disponibles para ?fields= (nombre en la respuesta -> lookup del ORM)
+    CAMPOS_RESUMEN = {
+        'id': 'id',
+        'estado': 'estado',
+        'total': 'total',
+        'fecha': 'fecha',
+        'observacion': 'observacion',
+        'motivo_correccion': 'motivo_correccion',
+        'fk_usuario': 'fk_usuario',
+        'usuario_nombre': 'fk_usuario__nombre',
+        'usuario_apellido': 'fk_usuario__apellido',
+        'usuario_email': 'fk_usuario__email',
+        'created_at': 'created_at',
+        'updated_at': 'updated_at',
+        'version': 'version',
+    }
+    # Columnas de ?view=summary: lo que muestran las tablas de PedidoAdmin y MisPedidos
+    CAMPOS_RESUMEN_DEFAULT = ['id', 'estado', 'total', 'fecha', 'fk_usuario',
+                              'usuario_nombre', 'usuario_apellido', 'updated_at', 'version']
+
     def list(self, request, *args, **kwargs):
+        campos = self.get_campos_resumen()
+        listar = super().list
         try:
-            return super().list(request, *args, **kwargs)
+            queryset = self.filtrar_pedidos()
+            if campos:
+                construir = lambda: self.listar_resumen(queryset, campos)
+            else:
+                construir = lambda: listar(request, *args, **kwargs)
+            return self.respuesta_condicional(queryset, construir, campos)
         except Exception as e:
             return Response(
                 {'error': str(e), 'traceback': traceback.format_exc()},
                 status=status.HTTP_500_INTERNAL_SERVER_ERROR
             )
 
-    def get_queryset(self):
-        from django.db.models import Prefetch
-        
+    def respuesta_condicional(self, queryset, construir, campos):
+        """
+        ETag / Last-Modified del listado. Además del pedido, la representación
+        incluye datos del usuario y, en la vista completa, las impresiones (páginas,
+        preflight) y nombre y precio de los productos: sus updated_at también invalidan.
+        """
+        extra = ''
+        campos_fecha = ('updated_at', 'fk_usuario__updated_at')
+        if not campos:
+            extra = Producto.objects.aggregate(ultimo=Max('updated_at'))['ultimo']
+            campos_fecha += ('pedidoimpresiondetalle__fk_impresion__updated_at',)
+        return respuesta_condicional(self.request, queryset, construir, campos_fecha, extra)
+
+    def get_campos_resumen(self):
+        """
+        Columnas pedidas con ?fields=a,b o ?view=summary; None para el listado completo.
+        El id siempre se incluye (lo necesitan la paginación por cursor y el retrieve).
+        """
+        fields = self.request.query_params.get('fields')
+        if fields:
+            campos = [c.strip() for c in fields.split(',') if c.strip()]
+            invalidos = [c for c in campos if c not in self.CAMPOS_RESUMEN]
+            if invalidos:
+                raise ValidationError({
+                    'fields': f"Campos no disponibles: {', '.join(invalidos)}. "
+                              f"Opciones: {', '.join(self.CAMPOS_RESUMEN)}"
+                })
+            if 'id' not in campos:
+                campos.insert(0, 'id')
+            return campos
+        if self.request.query_params.get('view') == 'summary':
+            return list(self.CAMPOS_RESUMEN_DEFAULT)
+        return None
+
+    def listar_resumen(self, queryset, campos):
+        """Lista solo las columnas pedidas con .values(): sin prefetch ni serializer"""
+        directos = [c for c in campos if self.CAMPOS_RESUMEN[c] == c]
+        renombrados = {c: F(self.CAMPOS_RESUMEN[c]) for c in campos if self.CAMPOS_RESUMEN[c] != c}
+        filas = queryset.values(*directos, **renombrados).order_by('-id')
+
+        page = self.paginate_queryset(filas)
+        if page is not None:
+            return self.get_paginated_response(page)
+        return Response(list(filas))
+
+    def filtrar_pedidos(self):
+        """Pedidos visibles para el usuario con los filtros de la query string, sin relaciones"""
         user = self.request.user
         
-        # CORRECCIÓN: Acceder a la descripción del tipo de usuario correctamente
-        # Usamos .descripcion porque así está en tu modelo UsuarioTipo
-        is_admin = False
-        if hasattr(user, 'usuarioTipo') and user.usuarioTipo:
-            is_admin = user.usuarioTipo.descripcion == 'Admin'
+        # El rol sale del usuario cacheado o de los claims del token (sin query)
+        is_admin = user.es_admin()
 
         # 1. Filtrado por Rol
         if is_admin:
@@ -153,7 +295,7 @@ class PedidoViewSet(viewsets.ModelViewSet):
                 queryset = queryset.filter(fk_usuario_id=usuario_id)
         else:
             # El cliente común SOLO ve sus pedidos
-            queryset = Pedido.objects.filter(fk_usuario=user)
+            queryset = Pedido.objects.filter(fk_usuario_id=user.id)
 
         # 2. Filtros adicionales de búsqueda
         estado = self.request.query_params.get('estado', None)
@@ -167,113 +309,98 @@ class PedidoViewSet(viewsets.ModelViewSet):
         if fecha_hasta:
             queryset = queryset.filter(fecha__lte=fecha_hasta)
 
-        # OPTIMIZACIÓN: Cargar relaciones de una vez para evitar N+1 queries
-        queryset = queryset.select_related('fk_usuario')
-        queryset = queryset.prefetch_related(
-            'pedidoproductodetalle_set',
-            'pedidoimpresiondetalle_set',
-            'historial_estados'
-        )
+        return queryset
 
-        return queryset.order_by('-id')
+    def get_queryset(self):
+        # OPTIMIZACIÓN: Cargar relaciones de una vez para evitar N+1 queries
+        return pedidos_con_relaciones(self.filtrar_pedidos()).order_by('-id')
 
     # ESTO ES LO QUE TE FALTA PARA QUITAR EL 404
     @action(detail=False, methods=['get'])
     def mis_pedidos(self, request):
         """
         Endpoint: GET /api/pedidos/mis_pedidos/
+        Acepta ?view=summary o ?fields= igual que el listado.
         """
-        pedidos = (Pedido.objects
-                   .filter(fk_usuario=request.user)
-                   .select_related('fk_usuario')
-                   .prefetch_related(
-                       'pedidoproductodetalle_set',
-                       'pedidoimpresiondetalle_set',
-                       'historial_estados'
-                   )
-                   .order_by('-id'))
-        
-        # Manejo de paginación (por si usas en el futuro)
-        page = self.paginate_queryset(pedidos)
-        if page is not None:
-            serializer = self.get_serializer(page, many=True)
-            return self.get_paginated_response(serializer.data)
+        campos = self.get_campos_resumen()
+        propios = Pedido.objects.filter(fk_usuario_id=request.user.id)
+        if campos:
+            return self.respuesta_condicional(propios, lambda: self.listar_resumen(propios, campos), campos)
 
-        serializer = self.get_serializer(pedidos, many=True)
-        return Response(serializer.data)
+        def construir():
+            pedidos = pedidos_con_relaciones(propios).order_by('-id')
+            
+            # Manejo de paginación (por si usas en el futuro)
+            page = self.paginate_queryset(pedidos)
+            if page is not None:
+                serializer = self.get_serializer(page, many=True)
+                return self.get_paginated_response(serializer.data)
+
+            serializer = self.get_serializer(pedidos, many=True)
+            return Response(serializer.data)
+        return self.respuesta_condicional(propios, construir, campos)
     
     @action(detail=True, methods=['patch'])
     def cambiar_estado(self, request, pk=None):
+        """
+        Cambio de estado con concurrencia optimista: un solo
+        UPDATE ... WHERE id=? AND estado IN (orígenes válidos) [AND version=If-Match],
+        sin leer el pedido antes ni tomar locks. Si otro operador lo cambió
+        primero, responde 412 y el cliente debe recargar.
+        """
         try:
-            # Obtener el pedido con las optimizaciones de relaciones
-            queryset = self.get_queryset()
-            pedido = queryset.get(pk=pk)
-            
             nuevo_estado = request.data.get('estado')
             motivo_correccion = request.data.get('motivo_correccion', None)
+            if nuevo_estado not in Pedido.TRANSICIONES:
+                return Response(
+                    {"error": "Estado inválido"},
+                    status=status.HTTP_400_BAD_REQUEST
+                )
+            version = version_if_match(request)
 
-            print(f"\n{'='*60}")
-            print(f"🔄 CAMBIO DE ESTADO DE PEDIDO")
-            print(f"{'='*60}")
-            print(f"Pedido ID: {pedido.id}")
-            print(f"Estado actual: {pedido.estado}")
-            print(f"Nuevo estado: {nuevo_estado}")
-            
-            try:
-                print(f"Usuario: {pedido.fk_usuario.nombre} ({pedido.fk_usuario.email})")
-            except Exception as e:
-                print(f"⚠️ Error al acceder a datos del usuario: {e}")
-            print(f"{'='*60}\n")
+            cambios = {'estado': nuevo_estado, 'version': F('version') + 1, 'updated_at': timezone.now()}
+            # Si el estado es 'Requiere Corrección', guardar el motivo
+            if nuevo_estado == 'Requiere Corrección' and motivo_correccion:
+                cambios['motivo_correccion'] = motivo_correccion
+            elif nuevo_estado != 'Requiere Corrección':
+                cambios['motivo_correccion'] = None
 
-            if nuevo_estado in dict(Pedido.ESTADO).keys():
-                pedido.estado = nuevo_estado
-                # Si el estado es 'Requiere Corrección', guardar el motivo
-                if nuevo_estado == 'Requiere Corrección' and motivo_correccion:
-                    pedido.motivo_correccion = motivo_correccion
-                elif nuevo_estado != 'Requiere Corrección':
-                    pedido.motivo_correccion = None
-                pedido.save()
+            condicion = self.filtrar_pedidos().filter(pk=pk, estado__in=Pedido.origenes(nuevo_estado))
+            if version is not None:
+                condicion = condicion.filter(version=version)
+
+            # ===== SISTEMA DE NOTIFICACIONES =====
+            # El email se registra en el outbox dentro de la misma transacción y lo
+            # envía el qcluster al confirmar: el PATCH no espera al servidor de correo.
+            # Las pestañas abiertas se enteran por SSE (eventos.py) también al confirmar.
+            with transaction.atomic():
+                if not condicion.update(**cambios):
+                    return self.respuesta_sin_cambio(pk, nuevo_estado, version)
+                publicar_cambios_estado(
+                    Pedido.objects.filter(pk=pk).values('id', 'fk_usuario_id', 'estado', 'version', 'motivo_correccion')
+                )
+                pedido = Pedido(pk=int(pk), estado=nuevo_estado)
                 PedidoEstadoHistorial.objects.create(fk_pedido=pedido, estado=nuevo_estado)
-                
-                print(f"✅ Pedido #{pedido.id} actualizado a estado: {nuevo_estado}")
-                
-                # ===== SISTEMA DE NOTIFICACIONES =====
-                # Enviar email al cliente (aislado para que no afecte el cambio de estado si falla)
-                print(f"📧 Intentando enviar notificación por email...")
-                try:
-                    if nuevo_estado == 'Requiere Corrección' and motivo_correccion:
-                        # Email especial para correcciones
-                        resultado = enviar_notificacion_correccion_requerida(pedido, motivo_correccion)
-                        if resultado:
-                            print(f"✅ Notificación de corrección enviada exitosamente")
-                        else:
-                            print(f"⚠️ No se pudo enviar notificación de corrección")
-                    else:
-                        # Email general de cambio de estado
-                        resultado = enviar_notificacion_cambio_estado(pedido)
-                        if resultado:
-                            print(f"✅ Notificación enviada exitosamente")
-                        else:
-                            print(f"⚠️ No se pudo enviar notificación")
-                except Exception as e:
-                    # Si falla el email, solo lo registramos pero NO interrumpimos el flujo
-                    import traceback
-                    print(f"❌ [ADVERTENCIA] Error al enviar notificación: {e}")
-                    print(f"Traceback completo:\n{traceback.format_exc()}")
-                # ===== FIN NOTIFICACIONES =====
-                
-                print(f"\n{'='*60}\n")
-                
-                # Recargar el pedido desde DB para asegurar que tenemos todos los datos actualizados
-                pedido.refresh_from_db()
-                serializer = self.get_serializer(pedido)
-                return Response(serializer.data)
+                if nuevo_estado == 'En proceso':
+                    # Los archivos se bajan a la caché del local antes de que los pidan
+                    precargar_pedidos([pedido.pk])
+                if nuevo_estado == 'Requiere Corrección' and motivo_correccion:
+                    # Email especial para correcciones
+                    encolar_notificacion(pedido, 'correccion', motivo_correccion)
+                else:
+                    # Email general de cambio de estado
+                    encolar_notificacion(pedido)
+            # ===== FIN NOTIFICACIONES =====
 
-            return Response(
-                {"error": "Estado inválido"},
-                status=status.HTTP_400_BAD_REQUEST
-            )
+            print(f"✅ Pedido #{pk} actualizado a estado: {nuevo_estado} (notificación encolada)")
+
+            pedido = self.get_queryset().get(pk=pk)
+            response = Response(self.get_serializer(pedido).data)
+            response['ETag'] = etag_pedido(pedido.version)
+            return response
             
+        except ValidationError:
+            raise
         except Exception as e:
             # Errores inesperados
             import traceback
@@ -286,17 +413,173 @@ class PedidoViewSet(viewsets.ModelViewSet):
                 status=status.HTTP_500_INTERNAL_SERVER_ERROR
             )
 
+    def respuesta_sin_cambio(self, pk, nuevo_estado, version):
+        """
+        El UPDATE condicional no tocó ninguna fila. Con If-Match se responde 412
+        directamente; sin él se lee el estado actual para explicar el motivo.
+        """
+        if version is not None:
+            return Response(
+                {"error": "El pedido fue modificado por otra persona o el cambio no es válido "
+                          "desde su estado actual. Recargá el pedido y volvé a intentar."},
+                status=status.HTTP_412_PRECONDITION_FAILED
+            )
+        actual = self.filtrar_pedidos().filter(pk=pk).values_list('estado', flat=True).first()
+        if actual is None:
+            return Response({"error": "Pedido no encontrado"}, status=status.HTTP_404_NOT_FOUND)
+        return Response(
+            {"error": f"No se puede pasar de '{actual}' a '{nuevo_estado}'",
+             "permitidos": sorted(Pedido.TRANSICIONES[actual])},
+            status=status.HTTP_409_CONFLICT
+        )
+
+    def retrieve(self, request, *args, **kwargs):
+        response = super().retrieve(request, *args, **kwargs)
+        response['ETag'] = etag_pedido(response.data['version'])
+        return response
+
+    @action(detail=False, methods=['get'])
+    def plan_impresion(self, request):
+        """
+        Endpoint: GET /api/pedidos/plan_impresion/ (solo admins)
+        Trabajos de los pedidos Pendiente / En proceso agrupados en lotes por formato
+        y color, en el orden sugerido para imprimirlos (ver planificacion.py).
+        """
+        if not request.user.es_admin():
+            return Response({"error": "Solo los administradores pueden ver el plan de impresión"},
+                            status=status.HTTP_403_FORBIDDEN)
+        lotes = planificador.plan()
+        return Response({
+            'lotes': lotes,
+            'cambios_papel': sum(1 for lote in lotes if lote['cambio'] == 'papel'),
+            'cambios_color': sum(1 for lote in lotes if lote['cambio'] == 'color'),
+        })
+
+    @action(detail=False, methods=['post'])
+    def cambiar_estado_bulk(self, request):
+        """
+        Cambia el estado de muchos pedidos a la vez (solo admins).
+        Body: {"ids": [1, 2, 3], "estado": "Preparado", "motivo_correccion": "..."}
+        Un UPDATE condicional, un bulk_create del historial y una tarea de
+        notificaciones para todos. Solo se mueven los pedidos cuyo estado actual
+        admite la transición (Pedido.TRANSICIONES).
+        Respuesta por id: actualizado | sin_cambios | transicion_invalida | no_encontrado
+        """
+        if not request.user.es_admin():
+            return Response({"error": "Solo los administradores pueden cambiar estados en lote"},
+                            status=status.HTTP_403_FORBIDDEN)
+
+        nuevo_estado = request.data.get('estado')
+        if nuevo_estado not in dict(Pedido.ESTADO):
+            return Response({"error": "Estado inválido"}, status=status.HTTP_400_BAD_REQUEST)
+        try:
+            ids = list(dict.fromkeys(int(pedido_id) for pedido_id in request.data.get('ids') or []))
+        except (TypeError, ValueError):
+            return Response({"error": "'ids' debe ser una lista de ids de pedido"},
+                            status=status.HTTP_400_BAD_REQUEST)
+        if not ids or len(ids) > settings.CAMBIO_ESTADO_BULK_MAX:
+            return Response({"error": f"Enviar entre 1 y {settings.CAMBIO_ESTADO_BULK_MAX} ids"},
+                            status=status.HTTP_400_BAD_REQUEST)
+
+        motivo = request.data.get('motivo_correccion') if nuevo_estado == 'Requiere Corrección' else None
+        with transaction.atomic():
+            cambiados = set(actualizar_devolviendo_ids(
+                Pedido.objects.filter(id__in=ids, estado__in=Pedido.origenes(nuevo_estado)),
+                estado=nuevo_estado, motivo_correccion=motivo, updated_at=timezone.now(), version=F('version') + 1
+            ))
+            filas = Pedido.objects.filter(id__in=ids).values('id', 'fk_usuario_id', 'estado', 'version',
+                                                             'motivo_correccion')
+            encontrados = {fila['id']: fila for fila in filas}
+            actualizados = [pedido_id for pedido_id in ids if pedido_id in cambiados]
+
+            PedidoEstadoHistorial.objects.bulk_create([
+                PedidoEstadoHistorial(fk_pedido_id=pedido_id, estado=nuevo_estado) for pedido_id in actualizados
+            ])
+            encolar_notificaciones(actualizados, nuevo_estado,
+                                   'correccion' if motivo else 'cambio_estado', motivo)
+            publicar_cambios_estado(encontrados[pedido_id] for pedido_id in actualizados)
+            if nuevo_estado == 'En proceso':
+                precargar_pedidos(actualizados)
+
+        print(f"🔄 Cambio de estado en lote a '{nuevo_estado}': {len(actualizados)}/{len(ids)} pedidos")
+        def resultado(pedido_id):
+            if pedido_id not in encontrados:
+                return 'no_encontrado'
+            if pedido_id in cambiados:
+                return 'actualizado'
+            return 'sin_cambios' if encontrados[pedido_id]['estado'] == nuevo_estado else 'transicion_invalida'
+
+        resultados = {str(pedido_id): resultado(pedido_id) for pedido_id in ids}
+        return Response({"estado": nuevo_estado, "actualizados": len(actualizados), "resultados": resultados})
+
+    @action(detail=False, methods=['post'], url_path='claim_next')
+    def reclamar_siguientes(self, request):
+        """
+        Endpoint: POST /api/pedidos/claim_next/ (solo admins)
+        Body: {"cantidad": 3}
+        Entrega a la estación que llama los próximos pedidos "Pendiente" (los más
+        viejos primero) y los pasa a "En proceso" con su historial, en una transacción.
+        Varias estaciones pueden llamar a la vez: cada pedido lo recibe una sola.
+        """
+        if not request.user.es_admin():
+            return Response({"error": "Solo los administradores pueden tomar pedidos"},
+                            status=status.HTTP_403_FORBIDDEN)
+        try:
+            cantidad = int(request.data.get('cantidad', 1))
+        except (TypeError, ValueError):
+            return Response({"error": "'cantidad' debe ser un número entero"}, status=status.HTTP_400_BAD_REQUEST)
+        if not 1 <= cantidad <= settings.RECLAMAR_MAX:
+            return Response({"error": f"'cantidad' debe estar entre 1 y {settings.RECLAMAR_MAX}"},
+                            status=status.HTTP_400_BAD_REQUEST)
+
+        nuevo_estado = 'En proceso'
+        candidatos = Pedido.objects.filter(estado='Pendiente').order_by('created_at', 'id')
+        with transaction.atomic():
+            if connection.features.has_select_for_update_skip_locked:
+                # Postgres: las filas que otra estación tiene bloqueadas se saltean, sin esperar
+                ids = list(candidatos.select_for_update(skip_locked=True).values_list('id', flat=True)[:cantidad])
+                elegidos = Pedido.objects.filter(id__in=ids)
+            else:
+                # SQLite: un solo UPDATE ... WHERE id IN (SELECT ... LIMIT n); el lock de
+                # escritura de SQLite serializa las estaciones
+                elegidos = Pedido.objects.filter(id__in=Subquery(candidatos.values('id')[:cantidad]))
+            # RETURNING identifica las filas que tomó ESTA llamada
+            tomados = actualizar_devolviendo_ids(
+                elegidos.filter(estado='Pendiente'),
+                estado=nuevo_estado, updated_at=timezone.now(), version=F('version') + 1
+            )
+            filas = list(Pedido.objects.filter(id__in=tomados)
+                         .values('id', 'fk_usuario_id', 'estado', 'version', 'motivo_correccion')
+                         .order_by('created_at', 'id'))
+            reclamados = [fila['id'] for fila in filas]
+
+            PedidoEstadoHistorial.objects.bulk_create([
+                PedidoEstadoHistorial(fk_pedido_id=pedido_id, estado=nuevo_estado) for pedido_id in reclamados
+            ])
+            encolar_notificaciones(reclamados, nuevo_estado)
+            publicar_cambios_estado(filas)
+            precargar_pedidos(reclamados)
+
+        logger.info(f"{request.user.email} tomó {len(reclamados)} pedidos: {reclamados}")
+        pedidos = pedidos_con_relaciones(Pedido.objects.filter(id__in=reclamados)).order_by('created_at', 'id')
+        return Response({"pedidos": self.get_serializer(pedidos, many=True).data})
+
     @action(detail=True, methods=['post'])
     def corregir_archivos(self, request, pk=None):
         """
         Permite al cliente subir archivos corregidos para un pedido con estado "Requiere Corrección"
         Recalcula el precio del pedido basado en formato, color y cantidad de copias
+        Los archivos se suben primero; después todos los cambios se aplican en una
+        transacción que arranca con un UPDATE condicional sobre la versión leída
+        (o la del header If-Match): si el pedido cambió mientras tanto, 412 y no se toca nada.
         """
+        subidos = []
+        confirmado = False
         try:
             pedido = self.get_object()
             
             # Verificar que el pedido pertenece al usuario
-            if pedido.fk_usuario != request.user:
+            if pedido.fk_usuario_id != request.user.id:
                 return Response(
                     {"error": "No tienes permiso para modificar este pedido"},
                     status=status.HTTP_403_FORBIDDEN
@@ -309,10 +592,12 @@ class PedidoViewSet(viewsets.ModelViewSet):
                     status=status.HTTP_400_BAD_REQUEST
                 )
             
-            import json
-            import uuid
-            from django.core.files.base import ContentFile
-            from cloudinary_storage.storage import RawMediaCloudinaryStorage
+            version = version_if_match(request)
+            if version is not None and version != pedido.version:
+                return Response(
+                    {"error": "El pedido fue modificado. Recargalo y volvé a intentar."},
+                    status=status.HTTP_412_PRECONDITION_FAILED
+                )
             
             # Obtener lista de impresiones a corregir con sus nuevos archivos y configuración
             archivos_corregidos = json.loads(request.data.get('archivos_corregidos', '[]'))
@@ -323,204 +608,263 @@ class PedidoViewSet(viewsets.ModelViewSet):
                     status=status.HTTP_400_BAD_REQUEST
                 )
             
-            storage = RawMediaCloudinaryStorage()
+            # Detalles de impresión del pedido (ya vienen del prefetch de get_queryset)
+            detalles = {d.fk_impresion_id: d for d in pedido.pedidoimpresiondetalle_set.all()}
+            cambios = []  # (detalle, impresion, subido o None)
             
-            # Tabla de precios por hoja
-            precios = {
-                'A4': {'blanco y negro': 20, 'color': 40},
-                'A3': {'blanco y negro': 30, 'color': 60},
-            }
-            
-            # Actualizar cada impresión con el nuevo archivo y recalcular subtotal
+            # Preparar cada impresión con el nuevo archivo y recalcular subtotal (todavía sin guardar)
             for i, archivo_data in enumerate(archivos_corregidos):
                 impresion_id = archivo_data.get('impresion_id')
                 nuevo_formato = archivo_data.get('formato', 'A4')
-                nuevo_color = archivo_data.get('color', 'blanco y negro')
-                nuevas_copias = int(archivo_data.get('copias', 1))
+                nuevo_color = precios.es_color(archivo_data.get('color', 'blanco y negro'))
+                nuevas_copias = precios.entero_positivo(archivo_data.get('copias', 1), 'copias')
+                paginas = precios.entero_positivo(archivo_data.get('paginas') or 1, 'paginas')
                 archivo_nuevo = request.FILES.get(f'archivo_{i}')
+                # Planos grandes: el archivo ya se subió con /subidas/ y se envía el id de la sesión
+                subida_id = archivo_data.get('subida_id')
                 
-                if not archivo_nuevo or not impresion_id:
+                if not (archivo_nuevo or subida_id) or not impresion_id:
                     continue
                 
-                try:
-                    # Buscar la impresión dentro de este pedido
-                    detalle_impresion = PedidoImpresionDetalle.objects.get(
-                        fk_pedido=pedido,
-                        fk_impresion_id=impresion_id
-                    )
+                # Buscar la impresión dentro de este pedido
+                detalle_impresion = detalles.get(int(impresion_id))
+                if detalle_impresion is None:
+                    continue
+                
+                subido = None
+                if subida_id:
+                    sesion = (SesionSubida.objects.select_related('fk_impresion')
+                              .filter(id=subida_id, fk_usuario_id=request.user.id,
+                                      estado='Completada', fk_impresion__isnull=False)
+                              .first())
+                    if sesion is None:
+                        continue
+                    impresion = sesion.fk_impresion
+                    detalle_impresion.fk_impresion = impresion
+                else:
                     impresion = detalle_impresion.fk_impresion
-                    
-                    # Subir nuevo archivo a Cloudinary
-                    extension = os.path.splitext(archivo_nuevo.name)[1]
-                    nombre_archivo_nube = f"impresiones/corregidos/{uuid.uuid4()}{extension}"
-                    path_almacenado = storage.save(nombre_archivo_nube, archivo_nuevo)
-                    url_cloudinary = storage.url(path_almacenado)
-                    
-                    # Actualizar la impresión con los nuevos datos
-                    impresion.archivo = archivo_nuevo
-                    impresion.url = url_cloudinary
+                    impresion.paginas = contar_paginas(archivo_nuevo)
+                # Las páginas contadas en el servidor mandan sobre las que informa el cliente
+                paginas = impresion.paginas or paginas
+                
+                # Tarifa vigente de TipoImpresion; se valida antes de subir el archivo
+                _, subtotal = precios.precio_impresion(nuevo_formato, nuevo_color, nuevas_copias, paginas)
+                
+                if not subida_id:
+                    # Subir nuevo archivo a Cloudinary (si el contenido ya existe se reutiliza)
+                    subido = preparar_subidas({0: archivo_nuevo}, carpeta='impresiones/corregidos')[0]
+                    subidos.append(subido)
                     impresion.nombre_archivo = archivo_nuevo.name
-                    impresion.formato = nuevo_formato
-                    impresion.color = (nuevo_color == 'color')
-                    impresion.save()
-                    
-                    # Recalcular el subtotal del detalle
-                    precio_por_hoja = precios.get(nuevo_formato, {}).get(nuevo_color, 20)
-                    nuevo_subtotal = precio_por_hoja * nuevas_copias
-                    
-                    detalle_impresion.cantidadCopias = nuevas_copias
-                    detalle_impresion.subtotal = nuevo_subtotal
-                    detalle_impresion.save()
-                    
-                except PedidoImpresionDetalle.DoesNotExist:
-                    continue
+                impresion.formato = nuevo_formato
+                impresion.color = nuevo_color
+                
+                # Recalcular el subtotal del detalle
+                detalle_impresion.cantidadCopias = nuevas_copias
+                detalle_impresion.subtotal = subtotal
+                cambios.append((detalle_impresion, impresion, subido))
             
             # Recalcular el total del pedido
             total_productos = sum(
                 d.subtotal for d in pedido.pedidoproductodetalle_set.all()
             )
-            total_impresiones = sum(
-                d.subtotal for d in pedido.pedidoimpresiondetalle_set.all()
-            )
+            total_impresiones = sum(d.subtotal for d in detalles.values())
             total_bruto = total_productos + total_impresiones
             
             # Aplicar descuento del usuario
-            porcentaje_descuento = 0
-            if hasattr(request.user, 'usuarioTipo') and request.user.usuarioTipo:
-                porcentaje_descuento = request.user.usuarioTipo.descuento
-            
-            pedido.total = total_bruto * (1 - (porcentaje_descuento / 100))
-            
-            # Cambiar el estado del pedido a "Pendiente" y limpiar motivo de corrección
-            pedido.estado = "Pendiente"
-            pedido.motivo_correccion = None
-            pedido.save()
+            porcentaje_descuento = request.user.descuento
             
-            # Registrar en el historial
-            PedidoEstadoHistorial.objects.create(
-                fk_pedido=pedido,
-                estado="Pendiente"
-            )
-            
-            # Enviar notificación al cliente informando que recibimos sus archivos corregidos
-            print(f"📧 Enviando notificación de archivos corregidos recibidos...")
-            try:
-                resultado = enviar_notificacion_cambio_estado(pedido)
-                if resultado:
-                    print(f"✅ Notificación enviada exitosamente")
-                else:
-                    print(f"⚠️ No se pudo enviar notificación")
-            except Exception as e:
-                print(f"❌ Error al enviar notificación: {e}")
+            with transaction.atomic():
+                # Cambiar el estado del pedido a "Pendiente" y limpiar motivo de corrección,
+                # solo si nadie lo modificó desde que se leyó
+                actualizado = Pedido.objects.filter(
+                    pk=pedido.pk, version=pedido.version, estado='Requiere Corrección'
+                ).update(
+                    estado="Pendiente",
+                    motivo_correccion=None,
+                    total=total_bruto * (1 - (porcentaje_descuento / 100)),
+                    version=F('version') + 1,
+                    updated_at=timezone.now(),
+                )
+                if not actualizado:
+                    eliminar_subidos(subidos)
+                    return Response(
+                        {"error": "El pedido fue modificado mientras se subían los archivos. Recargalo y volvé a intentar."},
+                        status=status.HTTP_412_PRECONDITION_FAILED
+                    )
+                
+                # Referencias a los archivos deduplicados y guardado de impresiones/detalles
+                vincular_blobs(subidos, blobs.CLOUDINARY)
+                for detalle_impresion, impresion, subido in cambios:
+                    blob_anterior = None
+                    if subido:
+                        # Path ya subido, sin volver a subirlo al guardar
+                        blob_anterior = impresion.fk_blob_id
+                        impresion.archivo = subido.blob.ruta
+                        impresion.url = subido.blob.url
+                        impresion.fk_blob = subido.blob
+                    impresion.save()
+                    detalle_impresion.save()
+                    # El archivo reemplazado se borra si ninguna otra impresión lo usa
+                    if blob_anterior and blob_anterior != impresion.fk_blob_id:
+                        liberar_blob(blob_anterior)
+                # Archivo, formato o color cambiaron: se vuelve a revisar
+                encolar_preflight([impresion.id for _, impresion, _ in cambios])
+                
+                # Registrar en el historial
+                PedidoEstadoHistorial.objects.create(
+                    fk_pedido=pedido,
+                    estado="Pendiente"
+                )
+                
+                # Notificar al cliente que recibimos sus archivos corregidos (lo envía el qcluster)
+                pedido.estado = "Pendiente"
+                encolar_notificacion(pedido)
+                publicar_cambios_estado(
+                    Pedido.objects.filter(pk=pedido.pk).values('id', 'fk_usuario_id', 'estado', 'version', 'motivo_correccion')
+                )
+            confirmado = True
             
+            pedido = self.get_queryset().get(pk=pedido.pk)
             serializer = self.get_serializer(pedido)
-            return Response({
+            response = Response({
                 "message": "Archivos corregidos subidos exitosamente. El precio ha sido recalculado.",
                 "pedido": serializer.data
             }, status=status.HTTP_200_OK)
+            response['ETag'] = etag_pedido(pedido.version)
+            return response
             
+        except ValidationError:
+            raise
         except Exception as e:
             import traceback
             print(traceback.format_exc())
+            # Si la transacción no se confirmó, los archivos subidos quedarían huérfanos
+            if subidos and not confirmado:
+                eliminar_subidos(subidos)
             return Response(
                 {"error": str(e)},
                 status=status.HTTP_400_BAD_REQUEST
             )
 
-    @transaction.atomic
+    @action(detail=False, methods=['post'])
+    def cotizar(self, request):
+        """
+        Cotiza un carrito sin crear el pedido, con el descuento del usuario.
+        Body: {"detalles": [{"fk_producto": 1, "cantidad": 2}],
+               "impresiones": [{"formato": "A4", "color": "color", "copias": 3, "paginas": 10}]}
+        """
+        try:
+            cotizacion = precios.cotizar(request.data.get('detalles') or [],
+                                         request.data.get('impresiones') or [],
+                                         request.user.descuento)
+        except (Producto.DoesNotExist, ValueError, KeyError, TypeError) as e:
+            return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        return Response(cotizacion.datos())
+
     def create(self, request, *args, **kwargs):
+        """
+        Alta de pedido armando todas las filas en memoria: una query para los
+        productos, un INSERT del pedido con el total ya calculado y un
+        bulk_create por tabla de detalle/impresiones.
+        Los archivos se suben en paralelo ANTES de abrir la transacción, así la
+        conexión a la base no queda tomada mientras dura la subida. Los que ya
+        estaban almacenados (mismo SHA-256) no se vuelven a subir.
+        """
+        subidos = {}
+        confirmado = False
         try:
             user = request.user
-            import json
-            import uuid
-            from django.core.files.base import ContentFile
-            from cloudinary_storage.storage import RawMediaCloudinaryStorage
 
             # 1. Parseo de datos desde FormData
             detalles_productos = json.loads(request.data.get('detalles', '[]'))
             detalles_impresiones_metadata = json.loads(request.data.get('impresiones', '[]'))
             observacion = request.data.get('observacion', '')
 
-            # 2. Crear el Pedido inicial
-            pedido = Pedido.objects.create(
-                fk_usuario=user, 
-                total=0, 
-                observacion=observacion,
-                estado="Pendiente"
-            )
-            total_bruto = 0
-
-            # 3. Procesar Productos de catálogo
-            for det in detalles_productos:
-                producto = Producto.objects.get(id=det['fk_producto'])
-                cantidad = int(det.get('cantidad', 1))
-                sub_p = float(producto.precioUnitario) * cantidad
-                total_bruto += sub_p
-                
-                PedidoProductoDetalle.objects.create(
-                    fk_pedido=pedido, 
-                    fk_producto=producto, 
-                    cantidad=cantidad, 
-                    subtotal=sub_p
-                )
-
-            # 4. Procesar Impresiones (Subida MANUAL a Cloudinary)
+            # 2. Precios calculados en el servidor (precios.py): productos en una
+            # query y tarifas de TipoImpresion en memoria. El subtotal que mande el cliente se ignora
+            # y las páginas se cuentan del PDF subido (pdf.py) cuando se puede.
+            paginas_contadas = {}
             for i, imp_data in enumerate(detalles_impresiones_metadata):
-                archivo_real = request.FILES.get(f'archivo_impresion_{i}')
-                url_cloudinary = "temporal"
-                
-                if archivo_real:
-                    # Usamos el mismo storage que usas en los reportes
-                    storage = RawMediaCloudinaryStorage()
-                    
-                    # Generamos un nombre único para la carpeta 'impresiones' en Cloudinary
-                    extension = os.path.splitext(archivo_real.name)[1]
-                    nombre_archivo_nube = f"impresiones/{uuid.uuid4()}{extension}"
-                    
-                    # Guardamos el archivo directamente en Cloudinary
-                    path_almacenado = storage.save(nombre_archivo_nube, archivo_real)
-                    # Obtenemos la URL pública real
-                    url_cloudinary = storage.url(path_almacenado)
-
-                # Crear objeto Impresion con la URL de la nube
-                nueva_imp = Impresion.objects.create(
-                    nombre_archivo=imp_data.get('nombre_archivo', archivo_real.name if archivo_real else 'archivo.pdf'),
-                    formato=imp_data.get('formato', 'A4'),
-                    color=str(imp_data.get('color')).lower() == 'color',
-                    archivo=archivo_real,  # Se guarda el objeto archivo
-                    url=url_cloudinary,    # Guardamos el link de Cloudinary aquí
-                    fk_usuario=user
-                )
+                archivo = request.FILES.get(f'archivo_impresion_{i}')
+                paginas_contadas[i] = contar_paginas(archivo) if archivo else None
+                if paginas_contadas[i]:
+                    imp_data['paginas'] = paginas_contadas[i]
+            cotizacion = precios.cotizar(detalles_productos, detalles_impresiones_metadata, user.descuento)
+            filas_productos = [
+                PedidoProductoDetalle(fk_producto_id=linea['fk_producto'], cantidad=linea['cantidad'],
+                                      subtotal=linea['subtotal'])
+                for linea in cotizacion.productos
+            ]
 
-                subtotal_imp = float(imp_data.get('subtotal', 0))
-                total_bruto += subtotal_imp
+            # 3. Impresiones: todas las subidas a Cloudinary en paralelo, fuera de la transacción
+            subidos = preparar_subidas({
+                i: request.FILES.get(f'archivo_impresion_{i}')
+                for i in range(len(detalles_impresiones_metadata))
+            })
+            impresiones = []
+            filas_impresiones = []
+            for i, (imp_data, linea) in enumerate(zip(detalles_impresiones_metadata, cotizacion.impresiones)):
+                subido = subidos.get(i)
+                impresiones.append(Impresion(
+                    nombre_archivo=imp_data.get('nombre_archivo', subido.nombre_original if subido else 'archivo.pdf'),
+                    formato=linea['formato'],
+                    color=linea['color'],
+                    # Se guarda el path ya subido: pasar el UploadedFile lo volvería a subir al guardar
+                    archivo=subido.nombre if subido else None,
+                    url=subido.url if subido else "temporal",  # Link de Cloudinary
+                    paginas=paginas_contadas[i],
+                    fk_usuario_id=user.id
+                ))
 
-                # Crear el Detalle vinculado (campo fk_impresion)
-                PedidoImpresionDetalle.objects.create(
-                    fk_pedido=pedido,
-                    fk_impresion=nueva_imp, 
-                    cantidadCopias=int(imp_data.get('copias', 1)),
-                    subtotal=subtotal_imp
-                )
+                filas_impresiones.append(PedidoImpresionDetalle(
+                    cantidadCopias=linea['copias'],
+                    subtotal=linea['subtotal']
+                ))
 
-            # 5. Cálculo final con descuento
-            porcentaje_descuento = 0
-            if hasattr(user, 'usuarioTipo') and user.usuarioTipo:
-                porcentaje_descuento = user.usuarioTipo.descuento
+            # 4. Total con descuento ya calculado: el pedido se guarda una sola vez
+            with transaction.atomic():
+                # Referencias a los archivos deduplicados (se revierten si falla el alta)
+                vincular_blobs(subidos.values(), blobs.CLOUDINARY)
+                for i, impresion in enumerate(impresiones):
+                    subido = subidos.get(i)
+                    if subido:
+                        impresion.fk_blob = subido.blob
+                        impresion.archivo, impresion.url = subido.blob.ruta, subido.blob.url
 
-            pedido.total = total_bruto * (1 - (porcentaje_descuento / 100))
-            pedido.save()
+                pedido = Pedido.objects.create(
+                    fk_usuario_id=user.id,
+                    total=cotizacion.total,
+                    observacion=observacion,
+                    estado="Pendiente"
+                )
+
+                # 5. Inserts en lote (bulk_create devuelve los ids en Postgres y SQLite >= 3.35)
+                Impresion.objects.bulk_create(impresiones)
+                for fila in filas_productos:
+                    fila.fk_pedido = pedido
+                for fila, impresion in zip(filas_impresiones, impresiones):
+                    fila.fk_pedido = pedido
+                    fila.fk_impresion = impresion
+                PedidoProductoDetalle.objects.bulk_create(filas_productos)
+                PedidoImpresionDetalle.objects.bulk_create(filas_impresiones)
+                # Revisión de los archivos (páginas, tamaño, color) en el cluster
+                encolar_preflight([impresion.id for i, impresion in enumerate(impresiones) if subidos.get(i)])
+            confirmado = True
 
+            pedido = pedidos_con_relaciones(Pedido.objects.filter(pk=pedido.pk)).get()
             return Response(self.get_serializer(pedido).data, status=status.HTTP_201_CREATED)
 
         except Exception as e:
             import traceback
             print(traceback.format_exc())
+            # Si la transacción no se confirmó, los archivos subidos quedarían huérfanos
+            if subidos and not confirmado:
+                eliminar_subidos(subidos.values())
             return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
 
 
 
-class ImpresionViewSet(viewsets.ModelViewSet):
+class ImpresionViewSet(CursorOpcionalMixin, viewsets.ModelViewSet):
     queryset = Impresion.objects.all()
     serializer_class = ImpresionSerializer
     parser_classes = (MultiPartParser, FormParser, JSONParser)
@@ -528,21 +872,8 @@ class ImpresionViewSet(viewsets.ModelViewSet):
     
     def get_cloudflare_client(self):
         """Inicializa el cliente S3 para Cloudflare R2"""
-        # Configuración para Cloudflare R2
-        # Estas credenciales deberían estar en variables de entorno
-        account_id = os.getenv('CLOUDFLARE_ACCOUNT_ID', 'tu-account-id')
-        access_key = os.getenv('CLOUDFLARE_ACCESS_KEY', 'tu-access-key')
-        secret_key = os.getenv('CLOUDFLARE_SECRET_KEY', 'tu-secret-key')
-        bucket_name = os.getenv('CLOUDFLARE_BUCKET_NAME', 'suchus-impresiones')
-        
-        s3 = boto3.client(
-            's3',
-            endpoint_url=f'https://{account_id}.r2.cloudflarestorage.com',
-            aws_access_key_id=access_key,
-            aws_secret_access_key=secret_key,
-            region_name='auto'
-        )
-        return s3, bucket_name
+        # Las credenciales salen de variables de entorno (ver almacenamiento.config_r2)
+        return cliente_r2()
     
     def get_queryset(self):
         queryset = Impresion.objects.all()
@@ -569,37 +900,54 @@ class ImpresionViewSet(viewsets.ModelViewSet):
                 status=status.HTTP_400_BAD_REQUEST
             )
         
+        subido = None
+        confirmado = False
         try:
-            # Generar nombre único para el archivo
-            extension = archivo.name.split('.')[-1] if '.' in archivo.name else 'pdf'
-            cloudflare_key = f"impresiones/{uuid.uuid4()}.{extension}"
-            
-            # Subir a Cloudflare R2
-            s3, bucket_name = self.get_cloudflare_client()
-            s3.upload_fileobj(
-                archivo,
-                bucket_name,
-                cloudflare_key,
-                ExtraArgs={'ContentType': archivo.content_type}
-            )
-            
-            # Generar URL pública
-            url = f"https://pub-{os.getenv('CLOUDFLARE_PUB_ID', 'your-pub-id')}.r2.dev/{cloudflare_key}"
+            # Si el mismo contenido ya está en el bucket se reutiliza el objeto
+            digest = sha256_archivo(archivo)
+            paginas = contar_paginas(archivo)
+            blob = buscar_blobs([digest], blobs.R2).get(digest)
+            if blob is not None:
+                subido = ArchivoSubido(blob.ruta, blob.url, archivo.name, sha256=digest,
+                                       tamanio=archivo.size, nuevo=False)
+            else:
+                # Generar nombre único para el archivo
+                cloudflare_key = nueva_clave_r2(archivo.name)
+                
+                # Subir a Cloudflare R2
+                s3, bucket_name = self.get_cloudflare_client()
+                s3.upload_fileobj(
+                    archivo,
+                    bucket_name,
+                    cloudflare_key,
+                    ExtraArgs={'ContentType': archivo.content_type}
+                )
+                subido = ArchivoSubido(cloudflare_key, url_publica_r2(cloudflare_key), archivo.name,
+                                       sha256=digest, tamanio=archivo.size)
             
             # Crear registro en BD
-            impresion = Impresion.objects.create(
-                color=request.data.get('color', 'false').lower() == 'true',
-                formato=request.data.get('formato', 'A4'),
-                url=url,
-                nombre_archivo=archivo.name,
-                cloudflare_key=cloudflare_key,
-                fk_usuario_id=request.data.get('fk_usuario') if request.data.get('fk_usuario') else None
-            )
+            with transaction.atomic():
+                vincular_blobs([subido], blobs.R2)
+                impresion = Impresion.objects.create(
+                    color=request.data.get('color', 'false').lower() == 'true',
+                    formato=request.data.get('formato', 'A4'),
+                    url=subido.blob.url,
+                    nombre_archivo=archivo.name,
+                    cloudflare_key=subido.blob.ruta,
+                    fk_blob=subido.blob,
+                    paginas=paginas,
+                    fk_usuario_id=request.data.get('fk_usuario') if request.data.get('fk_usuario') else None
+                )
+                encolar_preflight([impresion.id])
+            confirmado = True
             
             serializer = self.get_serializer(impresion)
             return Response(serializer.data, status=status.HTTP_201_CREATED)
             
         except Exception as e:
+            # Un objeto recién subido que no llegó a registrarse quedaría huérfano
+            if subido is not None and subido.nuevo and not confirmado:
+                blobs.borrar_objeto(blobs.R2, subido.nombre)
             return Response(
                 {"error": f"Error al subir archivo: {str(e)}"}, 
                 status=status.HTTP_500_INTERNAL_SERVER_ERROR
@@ -610,9 +958,8 @@ class ImpresionViewSet(viewsets.ModelViewSet):
         partial = kwargs.pop('partial', False)
         instance = self.get_object()
         
-        # Actualizar last_accessed al acceder
-        instance.last_accessed = timezone.now()
-        instance.save()
+        # El acceso se guarda en el próximo volcado (accesos.py), sin un UPDATE propio
+        registrar_acceso(instance.id)
         
         serializer = self.get_serializer(instance, data=request.data, partial=partial)
         serializer.is_valid(raise_exception=True)
@@ -625,8 +972,9 @@ class ImpresionViewSet(viewsets.ModelViewSet):
         instance = self.get_object()
         
         try:
-            # Eliminar de Cloudflare R2 si existe la key
-            if instance.cloudflare_key:
+            # Eliminar de Cloudflare R2 si existe la key. Los archivos deduplicados
+            # los borra la señal de blobs.py cuando se va la última referencia.
+            if instance.cloudflare_key and instance.fk_blob_id is None:
                 s3, bucket_name = self.get_cloudflare_client()
                 s3.delete_object(Bucket=bucket_name, Key=instance.cloudflare_key)
             
@@ -643,48 +991,375 @@ class ImpresionViewSet(viewsets.ModelViewSet):
                 status=status.HTTP_500_INTERNAL_SERVER_ERROR
             )
     
+    @action(detail=False, methods=['post'])
+    def solicitar_subida(self, request):
+        """
+        Subida directa al bucket: devuelve una URL prefirmada de R2 para que el
+        navegador haga PUT del archivo sin pasar por nuestros workers.
+        Archivos grandes (más de SUBIDA_DIRECTA['UMBRAL_MULTIPART']) reciben un
+        multipart upload con una URL prefirmada por parte.
+        Body: nombre_archivo, content_type, tamanio (bytes)
+        """
+        nombre_archivo = request.data.get('nombre_archivo')
+        if not nombre_archivo:
+            return Response({"error": "El campo 'nombre_archivo' es requerido"},
+                            status=status.HTTP_400_BAD_REQUEST)
+        try:
+            tamanio = int(request.data.get('tamanio', 0))
+        except (TypeError, ValueError):
+            return Response({"error": "El tamaño debe ser un número de bytes"},
+                            status=status.HTTP_400_BAD_REQUEST)
+
+        config = settings.SUBIDA_DIRECTA
+        content_type = request.data.get('content_type') or 'application/pdf'
+        cloudflare_key = nueva_clave_r2(nombre_archivo)
+        s3, bucket_name = self.get_cloudflare_client()
+
+        try:
+            if tamanio <= config['UMBRAL_MULTIPART']:
+                url = s3.generate_presigned_url(
+                    'put_object',
+                    Params={'Bucket': bucket_name, 'Key': cloudflare_key, 'ContentType': content_type},
+                    ExpiresIn=config['EXPIRACION'],
+                )
+                datos = {"metodo": "PUT", "url": url, "headers": {"Content-Type": content_type}}
+                upload_id = None
+            else:
+                multipart = s3.create_multipart_upload(
+                    Bucket=bucket_name, Key=cloudflare_key, ContentType=content_type
+                )
+                upload_id = multipart['UploadId']
+                bytes_parte = config['BYTES_PARTE']
+                cantidad_partes = -(-tamanio // bytes_parte)
+                datos = {
+                    "metodo": "MULTIPART",
+                    "upload_id": upload_id,
+                    "bytes_parte": bytes_parte,
+                    "partes": [
+                        {
+                            "numero": numero,
+                            "url": s3.generate_presigned_url(
+                                'upload_part',
+                                Params={'Bucket': bucket_name, 'Key': cloudflare_key,
+                                        'UploadId': upload_id, 'PartNumber': numero},
+                                ExpiresIn=config['EXPIRACION'],
+                            ),
+                        }
+                        for numero in range(1, cantidad_partes + 1)
+                    ],
+                }
+        except Exception as e:
+            return Response({"error": f"Error al preparar la subida: {str(e)}"},
+                            status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+        # El token ata la key al usuario: completar_subida no acepta keys ajenas
+        datos["token_subida"] = signing.dumps(
+            {"key": cloudflare_key, "upload_id": upload_id, "usuario": request.user.id},
+            salt='subida-directa'
+        )
+        datos["cloudflare_key"] = cloudflare_key
+        datos["expira_en"] = config['EXPIRACION']
+        return Response(datos, status=status.HTTP_201_CREATED)
+
+    @action(detail=False, methods=['post'])
+    def completar_subida(self, request):
+        """
+        Registra la Impresion de un archivo ya subido con solicitar_subida.
+        Body: token_subida, nombre_archivo, formato, color y, para multipart,
+        partes: [{"numero": 1, "etag": "..."}, ...]
+        """
+        try:
+            datos_token = signing.loads(
+                request.data.get('token_subida', ''), salt='subida-directa',
+                max_age=settings.SUBIDA_DIRECTA['EXPIRACION'] * 2
+            )
+        except signing.BadSignature:
+            return Response({"error": "Token de subida inválido o vencido"},
+                            status=status.HTTP_400_BAD_REQUEST)
+        if datos_token['usuario'] != request.user.id:
+            return Response({"error": "La subida pertenece a otro usuario"},
+                            status=status.HTTP_403_FORBIDDEN)
+
+        cloudflare_key = datos_token['key']
+        s3, bucket_name = self.get_cloudflare_client()
+        try:
+            if datos_token['upload_id']:
+                partes = request.data.get('partes') or []
+                if isinstance(partes, str):
+                    partes = json.loads(partes)
+                s3.complete_multipart_upload(
+                    Bucket=bucket_name, Key=cloudflare_key, UploadId=datos_token['upload_id'],
+                    MultipartUpload={'Parts': sorted(
+                        ({'PartNumber': int(p['numero']), 'ETag': p['etag']} for p in partes),
+                        key=lambda p: p['PartNumber']
+                    )},
+                )
+            # Confirmar que el objeto realmente está en el bucket
+            tamanio = s3.head_object(Bucket=bucket_name, Key=cloudflare_key)['ContentLength']
+        except Exception as e:
+            return Response({"error": f"El archivo no se pudo confirmar en el bucket: {str(e)}"},
+                            status=status.HTTP_400_BAD_REQUEST)
+
+        impresion, creada = Impresion.objects.get_or_create(
+            cloudflare_key=cloudflare_key,
+            defaults={
+                'color': str(request.data.get('color', 'false')).lower() == 'true',
+                'formato': request.data.get('formato', 'A4'),
+                'url': url_publica_r2(cloudflare_key),
+                'nombre_archivo': request.data.get('nombre_archivo') or cloudflare_key.split('/')[-1],
+                'fk_usuario_id': request.user.id,
+                'paginas': contar_paginas_r2(s3, bucket_name, cloudflare_key, tamanio),
+            }
+        )
+        if creada:
+            encolar_preflight([impresion.id])
+        serializer = self.get_serializer(impresion)
+        return Response(serializer.data, status=status.HTTP_201_CREATED)
+
+    @action(detail=True, methods=['get'])
+    def descargar(self, request, pk=None):
+        """
+        Endpoint: GET /api/impresiones/<id>/descargar/
+        Sirve el archivo desde la caché en disco del local (cache_archivos.py); si no
+        está, lo baja una vez de Cloudinary/R2. Soporta Range (206) para visores de PDF.
+        """
+        impresion = self.get_object()
+        nombre = impresion.nombre_archivo or f"impresion-{impresion.id}.pdf"
+        error = None
+        for _ in range(2):
+            try:
+                ruta = cache_archivos().obtener(impresion)
+                respuesta = servir(request, ruta, nombre, f'"{clave_de(impresion)}"')
+            except FileNotFoundError as e:
+                # Otro request lo desalojó entre obtener() y la apertura: se vuelve a bajar
+                error = e
+                continue
+            except Exception as e:
+                error = e
+                break
+            registrar_acceso(impresion.id)
+            return respuesta
+        print(f"❌ No se pudo obtener el archivo de la impresión #{impresion.id}: {error}")
+        return Response({"error": "No se pudo obtener el archivo"}, status=status.HTTP_502_BAD_GATEWAY)
+
     @action(detail=True, methods=['patch'])
     def actualizar_acceso(self, request, pk=None):
-        """Actualiza el timestamp de último acceso"""
+        """Registra el acceso; se guarda junto con los demás en el próximo volcado (accesos.py)"""
         impresion = self.get_object()
-        impresion.last_accessed = timezone.now()
-        impresion.save()
+        impresion.last_accessed = registrar_acceso(impresion.id)
         serializer = self.get_serializer(impresion)
         return Response(serializer.data)
     
     @action(detail=False, methods=['post'])
     def limpiar_antiguos(self, request):
-        """Elimina impresiones sin usar por más de X días"""
-        dias = int(request.data.get('dias', 30))
-        fecha_limite = timezone.now() - timedelta(days=dias)
-        
-        impresiones_antiguas = Impresion.objects.filter(last_accessed__lt=fecha_limite)
-        count = impresiones_antiguas.count()
-        
+        """
+        Elimina impresiones sin usar por más de X días.
+        Responde enseguida con el id del trabajo; la limpieza la hace el cluster
+        (limpieza.py) y el avance se consulta en /impresiones/limpiezas/<id>/.
+        """
         try:
-            s3, bucket_name = self.get_cloudflare_client()
-            
-            # Eliminar archivos de Cloudflare
-            for impresion in impresiones_antiguas:
-                if impresion.cloudflare_key:
-                    try:
-                        s3.delete_object(Bucket=bucket_name, Key=impresion.cloudflare_key)
-                    except:
-                        pass
-            
-            # Eliminar registros de BD
-            impresiones_antiguas.delete()
-            
-            return Response(
-                {"mensaje": f"{count} impresiones eliminadas", "dias": dias}, 
-                status=status.HTTP_200_OK
+            dias = int(request.data.get('dias', 30))
+        except (TypeError, ValueError):
+            return Response({"error": "'dias' debe ser un número entero"}, status=status.HTTP_400_BAD_REQUEST)
+        if dias < 1:
+            return Response({"error": "'dias' debe ser mayor a 0"}, status=status.HTTP_400_BAD_REQUEST)
+
+        limpieza = iniciar_limpieza(dias, request.user)
+        return Response(
+            {"mensaje": "Limpieza encolada", "id": limpieza.id, "estado": limpieza.estado, "dias": dias},
+            status=status.HTTP_202_ACCEPTED
+        )
+
+    @action(detail=False, methods=['get'], url_path=r'limpiezas/(?P<limpieza_id>\d+)')
+    def estado_limpieza(self, request, limpieza_id=None):
+        """Avance de un trabajo de limpieza"""
+        limpieza = LimpiezaAlmacenamiento.objects.filter(id=limpieza_id).first()
+        if limpieza is None:
+            return Response({"error": "Limpieza no encontrada"}, status=status.HTTP_404_NOT_FOUND)
+        return Response({
+            "id": limpieza.id,
+            "estado": limpieza.estado,
+            "dias": limpieza.dias,
+            "eliminadas": limpieza.eliminadas,
+            "fallidas": limpieza.fallidas,
+            "pendientes": limpieza.pendientes,
+            "errores": limpieza.errores,
+            "created_at": limpieza.created_at,
+            "finalizada_at": limpieza.finalizada_at,
+        })
+
+class SubidaViewSet(mixins.RetrieveModelMixin, mixins.DestroyModelMixin, viewsets.GenericViewSet):
+    """
+    Subida reanudable por partes para planos grandes (A0/A1):
+    1. POST   /subidas/                      -> abre la sesión (y el multipart upload en R2)
+    2. PUT    /subidas/{id}/partes/{n}/      -> cuerpo = bytes de la parte, header X-Checksum-SHA256
+    3. GET    /subidas/{id}/                 -> offset confirmado y partes faltantes (para reanudar)
+    4. POST   /subidas/{id}/completar/       -> arma el objeto en R2 y crea la Impresion
+    DELETE /subidas/{id}/ cancela la sesión y aborta el multipart upload.
+    """
+    serializer_class = SesionSubidaSerializer
+    permission_classes = [permissions.IsAuthenticated]
+
+    def get_queryset(self):
+        return SesionSubida.objects.filter(fk_usuario_id=self.request.user.id).select_related('fk_impresion')
+
+    def create(self, request, *args, **kwargs):
+        """Body: nombre_archivo, tamanio (bytes), content_type, formato, color"""
+        nombre_archivo = request.data.get('nombre_archivo')
+        try:
+            tamanio = int(request.data.get('tamanio', 0))
+        except (TypeError, ValueError):
+            tamanio = 0
+        config = settings.SUBIDA_PARTES
+        if not nombre_archivo or tamanio <= 0:
+            return Response({"error": "Se requieren 'nombre_archivo' y 'tamanio' (bytes)"},
+                            status=status.HTTP_400_BAD_REQUEST)
+        if tamanio > config['TAMANIO_MAXIMO']:
+            return Response({"error": f"El archivo supera el máximo de {config['TAMANIO_MAXIMO']} bytes"},
+                            status=status.HTTP_400_BAD_REQUEST)
+
+        # S3/R2 admiten hasta 10.000 partes por objeto
+        bytes_parte = max(config['BYTES_PARTE'], -(-tamanio // 10000))
+        content_type = request.data.get('content_type') or 'application/pdf'
+        cloudflare_key = nueva_clave_r2(nombre_archivo)
+        s3, bucket_name = cliente_r2()
+        try:
+            multipart = s3.create_multipart_upload(
+                Bucket=bucket_name, Key=cloudflare_key, ContentType=content_type
             )
-            
         except Exception as e:
-            return Response(
-                {"error": f"Error en limpieza: {str(e)}"}, 
-                status=status.HTTP_500_INTERNAL_SERVER_ERROR
+            return Response({"error": f"Error al iniciar la subida: {str(e)}"},
+                            status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+        sesion = SesionSubida.objects.create(
+            fk_usuario_id=request.user.id,
+            nombre_archivo=nombre_archivo,
+            content_type=content_type,
+            tamanio=tamanio,
+            bytes_parte=bytes_parte,
+            formato=request.data.get('formato', 'A4'),
+            color=str(request.data.get('color', 'false')).lower() == 'true',
+            cloudflare_key=cloudflare_key,
+            upload_id=multipart['UploadId'],
+        )
+        return Response(self.get_serializer(sesion).data, status=status.HTTP_201_CREATED)
+
+    def destroy(self, request, *args, **kwargs):
+        sesion = self.get_object()
+        if sesion.estado != 'Activa':
+            return Response({"error": f"La subida ya está {sesion.estado.lower()}"},
+                            status=status.HTTP_409_CONFLICT)
+        s3, bucket_name = cliente_r2()
+        try:
+            s3.abort_multipart_upload(Bucket=bucket_name, Key=sesion.cloudflare_key, UploadId=sesion.upload_id)
+        except Exception as e:
+            print(f"⚠️ No se pudo abortar el multipart {sesion.upload_id}: {e}")
+        sesion.estado = 'Cancelada'
+        sesion.save(update_fields=['estado', 'updated_at'])
+        return Response(status=status.HTTP_204_NO_CONTENT)
+
+    @action(detail=True, methods=['put'], url_path=r'partes/(?P<numero>\d+)')
+    def subir_parte(self, request, pk=None, numero=None):
+        """
+        Recibe una parte cruda (Content-Type: application/octet-stream) y la sube
+        como parte del multipart upload. Reenviar una parte ya confirmada con el
+        mismo checksum es idempotente; con otro checksum la reemplaza.
+        """
+        sesion = self.get_object()
+        numero = int(numero)
+        if sesion.estado != 'Activa':
+            return Response({"error": f"La subida ya está {sesion.estado.lower()}"},
+                            status=status.HTTP_409_CONFLICT)
+        if not 1 <= numero <= sesion.cantidad_partes:
+            return Response({"error": f"La parte debe estar entre 1 y {sesion.cantidad_partes}"},
+                            status=status.HTTP_400_BAD_REQUEST)
+
+        checksum = (request.headers.get('X-Checksum-SHA256') or '').lower()
+        if len(checksum) != 64:
+            return Response({"error": "Header X-Checksum-SHA256 (hex) requerido"},
+                            status=status.HTTP_400_BAD_REQUEST)
+
+        previa = sesion.partes.get(str(numero))
+        if previa and previa['sha256'] == checksum:
+            return Response(self.get_serializer(sesion).data)
+
+        esperado = sesion.bytes_de_parte(numero)
+        if request.stream is None:
+            return Response({"error": "Cuerpo vacío (se requiere Content-Length)"},
+                            status=status.HTTP_400_BAD_REQUEST)
+        # Se lee un byte de más para detectar partes más largas de lo declarado
+        parte = leer_parte(request.stream, esperado + 1)
+        try:
+            if parte.bytes_leidos != esperado:
+                return Response({"error": f"La parte {numero} debe tener {esperado} bytes y llegaron {parte.bytes_leidos}"},
+                                status=status.HTTP_400_BAD_REQUEST)
+            if parte.sha256 != checksum:
+                return Response({"error": "El checksum no coincide: reenviar la parte"},
+                                status=status.HTTP_422_UNPROCESSABLE_ENTITY)
+
+            s3, bucket_name = cliente_r2()
+            respuesta = s3.upload_part(
+                Bucket=bucket_name, Key=sesion.cloudflare_key, UploadId=sesion.upload_id,
+                PartNumber=numero, Body=parte.archivo, ContentLength=esperado,
+                ContentMD5=parte.md5_b64,
             )
+        except Exception as e:
+            return Response({"error": f"Error al subir la parte {numero}: {str(e)}"},
+                            status=status.HTTP_502_BAD_GATEWAY)
+        finally:
+            parte.archivo.close()
+
+        # Las partes pueden llegar en paralelo: se bloquea la fila para no pisar el JSON
+        with transaction.atomic():
+            sesion = SesionSubida.objects.select_for_update().get(pk=sesion.pk)
+            if sesion.estado != 'Activa':
+                return Response({"error": f"La subida ya está {sesion.estado.lower()}"},
+                                status=status.HTTP_409_CONFLICT)
+            sesion.partes[str(numero)] = {'etag': respuesta['ETag'], 'sha256': checksum, 'bytes': esperado}
+            sesion.save(update_fields=['partes', 'updated_at'])
+        return Response(self.get_serializer(sesion).data)
+
+    @action(detail=True, methods=['post'])
+    def completar(self, request, pk=None):
+        """Une las partes en R2 y crea la Impresion. Es idempotente."""
+        with transaction.atomic():
+            sesion = self.get_queryset().select_for_update().get(pk=self.get_object().pk)
+            if sesion.estado == 'Completada':
+                return Response(self.get_serializer(sesion).data)
+            if sesion.estado != 'Activa':
+                return Response({"error": "La subida fue cancelada"}, status=status.HTTP_409_CONFLICT)
+            if sesion.partes_faltantes:
+                return Response({"error": "Faltan partes", "partes_faltantes": sesion.partes_faltantes},
+                                status=status.HTTP_409_CONFLICT)
+
+            s3, bucket_name = cliente_r2()
+            try:
+                s3.complete_multipart_upload(
+                    Bucket=bucket_name, Key=sesion.cloudflare_key, UploadId=sesion.upload_id,
+                    MultipartUpload={'Parts': [
+                        {'PartNumber': numero, 'ETag': sesion.partes[str(numero)]['etag']}
+                        for numero in range(1, sesion.cantidad_partes + 1)
+                    ]},
+                )
+            except Exception as e:
+                return Response({"error": f"No se pudo completar la subida: {str(e)}"},
+                                status=status.HTTP_502_BAD_GATEWAY)
+
+            sesion.fk_impresion = Impresion.objects.create(
+                color=sesion.color,
+                formato=sesion.formato,
+                url=url_publica_r2(sesion.cloudflare_key),
+                nombre_archivo=sesion.nombre_archivo,
+                cloudflare_key=sesion.cloudflare_key,
+                fk_usuario_id=sesion.fk_usuario_id,
+                # Lee por rangos solo la cola, la xref y el árbol de páginas del objeto ya armado
+                paginas=contar_paginas_r2(s3, bucket_name, sesion.cloudflare_key, sesion.tamanio),
+            )
+            sesion.estado = 'Completada'
+            sesion.save(update_fields=['fk_impresion', 'estado', 'updated_at'])
+            encolar_preflight([sesion.fk_impresion_id])
+        return Response(self.get_serializer(sesion).data, status=status.HTTP_201_CREATED)
+
 
 class ProductoViewSet(viewsets.ModelViewSet):
     queryset = Producto.objects.all()
@@ -714,6 +1389,12 @@ class ProductoViewSet(viewsets.ModelViewSet):
         
         return queryset.order_by('-created_at')
     
+    def list(self, request, *args, **kwargs):
+        # GET condicional: 304 si el catálogo no cambió desde la última consulta
+        listar = super().list
+        return respuesta_condicional(request, self.get_queryset(),
+                                     lambda: listar(request, *args, **kwargs))
+    
     def create(self, request, *args, **kwargs):
         """Alta de producto"""
         serializer = self.get_serializer(data=request.data)
@@ -999,8 +1680,10 @@ class TipoImpresionViewSet(viewsets.ModelViewSet):
     def activos(self, request):
         """Listar solo tipos de impresión activos"""
         tipos_activos = TipoImpresion.objects.filter(activo=True).order_by('formato', 'color')
-        serializer = self.get_serializer(tipos_activos, many=True)
-        return Response(serializer.data)
+        return respuesta_condicional(
+            request, tipos_activos,
+            lambda: Response(self.get_serializer(tipos_activos, many=True).data)
+        )
     
     @action(detail=True, methods=['patch'])
     def actualizar_precio(self, request, pk=None):
@@ -1039,7 +1722,7 @@ class TipoImpresionViewSet(viewsets.ModelViewSet):
             "tipo_impresion": serializer.data
         })
 
-class UsuarioViewSet(viewsets.ModelViewSet):
+class UsuarioViewSet(CursorOpcionalMixin, viewsets.ModelViewSet):
     queryset = Usuario.objects.all()
     
     def get_serializer_class(self):
@@ -1162,6 +1845,7 @@ class UsuarioViewSet(viewsets.ModelViewSet):
                 )
         
         usuario.activo = False
+        usuario.token_version += 1  # invalida los tokens con claims ya emitidos
         usuario.save()
         
         serializer = self.get_serializer(usuario)
@@ -1281,6 +1965,7 @@ class UsuarioViewSet(viewsets.ModelViewSet):
             )
         
         usuario.usuarioTipo = tipo_admin
+        usuario.token_version += 1  # invalida los tokens con claims ya emitidos
         usuario.save()
         
         serializer = self.get_serializer(usuario)
@@ -1297,11 +1982,12 @@ class UsuarioViewSet(viewsets.ModelViewSet):
         del usuario que está logueado actualmente.
         """
         user = request.user
-        # Accedemos a la relación usuarioTipo definida en tu modelo
-        if user.usuarioTipo:
+        # Con JWT_CLAIMS_AUTH el tipo y el descuento vienen firmados en el token
+        if user.usuarioTipo_id:
+            tipo = user.tipo if hasattr(user, 'tipo') else user.usuarioTipo.descripcion
             return Response({
-                "tipo": user.usuarioTipo.descripcion,
-                "descuento": user.usuarioTipo.descuento
+                "tipo": tipo,
+                "descuento": user.descuento
             })
         
         return Response({"tipo": "Sin Tipo", "descuento": 0})
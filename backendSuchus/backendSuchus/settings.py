@@ -47,7 +47,7 @@ INSTALLED_APPS = [
     'corsheaders',
     'cloudinary',
     'cloudinary_storage',
-    
+    'django_q',  # cola de tareas (worker: qcluster en el Procfile)
 ]
 Q_CLUSTER = {
     'name': 'DjangORM',
@@ -57,6 +57,9 @@ Q_CLUSTER = {
     'queue_limit': 50,
     'bulk': 10,
     'orm': 'default',    # Almacena las tareas en tu base de datos actual
+    # El preflight (app/preflight.py) abre su propio pool de procesos dentro del
+    # worker, y un proceso daemon no puede tener hijos.
+    'daemonize_workers': False,
 }
 MIDDLEWARE = [
     'django.middleware.security.SecurityMiddleware',
@@ -103,6 +106,17 @@ REST_FRAMEWORK = {
     'PAGE_SIZE': 100,
 }
 
+# Cache por proceso de usuarios autenticados (evita 2 queries por request)
+USUARIO_CACHE = {
+    'TTL': int(os.getenv('USUARIO_CACHE_TTL', '30')),   # segundos
+    'TTL_VERSION': 15,  # máximo tiempo que otro worker acepta un token ya invalidado
+    'MAX_ENTRADAS': 2048,
+}
+
+# Si está activo, el access token lleva tipo de usuario, es_admin y descuento,
+# y los endpoints calientes no consultan la base para saber el rol del usuario
+JWT_CLAIMS_AUTH = os.getenv('JWT_CLAIMS_AUTH', 'False') == 'True'
+
 SIMPLE_JWT = {
     'ACCESS_TOKEN_LIFETIME': timedelta(hours=1),
     'REFRESH_TOKEN_LIFETIME': timedelta(days=1),
@@ -125,6 +139,30 @@ CLOUDINARY_STORAGE = {
     'API_SECRET': os.getenv('CLOUDINARY_API_SECRET')
 }
 DEFAULT_FILE_STORAGE = 'cloudinary_storage.storage.RawMediaCloudinaryStorage'
+# Cantidad máxima de archivos de un pedido que se suben a la vez
+SUBIDAS_PARALELAS = int(os.getenv('SUBIDAS_PARALELAS', '4'))
+
+# Cliente de R2 compartido por proceso (app/almacenamiento.cliente_r2)
+R2_CLIENTE = {
+    'MAX_CONEXIONES': int(os.getenv('R2_MAX_CONEXIONES', '20')),  # conexiones keep-alive por proceso
+    'TIMEOUT_CONEXION': 5,    # segundos
+    'TIMEOUT_LECTURA': 60,
+    'REINTENTOS': 3,          # modo 'standard' de botocore: backoff con jitter
+}
+
+# Subida directa del navegador a R2 con URLs prefirmadas
+SUBIDA_DIRECTA = {
+    'EXPIRACION': 3600,                      # segundos de validez de cada URL
+    'UMBRAL_MULTIPART': 100 * 1024 * 1024,   # desde este tamaño se usa multipart upload
+    'BYTES_PARTE': 64 * 1024 * 1024,         # R2/S3: mínimo 5 MiB, máximo 10.000 partes
+}
+
+# Subida reanudable por partes a través del backend (SesionSubida)
+SUBIDA_PARTES = {
+    'BYTES_PARTE': 8 * 1024 * 1024,          # tamaño de cada parte (mínimo 5 MiB salvo la última)
+    'TAMANIO_MAXIMO': 4 * 1024 * 1024 * 1024,
+    'VIGENCIA_HORAS': 48,                    # sesiones activas más viejas se abortan en la limpieza
+}
 
 ROOT_URLCONF = 'backendSuchus.urls'
 
@@ -145,6 +183,7 @@ TEMPLATES = [
 ]
 
 WSGI_APPLICATION = 'backendSuchus.wsgi.application'
+ASGI_APPLICATION = 'backendSuchus.asgi.application'
 
 # --- CONFIGURACIÓN DE BASE DE DATOS (SUPER REFORZADA) ---
 
@@ -248,3 +287,90 @@ else:
 # Email por defecto para FROM
 DEFAULT_FROM_EMAIL = 'Copysuchus@gmail.com'
 SERVER_EMAIL = 'Copysuchus@gmail.com'
+
+# Tabla de tarifas de impresión en memoria (app/precios.py). Se invalida al guardar un
+# TipoImpresion; el TTL acota cuánto tarda otro worker en ver el cambio.
+PRECIOS = {
+    'TTL': 300,  # segundos
+}
+
+# Máximo de pedidos por llamada a /pedidos/cambiar_estado_bulk/
+CAMBIO_ESTADO_BULK_MAX = 500
+
+# Máximo de pedidos que una estación toma por llamada a /pedidos/claim_next/
+RECLAMAR_MAX = 20
+
+# Outbox de notificaciones (app/outbox.py): reintentos con backoff exponencial
+NOTIFICACIONES = {
+    'MAX_INTENTOS': 6,
+    'BACKOFF_BASE': 30,     # segundos hasta el primer reintento, se duplica en cada fallo
+    'BACKOFF_MAX': 3600,
+    # Segundos que un worker "reserva" la notificación mientras la envía: más que
+    # Q_CLUSTER['timeout'], así una tarea viva nunca comparte notificaciones con otra
+    'LEASE': 150,
+    # Entrega (app/notifications.py): una conexión por proceso, lotes y tope de envíos
+    'LOTE': 50,
+    'ENVIOS_POR_SEGUNDO': float(os.getenv('EMAIL_ENVIOS_POR_SEGUNDO', '5')),
+    'CONEXION_MAX_IDLE': 60,  # segundos; pasado ese tiempo se reabre (los SMTP cortan las ociosas)
+}
+
+# Cambios de estado en vivo por SSE (app/eventos.py, requiere servir la app ASGI)
+EVENTOS = {
+    # Con Postgres los procesos web comparten los eventos por LISTEN/NOTIFY; el broker
+    # en memoria (SQLite, desarrollo) solo alcanza con un proceso web.
+    'BROKER': os.getenv('EVENTOS_BROKER', 'app.eventos.BrokerPostgres' if DATABASE_URL else 'app.eventos.BrokerLocal'),
+    # Conexión directa para LISTEN si DATABASE_URL es un pooler en modo transacción
+    'LISTEN_URL': os.getenv('EVENTOS_LISTEN_URL'),
+    'MAX_COLA': 100,        # eventos pendientes por conexión antes de descartar
+    'HEARTBEAT': 25,        # segundos entre pings (los proxies cortan conexiones ociosas)
+    'RETRY_MS': 5000,       # espera sugerida al navegador antes de reconectar
+    'TTL_TICKET': 30,       # segundos para usar el ticket del stream (un solo uso)
+}
+
+# Preflight de archivos de impresión (app/preflight.py): corre en el cluster, cada
+# archivo se analiza en un proceso aparte con tiempo y memoria acotados.
+PREFLIGHT = {
+    'PROCESOS': int(os.getenv('PREFLIGHT_PROCESOS', '2')),
+    # Descarga + análisis de un archivo tienen que entrar en Q_CLUSTER['timeout']
+    # (preflight.archivos_por_tarea reparte los archivos en tareas según esto)
+    'TIMEOUT': 45,                      # segundos de análisis por archivo
+    'TIMEOUT_DESCARGA': 30,             # segundos para bajar el archivo
+    'INTENTOS': 3,                      # fallas transitorias (descarga, tiempo, memoria)
+    'MEMORIA_MB': 512,                  # límite de memoria de cada proceso de análisis
+    'MAX_BYTES': 200 * 1024 * 1024,     # archivos más grandes no se analizan
+    'MAX_PAGINAS': 2000,
+    'TAREAS_POR_PROCESO': 50,           # se recicla el proceso para no acumular memoria
+}
+
+# Plan de impresión por lotes (app/planificacion.py, GET /api/pedidos/plan_impresion/)
+PLAN_IMPRESION = {
+    'VENTANA_HORAS': 24,      # un pedido más nuevo que esto respecto del más viejo no lo adelanta
+    'MAX_HOJAS_LOTE': 2000,   # se corta el lote para no frenar a los otros formatos
+    'RESINCRONIZAR': 600,     # segundos entre rearmados completos desde la base
+    'MARGEN': 5,              # segundos de solapamiento al buscar pedidos modificados
+}
+
+# Limpieza de impresiones sin uso en el cluster (app/limpieza.py)
+LIMPIEZA = {
+    'LOTE': 500,     # impresiones por lote: una tarea, una transacción y un DeleteObjects
+    'LEASE': 300,    # segundos sin avance tras los que otro worker puede retomar el trabajo
+    'SEGUNDOS_BORRADO': 45,   # tope por tarea para borrar en Cloudinary (una llamada por archivo)
+    'REINTENTOS': 3,          # vueltas sin avance sobre los objetos que no se pudieron borrar
+}
+
+# Último acceso de impresiones con escrituras agrupadas (app/accesos.py)
+ACCESOS = {
+    'INTERVALO': 30,          # segundos entre volcados a la base (atraso máximo de last_accessed)
+    'LOTE': 200,              # filas por UPDATE ... CASE
+    'MAX_PENDIENTES': 5000,   # con más accesos acumulados se vuelca enseguida
+}
+
+# Caché en disco de los archivos de impresión en el servidor del local (app/cache_archivos.py)
+CACHE_ARCHIVOS = {
+    'DIRECTORIO': os.getenv('CACHE_ARCHIVOS_DIR', str(BASE_DIR / 'cache_archivos')),
+    'MAX_BYTES': int(os.getenv('CACHE_ARCHIVOS_MAX_MB', '5120')) * 1024 * 1024,
+    'PRECARGA_HILOS': 2,      # descargas en paralelo al pasar pedidos a "En proceso"
+    # Detrás de nginx: 'X-Accel-Redirect' y un location internal que apunte a DIRECTORIO
+    'SENDFILE': os.getenv('CACHE_ARCHIVOS_SENDFILE', ''),
+    'PREFIJO_SENDFILE': os.getenv('CACHE_ARCHIVOS_PREFIJO', '/cache_archivos/'),
+}
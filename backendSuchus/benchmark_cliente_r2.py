@@ -0,0 +1,47 @@
+# Micro-benchmark: costo por llamada de armar un cliente de R2 en cada request
+# contra reutilizar el cliente del proceso (app/almacenamiento.cliente_r2).
+#
+#   python benchmark_cliente_r2.py            solo construcción del cliente
+#   python benchmark_cliente_r2.py --red      además N head_bucket contra el bucket
+#                                             configurado (CLOUDFLARE_* o un MinIO local
+#                                             con CLOUDFLARE_ENDPOINT_URL)
+import os
+import statistics
+import sys
+import time
+
+import django
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'backendSuchus.settings')
+django.setup()
+
+import boto3
+
+from app.almacenamiento import cliente_r2, config_r2
+
+N = int(os.getenv('BENCHMARK_N', '50'))
+
+
+def medir(nombre, funcion):
+    tiempos = []
+    for _ in range(N):
+        inicio = time.perf_counter()
+        funcion()
+        tiempos.append((time.perf_counter() - inicio) * 1000)
+    print(f"{nombre:<40} mediana {statistics.median(tiempos):8.2f} ms   p95 {sorted(tiempos)[int(N * 0.95) - 1]:8.2f} ms")
+
+
+def cliente_nuevo():
+    return boto3.client('s3', **config_r2())
+
+
+print(f"{N} llamadas\n")
+print("Construcción del cliente")
+medir("  boto3.client() por llamada (antes)", cliente_nuevo)
+medir("  cliente_r2() compartido (ahora)", cliente_r2)
+
+if '--red' in sys.argv:
+    _, bucket = cliente_r2()
+    print(f"\nhead_bucket contra {config_r2()['endpoint_url']} / {bucket}")
+    medir("  cliente nuevo + conexión TLS nueva", lambda: cliente_nuevo().head_bucket(Bucket=bucket))
+    medir("  cliente compartido (keep-alive)", lambda: cliente_r2()[0].head_bucket(Bucket=bucket))
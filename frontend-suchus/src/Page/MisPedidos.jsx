@@ -35,6 +35,11 @@ const MisPedidos = () => {
     cargarTarifas();
   }, []);
 
+  // Estados en vivo: actualiza la fila sin volver a pedir el listado
+  useEffect(() => pedidosAPI.suscribirEstados(({ id, estado, version, motivo_correccion }) => {
+    setPedidos(prev => prev.map(p => (p.id === id ? { ...p, estado, version, motivo_correccion } : p)));
+  }), []);
+
   const cargarTarifas = async () => {
     try {
       const response = await api.get('tipo-impresion/activos/');
@@ -201,7 +206,8 @@ const MisPedidos = () => {
         impresion_id: parseInt(impresionId),
         formato: data.formato,
         color: data.color,
-        copias: data.copias
+        copias: data.copias,
+        paginas: data.hojas || 1
       }));
       
       formData.append('archivos_corregidos', JSON.stringify(archivos_corregidos));
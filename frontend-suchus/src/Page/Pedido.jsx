@@ -114,7 +114,7 @@ const Pedido = () => {
           formData.append(`archivo_impresion_${index}`, imp.file);
         }
 
-        // Importante: El subtotal individual es necesario para el total_bruto del backend
+        // Subtotal estimado en el front (el backend lo recalcula con TipoImpresion)
         const subtotalIndividual = imp.cantidad * imp.precioUnitario;
 
         return {
@@ -122,7 +122,8 @@ const Pedido = () => {
           formato: imp.tipoHoja || 'A4',
           color: imp.color === 'color' ? 'color' : 'bn',
           copias: imp.cantidad,
-          subtotal: subtotalIndividual // <--- Vital para el backend
+          paginas: imp.hojas || 1, // el backend calcula el precio con la tarifa vigente
+          subtotal: subtotalIndividual // solo referencia: el total lo calcula el backend
         };
       });
       
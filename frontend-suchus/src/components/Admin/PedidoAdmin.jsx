@@ -9,6 +9,17 @@ const { Title } = Typography;
 const { Option } = Select;
 const { RangePicker } = DatePicker;
 
+// Destinos permitidos desde cada estado: igual que Pedido.TRANSICIONES en el backend
+const TRANSICIONES = {
+  'Pendiente': ['En proceso', 'Preparado', 'Retirado', 'Cancelado', 'Requiere Corrección'],
+  'En proceso': ['Pendiente', 'Preparado', 'Retirado', 'Cancelado', 'Requiere Corrección'],
+  'Preparado': ['En proceso', 'Retirado', 'Cancelado'],
+  'Retirado': ['Preparado'],
+  'Cancelado': ['Pendiente'],
+  'Requiere Corrección': ['Pendiente', 'Cancelado', 'Requiere Corrección'],
+};
+const ESTADOS = ['Pendiente', 'En proceso', 'Preparado', 'Retirado', 'Cancelado', 'Requiere Corrección'];
+
 const PedidoAdmin = () => {
   const navigate = useNavigate();
   const [pedidos, setPedidos] = useState([]);
@@ -104,6 +115,11 @@ const PedidoAdmin = () => {
     cargarTiposUsuario();
   }, []);
 
+  // Estados en vivo: actualiza la fila sin volver a pedir el listado
+  useEffect(() => pedidosAPI.suscribirEstados(({ id, estado, version, motivo_correccion }) => {
+    setPedidos(prev => prev.map(p => (p.id === id ? { ...p, estado, version, motivo_correccion } : p)));
+  }), []);
+
   const cargarClientes = async () => {
     try {
       const response = await usuariosAPI.getAll({ activo: true });
@@ -385,13 +401,13 @@ const PedidoAdmin = () => {
         precio_unitario: Number(p.precioUnitario) || 0
       }));
 
+      // El precio lo calcula el servidor con las páginas de cada archivo (el admin no sube el PDF)
       const detallesImpresiones = impresiones.map(imp => ({
         nombre_archivo: imp.nombre,
-        hojas: imp.detalles.hojas,
+        paginas: imp.detalles.hojas,
         formato: imp.detalles.formato,
         color: imp.detalles.color,
-        copias: imp.cantidad,
-        precio_unitario: imp.precioUnitario
+        copias: imp.cantidad
       }));
 
       // LA CLAVE: Convertimos los arrays a STRING porque tu backend hace json.loads()
@@ -424,11 +440,21 @@ const PedidoAdmin = () => {
 
   const handleCambiarEstado = async (id, nuevoEstado, motivo = null) => {
     try {
-      await pedidosAPI.cambiarEstado(id, nuevoEstado, motivo);
+      const version = pedidos.find(p => p.id === id)?.version;
+      await pedidosAPI.cambiarEstado(id, nuevoEstado, motivo, version);
       message.success(`Pedido #${id} actualizado`);
       fetchPedidos();
     } catch (error) {
-      message.error("No se pudo actualizar el estado");
+      if (error.response?.status === 412) {
+        message.warning(`El pedido #${id} fue modificado por otra persona. Se recargó la lista.`);
+        fetchPedidos();
+      } else if (error.response?.status === 409) {
+        // El estado cambió desde que se cargó la lista: se muestra el vigente
+        message.warning(error.response.data?.error || `No se puede cambiar el estado del pedido #${id}`);
+        fetchPedidos();
+      } else {
+        message.error(error.response?.data?.error || "No se pudo actualizar el estado");
+      }
     }
   };
 
@@ -510,13 +536,15 @@ const PedidoAdmin = () => {
               value={record.estado}
               size="small"
               style={{ width: 170 }}
-              onChange={(value) => {
+              // onSelect (no onChange): volver a elegir "Requiere Corrección" reenvía el motivo
+              onSelect={(value) => {
+                if (value === record.estado && value !== 'Requiere Corrección') return;
                 if (value === 'Cancelado') {
                   setPedidoACancelar(record.id);
                   setConfirmCancelarVisible(true);
                 } else if (value === 'Requiere Corrección') {
                   setPedidoMotivoId(record.id);
-                  setMotivoCorreccion('');
+                  setMotivoCorreccion(record.estado === value ? (record.motivo_correccion || '') : '');
                   setModalMotivoVisible(true);
                 } else {
                   handleCambiarEstado(record.id, value);
@@ -524,12 +552,15 @@ const PedidoAdmin = () => {
               }}
               onClick={(e) => e.stopPropagation()}
             >
-              <Option value="Pendiente">Pendiente</Option>
-              <Option value="En proceso">En proceso</Option>
-              <Option value="Preparado">Preparado</Option>
-              <Option value="Retirado">Retirado</Option>
-              <Option value="Cancelado">Cancelado</Option>
-              <Option value="Requiere Corrección">Requiere Corrección</Option>
+              {ESTADOS.map(estado => (
+                <Option
+                  key={estado}
+                  value={estado}
+                  disabled={estado !== record.estado && !(TRANSICIONES[record.estado] || []).includes(estado)}
+                >
+                  {estado}
+                </Option>
+              ))}
             </Select>
           </Space>
         </Space>
@@ -136,15 +136,52 @@ const pedidosAPI = {
     const response = await api.delete(`pedidos/${id}/`);
     return response.data;
   },
-  cambiarEstado: async (id, estado, motivo_correccion = null) => {
+  cambiarEstado: async (id, estado, motivo_correccion = null, version = null) => {
     const data = motivo_correccion ? { estado, motivo_correccion } : { estado };
-    const response = await api.patch(`pedidos/${id}/cambiar_estado/`, data);
+    // If-Match: si otro operador cambió el pedido antes, el backend responde 412
+    const headers = version ? { 'If-Match': `"${version}"` } : {};
+    const response = await api.patch(`pedidos/${id}/cambiar_estado/`, data, { headers });
     return response.data;
   },
   misPedidos: async (params = {}) => {
     const response = await api.get('pedidos/mis_pedidos/', { params });
     return response.data;
   },
+  // Cambios de estado en vivo (Server-Sent Events). Devuelve una función para cerrar la conexión.
+  suscribirEstados: (onCambio) => {
+    let fuente = null;
+    let cerrado = false;
+    const conectar = async () => {
+      const tokenCookie = document.cookie.split(';').map(c => c.trim()).find(c => c.startsWith('access_token='));
+      if (cerrado || !tokenCookie) return;
+      // EventSource no manda headers: en la URL va un ticket de un solo uso, no el JWT
+      let ticket;
+      try {
+        ticket = (await api.post('eventos/ticket/')).data.ticket;
+      } catch (error) {
+        setTimeout(conectar, 5000);
+        return;
+      }
+      if (cerrado) return;
+      fuente = new EventSource(`${API_URL}eventos/pedidos/?ticket=${encodeURIComponent(ticket)}`);
+      fuente.addEventListener('pedido_estado', (e) => onCambio(JSON.parse(e.data)));
+      const reconectar = () => {
+        fuente.close();
+        setTimeout(conectar, 5000);
+      };
+      // El servidor cierra al vencer el token; con un 401 el navegador no reintenta solo.
+      // Cada reconexión pide un ticket nuevo (el anterior ya se usó)
+      fuente.addEventListener('token_vencido', reconectar);
+      fuente.onerror = () => {
+        if (fuente.readyState === EventSource.CLOSED) reconectar();
+      };
+    };
+    conectar();
+    return () => {
+      cerrado = true;
+      if (fuente) fuente.close();
+    };
+  },
   corregirArchivos: async (id, formData) => {
     const response = await api.post(`pedidos/${id}/corregir_archivos/`, formData, {
       headers: {